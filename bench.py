@@ -0,0 +1,435 @@
+"""Headless benchmarks for the editor core, runnable without a display.
+
+Drives a document, highlighter and line number gutter the way TextEditor
+does, over generated files of 1k to 1M lines:
+
+    python bench.py                          # every size, both grammars up to 100k lines
+    python bench.py --sizes 1000 10000 --json before.json
+    python bench.py --sizes 1000 10000 --compare before.json
+
+Latencies are reported as p50/p95/p99 in milliseconds and throughput as
+lines and megabytes per second.
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+from gvim_core import (CompiledGrammar, LineNumbers, PieceTable, Profiler, SaveWorker, SearchWorker,
+                       SyntaxHighlighter, TokenizerWorker, WorkspaceIndex)
+
+BASIC_RULES = [
+    {"pattern": r"/\*[\s\S]*?\*/", "color": "#6a9955", "priority": 5},
+    {"pattern": r"//.*", "color": "#6a9955", "priority": 4},
+    {"pattern": r'"(?:[^"\\\n]|\\.)*"', "color": "#ce9178", "priority": 3},
+    {"pattern": r"\b(?:if|else|for|while|return|break|continue|struct|static|const)\b", "color": "#569cd6",
+     "priority": 2},
+    {"pattern": r"\b(?:int|char|void|long|float|double|unsigned)\b", "color": "#4ec9b0", "priority": 2},
+    {"pattern": r"\b\d+(?:\.\d+)?\b", "color": "#b5cea8", "priority": 1},
+]
+
+WORDS = ["alpha", "beta", "count", "index", "buffer", "length", "result", "value", "node", "next", "size", "data"]
+
+
+def heavy_rules():
+    """The basic grammar plus many overlapping word, call, operator and lookaround rules"""
+    rules = list(BASIC_RULES)
+    rules += [
+        {"pattern": r"^\s*#\s*(?:include|define|ifdef|ifndef|endif|pragma)\b.*", "color": "#c586c0", "priority": 6},
+        {"pattern": r"\b0x[0-9a-fA-F]+\b", "color": "#b5cea8", "priority": 1},
+        {"pattern": r"\b[A-Z][A-Z0-9_]{2,}\b", "color": "#4fc1ff", "priority": 1},
+        {"pattern": r"\b[a-z_]\w*(?=\s*\()", "color": "#dcdcaa", "priority": 1},
+        {"pattern": r"(?<=\.)[a-z_]\w*", "color": "#9cdcfe", "priority": 1},
+        {"pattern": r"(?<=->)[a-z_]\w*", "color": "#9cdcfe", "priority": 1},
+        {"pattern": r"[-+*/%=<>!&|^~]=?|&&|\|\|", "color": "#d4d4d4", "priority": 0},
+        {"pattern": r"[{}()\[\];,]", "color": "#808080", "priority": 0},
+        {"pattern": r"\b(?:TODO|FIXME|XXX)\b", "color": "#ff8800", "priority": 7},
+    ]
+    for i, word in enumerate(WORDS * 4):
+        rules.append({"pattern": rf"\b{word}{i}\w*\b", "color": "#aaaaaa", "priority": 0})
+    return rules
+
+
+def generate(lines, seed=0):
+    """C-like source of exactly `lines` lines, with no line break after the last one"""
+    rng = random.Random(seed)
+    out = []
+    while len(out) < lines:
+        kind = rng.random()
+        a, b = rng.choice(WORDS), rng.choice(WORDS)
+        if kind < 0.05:
+            out.append("/*")
+            out.extend(f" * {a} {b} {rng.randint(0, 999)}" for _ in range(rng.randint(1, 6)))
+            out.append(" */")
+        elif kind < 0.15:
+            out.append(f"static int {a}_{b}(int {a}, const char *{b}) {{")
+        elif kind < 0.2:
+            out.append("}")
+        elif kind < 0.35:
+            out.append(f"    // {a} {b} TODO {rng.randint(0, 99)}")
+        elif kind < 0.5:
+            out.append(f'    printf("{a} %d {b}\\n", {a}->{b});')
+        elif kind < 0.7:
+            out.append(f"    if ({a} < {rng.randint(0, 9999)}) {{ {b} = {a} + 0x{rng.randint(0, 65535):x}; }}")
+        else:
+            out.append(f"    {a}.{b} = {b}({a}, {rng.random():.3f});")
+    return "\n".join(out[:lines])
+
+
+class Session:
+    """A document, highlighter and gutter driven the way TextEditor drives them"""
+
+    def __init__(self, path, rules, viewport=50, margin=50, chunk_ms=8):
+        self.document = PieceTable.open(path)
+        self.highlighter = SyntaxHighlighter()
+        self.highlighter.set_grammar(CompiledGrammar(rules))
+        self.gutter = LineNumbers(virtual=True)
+        self.gutter.line_count = self.document.line_count()
+        self.viewport = viewport
+        self.margin = margin
+        self.chunk_ms = chunk_ms
+        self.top = 0
+
+    def line_count(self):
+        return self.document.line_count()
+
+    def get_lines(self, first, last):
+        text = self.document.read(first, last - first + 1)
+        return text if text.endswith("\n") else text + "\n"
+
+    def frame(self):
+        """One redraw: tokenize what is pending around the viewport and draw its line numbers"""
+        line_count = self.line_count()
+        bottom = min(line_count - 1, self.top + self.viewport - 1)
+        deadline = time.perf_counter() + self.chunk_ms / 1000
+        regions = self.highlighter.highlight_lines(self.get_lines, line_count, self.top - self.margin,
+                                                   bottom + self.margin, deadline)
+        self.gutter.window_text(self.top + 1, bottom + 1)
+        return regions
+
+    def replace_lines(self, first, count, text):
+        """Replace whole lines and report the edit like the text widget hook does"""
+        added = text.count("\n")
+        self.document.replace_lines(first, count, text)
+        removed, added = (count - 1, added - 1) if count and added else (count, added)
+        self.highlighter.on_edit(first, removed, added)
+        self.gutter.on_edit(removed, added)
+
+    def settle(self, chunk_lines=200):
+        """Tokenize everything still pending, as idle-time highlighting would"""
+        while self.highlighter.highlight_next(self.get_lines, self.line_count(), self.top, chunk_lines):
+            pass
+
+    def close(self):
+        self.document.close()
+
+
+def throughput(seconds, lines, size):
+    seconds = max(seconds, 1e-9)
+    return {"seconds": seconds, "lines_per_s": lines / seconds, "mb_per_s": size / seconds / 1e6}
+
+
+def bench_open(path, lines):
+    started = time.perf_counter()
+    document = PieceTable.open(path)
+    document.line_count()
+    document.read(lines // 2, 50)
+    elapsed = time.perf_counter() - started
+    document.close()
+    return throughput(elapsed, lines, os.path.getsize(path))
+
+
+def bench_scroll(path, lines, rules, frames=300):
+    """Page through a freshly opened file, tokenizing only what comes on screen"""
+    session = Session(path, rules)
+    profiler = Profiler(enabled=True)
+    step = max(1, lines // frames)
+    for top in range(0, lines, step):
+        session.top = top
+        started = time.perf_counter()
+        session.frame()
+        profiler.record("frame", time.perf_counter() - started)
+    session.close()
+    return profiler.summary()["frame"]
+
+
+def bench_tokenize(session, lines, size):
+    """Tokenize a freshly opened file in background-sized chunks until nothing is pending"""
+    started = time.perf_counter()
+    session.settle()
+    return throughput(time.perf_counter() - started, lines, size)
+
+
+def bench_typing(session, lines, keys=500, seed=0):
+    """Type a burst into the middle of a tokenized file, one frame per key"""
+    rng = random.Random(seed)
+    profiler = Profiler(enabled=True)
+    line = lines // 2
+    session.top = max(0, line - session.viewport // 2)
+    column = 0
+    for i in range(keys):
+        key = "\n" if i % 40 == 39 else rng.choice("abcdefghijklmnopqrstuvwxyz (){};*/\"")
+        started = time.perf_counter()
+        text = session.get_lines(line, line)
+        session.replace_lines(line, 1, text[:column] + key + text[column:])
+        if key == "\n":
+            line, column = line + 1, 0
+        else:
+            column += 1
+        session.frame()
+        profiler.record("key", time.perf_counter() - started)
+    return profiler.summary()["key"]
+
+
+def bench_worker_typing(session, lines, rules, keys=500, seed=0):
+    """Type a burst with the background tokenizer: UI-side time per key, then time until colors catch up"""
+    rng = random.Random(seed)
+    worker = TokenizerWorker(session.margin)
+    worker.set_grammar(CompiledGrammar(rules))
+    worker.reset(session.get_lines(0, session.line_count() - 1))
+    line = lines // 2
+    session.top = max(0, line - session.viewport // 2)
+    worker.set_view(session.top, session.top + session.viewport - 1)
+    while worker.busy():
+        while not worker.results.empty():
+            worker.results.get()
+        time.sleep(0.001)
+    profiler = Profiler(enabled=True)
+    column = 0
+    painted = 0
+    for i in range(keys):
+        key = "\n" if i % 40 == 39 else rng.choice("abcdefghijklmnopqrstuvwxyz (){};*/\"")
+        started = time.perf_counter()
+        text = session.get_lines(line, line)
+        new = text[:column] + key + text[column:]
+        session.document.replace_lines(line, 1, new)
+        worker.edit(line, 0, new.count("\n") - 1, new)
+        if key == "\n":
+            line, column = line + 1, 0
+        else:
+            column += 1
+        worker.set_view(session.top, session.top + session.viewport - 1)
+        painted += drain_results(worker)
+        profiler.record("key", time.perf_counter() - started)
+    started = time.perf_counter()
+    while worker.busy():
+        painted += drain_results(worker)
+        time.sleep(0.001)
+    caught_up = time.perf_counter() - started
+    worker.stop()
+    return dict(profiler.summary()["key"], catch_up_ms=caught_up * 1000, regions_painted=painted)
+
+
+def drain_results(worker):
+    """What TextEditor.poll_tokens does, without the painting"""
+    painted = 0
+    while True:
+        try:
+            _, generation, region = worker.results.get_nowait()
+        except queue.Empty:
+            return painted
+        if generation == worker.generation:
+            painted += 1
+        else:
+            worker.retry(generation, region[0], region[1])
+
+
+def bench_paste(session, lines, paste_lines=None):
+    """Paste a block into a tokenized file; time the frame and settling the rest"""
+    paste_lines = paste_lines or max(100, lines // 10)
+    block = generate(paste_lines, seed=1) + "\n"
+    session.settle()
+    line = lines // 4
+    session.top = line
+    started = time.perf_counter()
+    session.replace_lines(line, 0, block)
+    session.frame()
+    frame = time.perf_counter() - started
+    session.settle()
+    settled = time.perf_counter() - started
+    return {"lines": paste_lines, "frame_ms": frame * 1000, "settle_ms": settled * 1000,
+            "lines_per_s": paste_lines / max(settled, 1e-9)}
+
+
+def bench_save(path, lines):
+    document = PieceTable.open(path)
+    target = path + ".saved"
+    saver = SaveWorker()
+    started = time.perf_counter()
+    chunks, total = document.chunks()
+    saver.write(target, chunks, total, True, started)
+    kind, *message = saver.messages.get()
+    while kind == "progress":
+        kind, *message = saver.messages.get()
+    if kind == "error":
+        raise message[0]
+    os.replace(message[0], target)
+    elapsed = time.perf_counter() - started
+    document.close()
+    os.remove(target)
+    return throughput(elapsed, lines, total)
+
+
+def bench_search(path, lines):
+    """Search and replace-all on the worker: time to the first batch, to the last, and for the replace"""
+    with open(path, "r") as file:
+        text = file.read()
+    worker = SearchWorker()
+    pattern = SearchWorker.compile("buffer", case=False, word=True)
+    started = time.perf_counter()
+    worker.search(text, pattern)
+    first_batch = None
+    kind = None
+    while kind != "done":
+        kind, _, *rest = worker.results.get()
+        if first_batch is None:
+            first_batch = time.perf_counter() - started
+    searched = time.perf_counter() - started
+    started = time.perf_counter()
+    worker.replace(text, pattern, "BUFFER")
+    kind, _, runs, count = worker.results.get()
+    replaced = time.perf_counter() - started
+    worker.stop()
+    return {"matches": rest[0], "first_batch_ms": first_batch * 1000, "search_ms": searched * 1000,
+            "replace_ms": replaced * 1000, "lines_per_s": lines / max(searched, 1e-9)}
+
+
+def bench_workspace(directory, files, lines=100):
+    """Index a generated tree cold and again unchanged, then time quick open and goto symbol queries as typed"""
+    root = os.path.join(directory, "workspace")
+    for i in range(files):
+        folder = os.path.join(root, f"module{i % 50}", f"part{i % 500}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{WORDS[i % len(WORDS)]}_{i}.c"), "w", newline="\n") as file:
+            file.write(generate(lines, seed=i))
+    rules = {"c": [[r"^static int (\w+)\(", "function"]]}
+    index = WorkspaceIndex(root, directory=os.path.join(directory, "index"))
+    started = time.perf_counter()
+    index.refresh(rules)
+    indexed = time.perf_counter() - started
+    started = time.perf_counter()
+    index.refresh(rules)
+    refreshed = time.perf_counter() - started
+    profiler = Profiler(enabled=True)
+    for query in ("buffer_1234", "nodesize", "@alpha_beta", "@valuedata", "zzqx"):
+        find = index.find_symbols if query.startswith("@") else index.find_files
+        query = query.lstrip("@")
+        for end in range(1, len(query) + 1):
+            started = time.perf_counter()
+            find(query[:end])
+            profiler.record("query", time.perf_counter() - started)
+    metrics = profiler.summary()["query"]
+    metrics.update({"index_ms": indexed * 1000, "refresh_ms": refreshed * 1000, "files": len(index.files),
+                    "symbols": len(index.symbols)})
+    return metrics
+
+
+def run(sizes, grammars, directory, heavy_max_lines):
+    results = {}
+    for lines in sizes:
+        path = os.path.join(directory, f"bench_{lines}.c")
+        with open(path, "w", newline="\n") as file:
+            file.write(generate(lines))
+        results[f"{lines}/open"] = bench_open(path, lines)
+        results[f"{lines}/save"] = bench_save(path, lines)
+        results[f"{lines}/search"] = bench_search(path, lines)
+        for grammar in grammars:
+            if grammar == "heavy" and lines > heavy_max_lines:
+                continue
+            rules = BASIC_RULES if grammar == "basic" else heavy_rules()
+            prefix = f"{lines}/{grammar}"
+            results[f"{prefix}/scroll"] = bench_scroll(path, lines, rules)
+            # Typing and pasting go on in the file the tokenize run left fully highlighted
+            session = Session(path, rules)
+            results[f"{prefix}/tokenize"] = bench_tokenize(session, lines, os.path.getsize(path))
+            results[f"{prefix}/typing"] = bench_typing(session, lines)
+            results[f"{prefix}/paste"] = bench_paste(session, lines)
+            results[f"{prefix}/typing_worker"] = bench_worker_typing(session, lines, rules)
+            session.close()
+            for name in ("scroll", "tokenize", "typing", "paste", "typing_worker"):
+                report(f"{prefix}/{name}", results[f"{prefix}/{name}"])
+        report(f"{lines}/open", results[f"{lines}/open"])
+        report(f"{lines}/save", results[f"{lines}/save"])
+        report(f"{lines}/search", results[f"{lines}/search"])
+        os.remove(path)
+    return results
+
+
+def headline(metrics):
+    """The number a run is compared on: p95 latency or throughput"""
+    if "p95" in metrics:
+        return "p95", metrics["p95"], "ms"
+    if "settle_ms" in metrics:
+        return "settle", metrics["settle_ms"], "ms"
+    return "lines/s", metrics["lines_per_s"], ""
+
+
+def report(name, metrics):
+    if "p95" in metrics:
+        text = (f"p50 {metrics['p50']:8.3f}  p95 {metrics['p95']:8.3f}  p99 {metrics['p99']:8.3f} ms"
+                f"  ({metrics['count']} samples)")
+        if "catch_up_ms" in metrics:
+            text += f"  catch-up {metrics['catch_up_ms']:.1f} ms"
+        if "index_ms" in metrics:
+            text += (f"  index {metrics['index_ms']:.0f} ms, unchanged {metrics['refresh_ms']:.0f} ms"
+                     f" ({metrics['files']} files, {metrics['symbols']} symbols)")
+    elif "search_ms" in metrics:
+        text = (f"first batch {metrics['first_batch_ms']:8.3f} ms  all {metrics['search_ms']:10.1f} ms"
+                f"  replace {metrics['replace_ms']:10.1f} ms  ({metrics['matches']} matches)")
+    elif "settle_ms" in metrics:
+        text = f"frame {metrics['frame_ms']:8.3f} ms  settle {metrics['settle_ms']:10.1f} ms  ({metrics['lines']} lines)"
+    else:
+        text = f"{metrics['lines_per_s']:14,.0f} lines/s  {metrics['mb_per_s']:8.1f} MB/s  {metrics['seconds']:.3f} s"
+    print(f"{name:<28} {text}", flush=True)
+
+
+def compare(results, old_path):
+    with open(old_path, "r") as file:
+        old = json.load(file)["results"]
+    print(f"\nCompared with {old_path}:")
+    for name, metrics in results.items():
+        if name not in old:
+            continue
+        label, new_value, unit = headline(metrics)
+        old_value = headline(old[name])[1]
+        change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+        print(f"{name:<28} {label:>7} {old_value:14.3f} -> {new_value:14.3f} {unit:<2} ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="document sizes in lines")
+    parser.add_argument("--grammar", choices=["basic", "heavy", "both"], default="both")
+    parser.add_argument("--heavy-max-lines", type=int, default=100000,
+                        help="skip the heavy grammar above this size, it tokenizes about ten times slower")
+    parser.add_argument("--workspace-files", type=int, default=10000,
+                        help="files in the generated tree for the workspace index, 0 to skip it")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    grammars = ["basic", "heavy"] if args.grammar == "both" else [args.grammar]
+    directory = tempfile.mkdtemp(prefix="gvim_bench_")
+    try:
+        results = run(args.sizes, grammars, directory, args.heavy_max_lines)
+        if args.workspace_files:
+            results["workspace/query"] = bench_workspace(directory, args.workspace_files)
+            report("workspace/query", results["workspace/query"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"timestamp": time.time(), "python": sys.version.split()[0],
+                       "platform": platform.platform(), "results": results}, file, indent=4)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,25 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, Toplevel, Listbox, Label, END
 import json
-import re
 import os
-import importlib.util
-from ctypes import windll, Structure, c_int, byref, sizeof, c_void_p, cast, POINTER
-
-class EditorAPI:
-    def __init__(self, editor):
-        self.editor = editor
-        self.event = {}
-
-    def __init__(self, editor):
-        self.editor = editor
-        self.event = {}
-
-    def update_event(self, name, value):
-        """Update event with a name and value"""
-        print(f"Event: {name} - {value}")
-        self.event[name] = value
-
-    def pop_event(self):
-        """Clear the event after it is handled"""
-        return self.event.popitem()
-    
-    def get_text(self):
-        return self.editor.text_area.get(1.0, tk.END)
-    
-    def set_text(self, text):
-        self.editor.text_area.delete(1.0, tk.END)
-        self.editor.text_area.insert(1.0, text)
-
-    def get_file_path(self):
-        return self.editor.file_path
-
+import queue
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+import gvim_core
+from gvim_core import (PROFILER, Buffer, BufferList, CompiledGrammar, DocumentChanged, EventBus, ExtensionIndex,
+                       FileWatcher, GrammarCache, PieceTable, RuleProfiler, SaveWorker, SearchWorker, SyntaxPackage, ThemeRegistry,
+                       TokenizerWorker, UndoJournal, WorkspaceIndex)
+
+class EditorAPI(gvim_core.EditorAPI):
     def insert_text(self, position, text):
-        self.editor.text_area.insert(position, text)
+        self.call_on_ui(self.editor.text_area.insert, position, text)
 
     def get_selection(self):
+        return self.read_on_ui(self.read_selection)
+
+    def read_selection(self):
         try:
             return self.editor.text_area.get(tk.SEL_FIRST, tk.SEL_LAST)
         except tk.TclError:
@@ -45,9 +27,12 @@ class EditorAPI:
         
     def bind_key(self, key, callback):
         """binds a key but does not interfere with the editor's key bindings"""
-        self.editor.text_area.bind(key, callback)
+        self.call_on_ui(self.editor.bind_text, key, callback)
 
     def replace_selection(self, text):
+        self.call_on_ui(self.apply_replace_selection, text)
+
+    def apply_replace_selection(self, text):
         try:
             self.editor.text_area.delete(tk.SEL_FIRST, tk.SEL_LAST)
             self.editor.text_area.insert(tk.SEL_FIRST, text)
@@ -55,34 +40,79 @@ class EditorAPI:
             pass
 
     def get_cursor_position(self):
-        return self.editor.text_area.index(tk.INSERT)
+        return self.read_on_ui(self.editor.text_area.index, tk.INSERT)
 
     def set_cursor_position(self, position):
+        self.call_on_ui(self.apply_cursor_position, position)
+
+    def apply_cursor_position(self, position):
         self.editor.text_area.mark_set(tk.INSERT, position)
         self.editor.text_area.see(tk.INSERT)
 
+    def offset_to_index(self, offset):
+        """Text index "line.column" of a character offset into the text area"""
+        return self.read_on_ui(self.editor.line_index.index, offset)
 
-class PluginManager:
-    def __init__(self, editor):
-        self.editor = editor
-        self.plugins = []
-        self.toggled_off_plugins = []
-        self.plugin_dir = "plugins"
-        self.api = EditorAPI(editor)
+    def index_to_offset(self, index):
+        """Character offset of a "line.column" index, the other way round"""
+        return self.read_on_ui(lambda: self.editor.line_index.offset(self.editor.text_area.index(index)))
 
-    def install_plugin(self, path):
-        with open(path, 'r') as p, open(f'plugins/{path}', 'w') as f: 
-            f.write(p.read())
-            self.load_plugin(f'plugins/{path}')
+    def get_line_start(self, line):
+        """Character offset where 1-based `line` starts"""
+        return self.read_on_ui(self.editor.line_index.line_start, line - 1)
 
-    def load_plugins(self):
-        if not os.path.exists(self.plugin_dir):
-            os.makedirs(self.plugin_dir)
-        
-        for file in os.listdir(self.plugin_dir):
-            if file.endswith(".py"):
-                plugin_path = os.path.join(self.plugin_dir, file)
-                self.load_plugin(plugin_path)
+    def undo(self):
+        self.call_on_ui(self.editor.undo)
+
+    def redo(self):
+        self.call_on_ui(self.editor.redo)
+
+    def find(self, pattern, regex=False, case=True, word=False):
+        """Search the buffer on the search worker; get_matches fills up as matches come in"""
+        self.call_on_ui(self.editor.start_search, pattern, regex, case, word, False)
+
+    def get_matches(self):
+        """(start, end) "line.column" indices, in document lines, of the matches found so far"""
+        return [(f"{line}.{column}", f"{end_line}.{end_column}")
+                for line, column, end_line, end_column in self.read_on_ui(lambda: list(self.editor.search_matches))]
+
+    def replace_all(self, pattern, replacement, regex=False, case=True, word=False):
+        """Replace every match as one undo step; with `regex` the replacement may use groups like re.sub"""
+        self.call_on_ui(self.apply_replace_all, pattern, replacement, regex, case, word)
+
+    def apply_replace_all(self, pattern, replacement, regex, case, word):
+        if self.editor.start_search(pattern, regex, case, word, False):
+            self.editor.replace_all(replacement)
+
+    def get_rule_report(self, count=10):
+        """The slowest syntax rules of the current grammar, see RuleProfiler.report"""
+        return self.read_on_ui(lambda: self.editor.rule_profiler.report(self.editor.highlighter.grammar, count))
+
+    def goto_location(self, path, line=None):
+        """Open `path`, at 1-based `line` if given, e.g. a result of find_files or find_symbols"""
+        self.call_on_ui(self.editor.goto_location, path, line)
+
+    def get_live_tag_count(self):
+        """Number of tags in the text area, should stay flat while editing"""
+        return self.read_on_ui(self.editor.tag_pool.live_count)
+
+
+class PluginManager(gvim_core.PluginManager):
+    """Plugin manager hooked into the text area, Extensions menu and mainloop"""
+
+    api_class = EditorAPI
+
+    def bind_key_trigger(self, name, key):
+        self.editor.bind_text(key, lambda e, n=name, k=key: self.activate_on_key(n, k), add="+")
+
+    def add_command_trigger(self, name, label):
+        self.editor.extensions_menu.add_command(label=label, command=lambda n=name: self.run_command(n))
+
+    def replay_key(self, key):
+        self.editor.root.after_idle(lambda: self.editor.text_area.event_generate(key))
+
+    def schedule(self, delay_ms, callback):
+        return self.editor.root.after(delay_ms, callback)
 
     def uninstall_disable_plugin(self):
         # Modern and clean borderless plugin manager GUI
@@ -132,6 +162,10 @@ class PluginManager:
                                             style="Switch.TCheckbutton")
             toggle_button.grid(row=i, column=0, sticky="w", padx=10, pady=5)
             toggle_button.configure(command=lambda var=toggle_var, idx=i: self.toggle_plugin_state(var, idx))
+            stats_label = tk.Label(toggle_frame, text=self.format_stats(plugin), font=("Helvetica", 9),
+                                   fg=self.editor.current_scheme["line_number_color"],
+                                   bg=self.editor.current_scheme["background_color"])
+            stats_label.grid(row=i, column=1, sticky="w", padx=10, pady=5)
 
         # Styled delete button
         delete_button = ttk.Button(self.plugin_window, text="Delete", command=self.delete_plugin)
@@ -161,25 +195,159 @@ class PluginManager:
         else:
             self.toggled_off_plugins.append(plugin)
 
-    def load_plugin(self, plugin_path):
-        plugin_name = os.path.splitext(os.path.basename(plugin_path))[0]
-        spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        if hasattr(module, "run"):
-            self.plugins.append(module)
-
-    def execute_plugins(self):
-        for plugin in self.plugins:
-            plugin.run(self.api)
-
     def move_window(self, event):
         x, y = event.x_root, event.y_root
         self.plugin_window.geometry(f"+{x}+{y}")
 
 
+class TagPool:
+    """A fixed set of configured Text tags, one per syntax rule, shared by all matches"""
+
+    def __init__(self, widget, prefix="syntax"):
+        self.widget = widget
+        self.prefix = prefix
+        self.names = []
+
+    def build(self, rules, get_styles):
+        """Create one tag per rule; rules come highest priority first"""
+        if len(rules) != len(self.names):
+            self.clear()
+            self.names = [f"{self.prefix}_{i}" for i in range(len(rules))]
+        # Tags created later draw on top, so configure the highest priority rule last
+        for name, rule in reversed(list(zip(self.names, rules))):
+            self.widget.tag_configure(name, **get_styles(rule))
+
+    def clear(self):
+        if self.names:
+            self.widget.tag_delete(*self.names)
+        self.names = []
+
+    def remove(self, start, end):
+        for name in self.names:
+            self.widget.tag_remove(name, start, end)
+
+    def paint(self, matches, to_index):
+        """Add (rule_index, start, end) matches, `to_index` turning offsets into Text indices, one call per tag"""
+        ranges = {}
+        for rule_index, start, end in matches:
+            ranges.setdefault(rule_index, []).extend((to_index(start), to_index(end)))
+        for rule_index, indices in ranges.items():
+            self.widget.tag_add(self.names[rule_index], *indices)
+
+    def live_count(self):
+        """Number of tags that currently exist in the widget"""
+        return len(self.widget.tag_names())
+
+
+class LineNumberGutter(gvim_core.LineNumbers):
+    """Line number bar drawing what LineNumbers works out into a Text widget"""
+
+    def __init__(self, widget, virtual=False):
+        gvim_core.LineNumbers.__init__(self, virtual)
+        self.widget = widget
+        self.widget.tag_configure("center", justify="center")
+
+    def set_virtual(self, virtual):
+        if gvim_core.LineNumbers.set_virtual(self, virtual):
+            self.replace("")
+
+    def reset(self, line_count, offset=0):
+        gvim_core.LineNumbers.reset(self, line_count, offset)
+        self.replace("")
+
+    def draw_delta(self):
+        change = self.delta()
+        if change is None:
+            return
+        self.widget.config(state=tk.NORMAL)
+        if change[0] == "append":
+            self.widget.insert("end-1c", change[1], "center")
+        else:
+            self.widget.delete(f"{change[1]}.end", "end-1c")
+        self.widget.config(state=tk.DISABLED)
+        self.fit_width()
+
+    def draw_window(self, top, bottom):
+        """Draw the numbers for the 1-based lines top..bottom"""
+        numbers = self.window_text(top, bottom)
+        if numbers is None:
+            return
+        self.replace(numbers)
+        self.fit_width()
+
+    def replace(self, numbers):
+        self.widget.config(state=tk.NORMAL)
+        self.widget.delete("1.0", "end")
+        self.widget.insert("1.0", numbers, "center")
+        self.widget.config(state=tk.DISABLED)
+
+    def fit_width(self):
+        width = self.width()
+        if int(self.widget.cget("width")) != width:
+            self.widget.config(width=width)
+
+
+class RedrawScheduler:
+    """Collects redraw work marked by events and flushes it at most once per frame.
+
+    `handlers` is a list of (kind, callable) pairs run in that order when the
+    matching kind has been marked dirty since the last flush.
+    """
+
+    def __init__(self, root, handlers, fps=60):
+        self.root = root
+        self.handlers = handlers
+        self.fps = fps
+        self.dirty = set()
+        self.job = None
+        self.last_flush = 0.0
+
+    def mark(self, *kinds):
+        self.dirty.update(kinds)
+        if self.job is not None:
+            return
+        wait = self.last_flush + 1 / self.fps - time.perf_counter()
+        if wait > 0:
+            self.job = self.root.after(int(wait * 1000) + 1, self.flush_when_idle)
+        else:
+            self.job = self.root.after_idle(self.flush)
+
+    def flush_when_idle(self):
+        self.job = self.root.after_idle(self.flush)
+
+    def flush(self):
+        self.job = None
+        self.last_flush = time.perf_counter()
+        dirty, self.dirty = self.dirty, set()
+        for kind, handler in self.handlers:
+            if kind in dirty:
+                handler()
+
+
+def buffer_attribute(name):
+    """A TextEditor attribute that belongs to the buffer on screen"""
+    return property(lambda self: getattr(self.buffer, name), lambda self, value: setattr(self.buffer, name, value))
+
 
 class TextEditor:
+    # Per-file state lives on the Buffer being edited, see gvim_core.Buffer
+    file_path = buffer_attribute("file_path")
+    document = buffer_attribute("document")
+    window_first = buffer_attribute("window_first")
+    window_lines = buffer_attribute("window_lines")
+    window_trailing_newline = buffer_attribute("window_trailing_newline")
+    window_dirty = buffer_attribute("window_dirty")
+    syntax_rules = buffer_attribute("syntax_rules")
+    highlighter = buffer_attribute("highlighter")
+    line_index = buffer_attribute("line_index")
+    journal = buffer_attribute("journal")
+    text_area = buffer_attribute("text_area")
+    text_area_command = buffer_attribute("text_area_command")
+    tag_pool = buffer_attribute("tag_pool")
+
+    # Opening the picker walks the workspace again once the last walk is this old
+    WORKSPACE_WALK_SECONDS = 60
+
     def __init__(self, root):
         self.root = root
         self.root.geometry("900x600")
@@ -201,21 +369,106 @@ class TextEditor:
             "tab_size": 4,
             "line_number_font_size": 11,
             "line_number_bold": False,
-            "line_number_italic": False
+            "line_number_italic": False,
+            "virtual_line_numbers": False,
+            "viewport_highlighting": True,
+            "highlight_chunk_ms": 8,
+            "background_tokenizer": True,
+            "redraw_fps": 60,
+            "large_file_threshold_mb": 50,
+            "undo_memory_kb": 1024,
+            "search_match_color": "#613214",
+            "buffer_memory_mb": 64,
+            "rule_budget_ms": 50,
+            "file_watch_ms": 1000
         }
 
-        self.schemes = {"default": self.default_scheme}
-        self.syntax_rules = []
+        self.themes = ThemeRegistry("themes", {"default": self.default_scheme})
+        self.extension_index = ExtensionIndex()
+        self.grammar_cache = GrammarCache()
+        # Times syntax rules and demotes or disables the ones that take too long
+        self.rule_profiler = RuleProfiler(self.default_scheme["rule_budget_ms"])
+        self.rule_report = None
+        self.highlight_margin = 50
+        self.highlight_chunk_lines = 200
+        self.background_highlight_job = None
+        # Tokenizes off the UI thread while the scheme's background_tokenizer is on
+        self.tokenizer = None
+        self.token_poll_job = None
+
+        # Lines of a large file held in the text area at a time
+        self.window_size = 5000
+        self.loading_window = False
+
+        self.saver = SaveWorker()
+        self.saving_buffer = None
+        self.saving_path = None
+        self.saved_generation = None
+        # Buffers whose save was asked for while another save was running
+        self.save_again = []
+        self.saving_sequence = 0
+
+        # Open files are polled for changes made outside the editor, which are reloaded as diffs
+        self.watcher = FileWatcher()
+        self.reloading = False
+
+        # Files and symbols under the directory of the file opened, for quick open and goto symbol;
+        # refreshes run one at a time on a thread, the queue holds lists of saved paths or None for all
+        self.workspace = None
+        self.workspace_thread = None
+        self.workspace_queue = []
+        self.workspace_walked = 0.0
+        self.picker = None
+
+        # Edits replayed by undo/redo are logged in the journal but not undoable
+        self.replaying = False
+        self.journal_flush_job = None
+
+        # Find/replace: matches are (line, column, end_line, end_column) in document lines, sorted
+        self.searcher = SearchWorker()
+        self.search_pattern = None
+        self.search_literal = True
+        self.search_matches = []
+        self.search_fresh = False
+        self.search_jump = False
+        self.search_job = None
+        self.search_poll_job = None
+        # A replace all waiting for its reply, called off when the reply is dropped
+        self.replacing = False
+        self.find_bar = None
 
         self.current_scheme = self.default_scheme.copy()
 
-        self.root.config(bg=self.shift_color(self.current_scheme["background_color"], 7))
+        # Open files; only the most recently used keep a text widget within buffer_memory_mb
+        self.buffers = BufferList(self.current_scheme["buffer_memory_mb"] << 20)
+        self.buffer = self.new_buffer()
+        # Keys bound on every buffer's text area, as (key, callback, add)
+        self.text_bindings = []
+
+        self.palette = ThemeRegistry.palette(self.current_scheme["background_color"])
+        self.root.config(bg=self.palette["window_background"])
         self.text_font = (self.current_scheme["font_face"], self.current_scheme["font_size"])
 
+        self.events = EventBus(lambda: self.redraw.mark("events"))
+        self.last_cursor = None
+        self.last_view = None
+        # Performance overlay and the start of the keystroke being timed
+        self.hud = None
+        self.hud_job = None
+        self.key_started = None
         self.plugin_manager = PluginManager(self)
         
         self.create_menu_bar()
 
+        self.tab_bar = tk.Frame(self.root, bg=self.current_scheme["line_bar_color"])
+        self.tab_bar.pack(side="top", fill="x")
+
+        # Status bar for non-modal messages such as save progress
+        self.status_bar = tk.Label(self.root, anchor="w", padx=10, font=("Helvetica", 9),
+                                   bg=self.current_scheme["line_bar_color"],
+                                   fg=self.current_scheme["foreground_color"])
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
         # Frame to contain both the text area and the line numbers
         self.main_frame = tk.Frame(self.root, bg=self.current_scheme["background_color"])
         self.main_frame.pack(fill=tk.BOTH, expand=True)
@@ -223,11 +476,17 @@ class TextEditor:
         # Line number bar
         self.line_number_bar = self.create_text_widget(self.main_frame, 2, "#3E3E3E", "#5A5A5A")
         self.line_number_bar.pack(side=tk.LEFT, fill=tk.Y)
+        self.gutter = LineNumberGutter(self.line_number_bar)
 
         # Text area
-        self.text_area = self.create_text_widget(self.main_frame, None, self.current_scheme["background_color"], 
-                                                 self.current_scheme["foreground_color"], is_editable=True, py=20)
+        self.create_buffer_widget(self.buffer)
         self.text_area.pack(expand='yes', fill='both')
+        self.redraw = RedrawScheduler(self.root, [("gutter", self.update_line_numbers),
+                                                  ("highlight", self.apply_syntax_highlighting),
+                                                  ("scroll", self.sync_scroll),
+                                                  ("search", self.paint_search_matches),
+                                                  ("events", self.flush_events),
+                                                  ("keystroke", self.measure_keystroke)])
 
         self.save_schemes_in_themes()
         if os.path.exists("themes/.schemelog"):
@@ -235,22 +494,15 @@ class TextEditor:
         else:
             self.load_default_color_scheme()
 
-        # Bindings for updating line numbers and syntax highlighting
-        for event in ('<KeyRelease>', '<KeyPress>', '<MouseWheel>', '<Configure>'):
-            self.text_area.bind(event, self.update_line_numbers_on_change)
-        
-        # Bindings for syntax highlighting
-        self.text_area.bind("<KeyRelease>", self.apply_syntax_highlighting)
-
         #binding to move the window
+        self.root.report_callback_exception = self.report_callback_exception
         self.root.bind("<Button-1>", self.start_move)
         self.root.bind("<B1-Motion>", self.do_move)
 
-        self.file_path = None
-
         # Initialize and load plugins
         self.plugin_manager.load_plugins()
         self.plugin_manager.execute_plugins()
+        self.root.after(self.current_scheme["file_watch_ms"] or 1000, self.poll_disk)
 
         # Menu bar
 
@@ -273,29 +525,653 @@ class TextEditor:
             scheme = f.read()
             self.load_color_scheme(scheme)
 
+    @PROFILER.timed("gutter")
     def update_line_numbers(self):
-        line_count = self.text_area.get('1.0', 'end').count('\n')
-        self.line_number_bar.config(state=tk.NORMAL)
-        self.line_number_bar.delete('1.0', tk.END)
-        for i in range(1, line_count + 2):
-            self.line_number_bar.insert(tk.END, f'{i}\n')
-        
-        # Add tag to center text
-        self.line_number_bar.tag_configure("center", justify='center')
-        self.line_number_bar.tag_add("center", 1.0, tk.END)
-        
-        self.line_number_bar.config(state=tk.DISABLED)
+        if self.gutter.virtual:
+            top = int(self.text_area.index("@0,0").split(".")[0])
+            bottom = int(self.text_area.index(f"@0,{self.text_area.winfo_height()}").split(".")[0])
+            self.gutter.draw_window(top, bottom)
+        else:
+            self.gutter.draw_delta()
 
     def create_text_widget(self, parent, width, bg, fg, is_editable=False, px=5, py=20):
         state = tk.NORMAL if is_editable else tk.DISABLED
         return tk.Text(parent, width=width, padx=px, pady=py, takefocus=0, border=0, 
-                   background=bg, foreground=fg, wrap=tk.NONE, undo=True, autoseparators=True,
+                   background=bg, foreground=fg, wrap=tk.NONE, undo=False,
                    font=("Helvetica", 11), relief="flat", state=state)
 
+    def install_edit_hook(self, buffer):
+        """Route the buffer's text widget's Tcl command through us so every edit is seen"""
+        widget = buffer.text_area
+        buffer.text_area_command = widget._w + "_orig"
+        widget.tk.call("rename", widget._w, buffer.text_area_command)
+        # One dispatcher per widget, so a command sent to a buffer in the background stays with that buffer
+        widget.tk.createcommand(widget._w, lambda *args: self.dispatch_text_command(buffer, *args))
+
+    def destroy_buffer_widget(self, buffer):
+        widget = buffer.text_area
+        widget.destroy()
+        widget.tk.deletecommand(widget._w)
+        buffer.text_area = buffer.text_area_command = buffer.tag_pool = None
+
+    def new_buffer(self):
+        buffer = Buffer(self.current_scheme["undo_memory_kb"] * 1024)
+        buffer.journal.start()
+        self.buffers.add(buffer)
+        return buffer
+
+    def create_buffer_widget(self, buffer):
+        """Give `buffer` a text area holding the text it kept, styled and bound like the others"""
+        text_area = self.create_text_widget(self.main_frame, None, self.current_scheme["background_color"],
+                                            self.current_scheme["foreground_color"], is_editable=True, py=20)
+        # Filled before the edit hook goes in: the buffer's model already knows this text
+        text_area.insert("1.0", buffer.text)
+        buffer.text = ""
+        buffer.text_area = text_area
+        self.install_edit_hook(buffer)
+        text_area.bind("<<Undo>>", self.undo)
+        text_area.bind("<<Redo>>", self.redo)
+        text_area.bind("<Control-f>", self.show_find_bar)
+        text_area.bind("<Control-w>", self.close_buffer)
+        text_area.bind("<Control-p>", self.show_picker)
+        text_area.bind("<Control-t>", lambda e: self.show_picker(prefix="@"))
+        text_area.bind("<Control-Tab>", lambda e: self.activate(self.buffers.next(self.buffer)) or "break")
+        # Bindings for updating line numbers and syntax highlighting, edits mark their own work
+        for event in ('<KeyRelease>', '<KeyPress>', '<MouseWheel>', '<Configure>'):
+            text_area.bind(event, self.update_line_numbers_on_change)
+        for key, callback, add in self.text_bindings:
+            text_area.bind(key, callback, add=add)
+        buffer.tag_pool = TagPool(text_area)
+        # Only the matches on screen carry this tag, so it never holds more than a screenful of ranges
+        text_area.tag_configure("search", background=self.current_scheme["search_match_color"])
+        text_area.tag_lower("search", tk.SEL)
+        self.style_buffer_widget(buffer)
+        text_area.mark_set(tk.INSERT, buffer.cursor)
+        text_area.yview_moveto(buffer.view)
+        # Paint back the syntax tags the old widget had; lines still pending stay pending
+        for name, ranges in buffer.tag_ranges.items():
+            if ranges and name in buffer.tag_pool.names:
+                text_area.tag_add(name, *ranges)
+        buffer.tag_ranges = {}
+
+    def release_buffer_widget(self, buffer):
+        """Drop an inactive buffer's widget, keeping its text to rebuild it from"""
+        buffer.text = buffer.text_area.get("1.0", "end-1c")
+        buffer.tag_ranges = {name: [str(index) for index in buffer.text_area.tag_ranges(name)]
+                             for name in buffer.tag_pool.names}
+        self.destroy_buffer_widget(buffer)
+
+    def bind_text(self, key, callback, add=None):
+        """Bind a key on the text area of every buffer, now and to come"""
+        self.text_bindings.append((key, callback, add))
+        for buffer in self.buffers.buffers:
+            if buffer.text_area is not None:
+                buffer.text_area.bind(key, callback, add=add)
+
+    def activate(self, buffer):
+        """Show `buffer` in place of the current one"""
+        if buffer is self.buffer:
+            return
+        self.sync_window()
+        self.buffer.cursor = self.text_area.index(tk.INSERT)
+        self.buffer.view = self.text_area.yview()[0]
+        self.text_area.pack_forget()
+        self.show_buffer(buffer)
+        # It may have changed on disk while in the background
+        self.root.after_idle(self.check_disk)
+
+    def show_buffer(self, buffer):
+        self.buffer = buffer
+        self.buffers.touch(buffer)
+        if buffer.text_area is None:
+            self.create_buffer_widget(buffer)
+        self.text_area.pack(expand='yes', fill='both')
+        self.text_area.focus_set()
+        for other in self.buffers.evictions():
+            self.release_buffer_widget(other)
+        self.gutter.set_virtual(self.current_scheme["virtual_line_numbers"] or self.document is not None)
+        self.gutter.reset(self.line_count(), self.window_first)
+        if self.tokenizer is not None:
+            self.switch_tokenizer(buffer)
+        self.update_title()
+        self.refresh_tabs()
+        self.search_matches = []
+        self.search_stale()
+        self.redraw.mark("gutter", "highlight", "scroll", "search", "events")
+        self.events.publish("switch", path=self.file_path)
+
+    def close_buffer(self, buffer=None):
+        """Close a buffer, the one on screen by default, once its unsaved edits are saved or discarded"""
+        buffer = buffer if isinstance(buffer, Buffer) else self.buffer
+        if buffer is self.saving_buffer and self.saver.busy():
+            # The save may still be reading from the buffer's document
+            self.set_status(f"Still saving {os.path.basename(buffer.file_path)}")
+            return "break"
+        discarded = self.settle_unsaved([buffer], "Close")
+        if discarded is None:
+            return "break"
+        if buffer in self.save_again:
+            self.save_again.remove(buffer)
+        if buffer is self.buffer:
+            self.close_document()
+        elif buffer.document is not None:
+            buffer.document.close()
+            buffer.document = None
+        # Edits neither saved nor discarded keep their swap file for recovery
+        buffer.journal.close(remove=buffer in discarded or not buffer.journal.modified())
+        self.watcher.forget(buffer.file_path)
+        if self.tokenizer is not None:
+            self.tokenizer.forget(buffer)
+        buffer.closed = True
+        if buffer.text_area is not None:
+            self.destroy_buffer_widget(buffer)
+        following = self.buffers.remove(buffer)
+        if buffer is self.buffer:
+            self.show_buffer(following or self.new_buffer())
+        else:
+            self.refresh_tabs()
+        return "break"
+
+    def settle_unsaved(self, buffers, title):
+        """Ask to save or discard the unsaved edits of `buffers`; the discarded ones, or None to cancel"""
+        modified = [buffer for buffer in buffers if buffer.journal.modified()]
+        if not modified:
+            return set()
+        names = "\n".join(os.path.basename(buffer.file_path) if buffer.file_path else "Untitled"
+                          for buffer in modified)
+        answer = messagebox.askyesnocancel(title, f"Save your changes to these files?\n\n{names}")
+        if answer is None:
+            return None
+        if not answer:
+            return set(modified)
+        for buffer in modified:
+            self.save_file(buffer)
+        self.finish_saves()
+        unsaved = [buffer for buffer in modified if buffer.journal.modified()]
+        if unsaved:
+            # A failed save, or a Save As dialog closed without a name
+            self.set_status(f"{len(unsaved)} file(s) not saved")
+            return None
+        return set()
+
+    def open_buffer(self):
+        """Make a buffer to load a file into, reusing the current one when it is blank"""
+        if not self.buffer.is_blank():
+            self.activate(self.new_buffer())
+
+    def refresh_tabs(self):
+        for child in self.tab_bar.winfo_children():
+            child.destroy()
+        for buffer in self.buffers.buffers:
+            active = buffer is self.buffer
+            bg = self.current_scheme["background_color" if active else "line_bar_color"]
+            name = os.path.basename(buffer.file_path) if buffer.file_path else "Untitled"
+            tab = tk.Label(self.tab_bar, text=name, padx=10, pady=3, bg=bg, fg=self.current_scheme["foreground_color"])
+            tab.pack(side=tk.LEFT)
+            tab.bind("<Button-1>", lambda e, b=buffer: self.activate(b))
+            tab.bind("<Button-2>", lambda e, b=buffer: self.close_buffer(b))
+            close = tk.Label(self.tab_bar, text="x", padx=4, bg=bg, fg=self.current_scheme["line_number_color"])
+            close.pack(side=tk.LEFT)
+            close.bind("<Button-1>", lambda e, b=buffer: self.close_buffer(b))
+
+    def dispatch_text_command(self, buffer, *args):
+        command = buffer.text_area_command
+        call = buffer.text_area.tk.call
+        if not args or args[0] not in ("insert", "delete", "replace"):
+            return call((command,) + args)
+
+        operation = args[0]
+        if operation == "delete" and len(args) > 3:
+            # Several ranges: delete them one by one from the back so the others stay put
+            ranges = [(self.clamp_index(args[i], buffer),
+                       self.clamp_index(args[i + 1], buffer) if i + 1 < len(args) else None)
+                      for i in range(1, len(args), 2)]
+            for start, end in sorted(ranges, key=lambda r: tuple(map(int, r[0].split("."))), reverse=True):
+                self.dispatch_text_command(buffer, "delete", start, *([end] if end else []))
+            return ""
+
+        start = self.clamp_index(args[1], buffer)
+        removed_text = inserted_text = ""
+        if operation == "insert":
+            inserted_text = "".join(args[2::2])
+        else:
+            end = self.clamp_index(args[2] if len(args) > 2 else f"{start} + 1 chars", buffer)
+            removed_text = call(command, "get", start, end)
+            if operation == "replace":
+                inserted_text = "".join(args[3::2])
+        line = int(start.split(".")[0])
+        lines_before = int(str(call(command, "index", "end-1c")).split(".")[0])
+        result = call((command,) + args)
+        lines_after = int(str(call(command, "index", "end-1c")).split(".")[0])
+        if (removed_text or inserted_text) and not self.loading_window:
+            column = start.split(".")[1]
+            buffer.journal.record(f"{line + buffer.window_first}.{column}", removed_text, inserted_text,
+                                  history=not self.replaying)
+            if self.journal_flush_job is None:
+                self.journal_flush_job = self.root.after(int(UndoJournal.FLUSH_SECONDS * 1000),
+                                                         self.flush_journals_when_idle)
+
+        if operation == "insert":
+            added = sum(chars.count("\n") for chars in args[2::2])
+        elif operation == "replace":
+            added = sum(chars.count("\n") for chars in args[3::2])
+        else:
+            added = 0
+        removed = added - (lines_after - lines_before)
+        self.on_text_edit(min(line, lines_before) - 1, removed, added, buffer)
+        return result
+
+    def flush_journals_when_idle(self):
+        self.journal_flush_job = self.root.after_idle(self.flush_journals)
+
+    def flush_journals(self):
+        """Write the edits of the last second to the swap files, batched rather than one per key"""
+        self.journal_flush_job = None
+        for buffer in self.buffers.buffers:
+            buffer.journal.flush()
+
+    def clamp_index(self, index, buffer=None):
+        """Resolve a Text index to "line.column", stopping before the line break Tk keeps at the end"""
+        buffer = buffer or self.buffer
+        command = buffer.text_area_command
+        call = buffer.text_area.tk.call
+        index = str(call(command, "index", index))
+        if buffer.text_area.tk.getboolean(call(command, "compare", index, ">", "end-1c")):
+            index = str(call(command, "index", "end-1c"))
+        return index
+
+    def undo(self, event=None):
+        group = self.journal.take_undo()
+        if group:
+            self.replay([(index, inserted, removed) for index, removed, inserted in reversed(group)])
+        return "break"
+
+    def redo(self, event=None):
+        group = self.journal.take_redo()
+        if group:
+            self.replay(group)
+        return "break"
+
+    def replay(self, deltas, history=False):
+        """Apply (index, removed, inserted) deltas, indices in document lines, and put the cursor after the last"""
+        self.replaying = not history
+        try:
+            for index, removed, inserted in deltas:
+                self.text_area.replace(*self.window_range(index, UndoJournal.advance(index, removed)), inserted)
+                cursor = UndoJournal.advance(index, inserted)
+        finally:
+            self.replaying = False
+        self.text_area.mark_set(tk.INSERT, self.window_index(cursor))
+        self.text_area.see(tk.INSERT)
+
+    def window_index(self, index):
+        """Text area index of a "line.column" in document lines, sliding the window there if needed"""
+        return self.window_range(index, index)[0]
+
+    def window_range(self, start, end):
+        """Text area indices of the "line.column" positions `start` and `end` in document lines.
+
+        Both are resolved against one window, slid to hold the whole range if
+        it does not already: sliding between the two would leave `start`
+        pointing into the old window.
+        """
+        (first, start_column), (last, end_column) = start.split("."), end.split(".")
+        first, last = int(first), int(last)
+        # The text area holds the document lines after window_first, edits included
+        if self.document is not None and not self.window_first < first <= last <= self.window_first + self.line_count():
+            self.sync_window()
+            self.load_window(first - 1 - max(0, self.window_size - (last - first + 1)) // 2)
+        return f"{first - self.window_first}.{start_column}", f"{last - self.window_first}.{end_column}"
+
+    def show_find_bar(self, event=None):
+        if self.find_bar is None:
+            self.create_find_bar()
+        try:
+            selected = self.text_area.get(tk.SEL_FIRST, tk.SEL_LAST)
+        except tk.TclError:
+            selected = ""
+        if selected and "\n" not in selected:
+            self.find_entry.delete(0, tk.END)
+            self.find_entry.insert(0, selected)
+            self.search_from_find_bar()
+        self.find_entry.focus_set()
+        self.find_entry.select_range(0, tk.END)
+        return "break"
+
+    def create_find_bar(self):
+        bg, fg = self.current_scheme["line_bar_color"], self.current_scheme["foreground_color"]
+        self.find_bar = tk.Frame(self.root, bg=bg, padx=10, pady=4)
+        self.find_bar.pack(side=tk.BOTTOM, fill=tk.X, before=self.main_frame)
+        entry_style = {"bg": self.palette["field_background"], "fg": fg, "insertbackground": fg,
+                       "relief": "flat", "width": 24}
+        self.find_entry = tk.Entry(self.find_bar, **entry_style)
+        self.find_entry.pack(side=tk.LEFT, padx=(0, 5))
+        self.replace_entry = tk.Entry(self.find_bar, **entry_style)
+        self.replace_entry.pack(side=tk.LEFT, padx=5)
+        self.find_options = {}
+        for name, label, default in (("regex", ".*", False), ("case", "Aa", True), ("word", "W", False)):
+            variable = tk.BooleanVar(value=default)
+            tk.Checkbutton(self.find_bar, text=label, variable=variable, command=self.search_from_find_bar,
+                           bg=bg, fg=fg, selectcolor=bg, activebackground=bg, relief="flat").pack(side=tk.LEFT)
+            self.find_options[name] = variable
+        for label, command in (("X", self.close_find_bar), ("All", self.replace_all_from_find_bar),
+                               ("Replace", self.replace_from_find_bar),
+                               ("Next", self.find_next), ("Prev", lambda: self.find_next(backwards=True))):
+            tk.Button(self.find_bar, text=label, command=command, bg=bg, fg=fg, bd=0,
+                      relief="flat").pack(side=tk.RIGHT, padx=3)
+        self.find_entry.bind("<KeyRelease>", self.on_find_key)
+        self.find_entry.bind("<Return>", lambda e: self.find_next())
+        self.find_entry.bind("<Shift-Return>", lambda e: self.find_next(backwards=True))
+        self.replace_entry.bind("<Return>", lambda e: self.replace_from_find_bar())
+        for entry in (self.find_entry, self.replace_entry):
+            entry.bind("<Escape>", lambda e: self.close_find_bar())
+
+    def on_find_key(self, event):
+        if event.keysym not in ("Return", "Escape", "Shift_L", "Shift_R"):
+            self.schedule_search(self.search_from_find_bar)
+
+    def search_from_find_bar(self):
+        options = {name: variable.get() for name, variable in self.find_options.items()}
+        self.start_search(self.find_entry.get(), **options)
+
+    def replace_from_find_bar(self):
+        self.replace_current(self.replace_entry.get())
+
+    def replace_all_from_find_bar(self):
+        self.replace_all(self.replace_entry.get())
+
+    def close_find_bar(self):
+        if self.find_bar is not None:
+            self.find_bar.destroy()
+            self.find_bar = None
+        self.start_search("")
+        self.text_area.focus_set()
+
+    def start_search(self, pattern, regex=False, case=True, word=False, jump=True):
+        """Search for a new query, selecting the first match after the cursor with `jump`; False for a bad one"""
+        self.cancel_search_job()
+        self.cancel_searcher()
+        self.search_matches = []
+        self.search_pattern = None
+        self.redraw.mark("search")
+        if not pattern:
+            return False
+        try:
+            self.search_pattern = SearchWorker.compile(pattern, regex, case, word)
+        except re.error as e:
+            self.set_status(f"Bad pattern: {e}")
+            return False
+        self.search_literal = not regex
+        self.run_search(jump)
+        return True
+
+    def schedule_search(self, callback, delay_ms=150):
+        self.cancel_search_job()
+        self.search_job = self.root.after(delay_ms, callback)
+
+    def cancel_search_job(self):
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+            self.search_job = None
+
+    def search_stale(self):
+        """The text changed under the matches: drop any reply on its way and search again shortly"""
+        if self.search_pattern is not None:
+            self.cancel_searcher()
+            self.schedule_search(self.run_search)
+
+    def cancel_searcher(self):
+        """Drop any reply on its way, telling the user when that was a replace all's"""
+        self.searcher.cancel()
+        if self.replacing:
+            self.replacing = False
+            self.set_status("Replace all cancelled")
+
+    def run_search(self, jump=False):
+        self.cancel_search_job()
+        if self.search_pattern is None:
+            return
+        # The old matches stay up until the first batch of new ones replaces them
+        self.search_fresh = True
+        self.search_jump = jump
+        self.replacing = False
+        self.searcher.search(self.get_text(), self.search_pattern)
+        self.set_status("Searching...")
+        self.schedule_search_poll()
+
+    def schedule_search_poll(self):
+        if self.search_poll_job is None:
+            self.search_poll_job = self.root.after(10, self.poll_search)
+
+    def poll_search(self):
+        self.search_poll_job = None
+        while True:
+            try:
+                message = self.searcher.results.get_nowait()
+            except queue.Empty:
+                break
+            kind, generation = message[:2]
+            if generation != self.searcher.generation:
+                continue
+            if kind == "matches":
+                self.add_search_matches(message[2])
+            elif kind == "done":
+                self.finish_search(message[2])
+            elif kind == "replaced":
+                self.replacing = False
+                self.apply_replacements(*message[2:])
+            else:
+                self.replacing = False
+                self.set_status(f"Replace failed: {message[2]}")
+        if self.searcher.busy():
+            self.schedule_search_poll()
+
+    def add_search_matches(self, batch):
+        if self.search_fresh:
+            self.search_fresh = False
+            self.search_matches = []
+        self.search_matches.extend(batch)
+        if self.search_jump and batch[-1][:2] >= self.cursor_position():
+            self.search_jump = False
+            self.find_next()
+        self.redraw.mark("search")
+
+    def finish_search(self, count):
+        if self.search_fresh:
+            self.search_fresh = False
+            self.search_matches = []
+        if self.search_jump:
+            self.search_jump = False
+            self.find_next()
+        self.set_status(f"{count} matches")
+        self.redraw.mark("search")
+        self.events.publish("search", count=count)
+
+    def cursor_position(self):
+        """(line, column) of the cursor in document lines"""
+        line, column = map(int, self.text_area.index(tk.INSERT).split("."))
+        return line + self.window_first, column
+
+    def find_next(self, backwards=False):
+        """Select the match after the cursor, or before the selection, wrapping around"""
+        if not self.search_matches:
+            return "break"
+        if backwards:
+            try:
+                line, column = map(int, self.text_area.index(tk.SEL_FIRST).split("."))
+                start = (line + self.window_first, column)
+            except tk.TclError:
+                start = self.cursor_position()
+            match = self.search_matches[bisect_left(self.search_matches, start) - 1]
+        else:
+            position = bisect_left(self.search_matches, self.cursor_position())
+            match = self.search_matches[position % len(self.search_matches)]
+        self.select_match(match)
+        return "break"
+
+    def select_match(self, match):
+        line, column, end_line, end_column = match
+        start, end = self.window_range(f"{line}.{column}", f"{end_line}.{end_column}")
+        self.text_area.tag_remove(tk.SEL, "1.0", tk.END)
+        self.text_area.tag_add(tk.SEL, start, end)
+        self.text_area.mark_set(tk.INSERT, end)
+        self.text_area.see(start)
+        self.redraw.mark("highlight", "scroll", "search", "events")
+
+    def replace_current(self, replacement):
+        """Replace the selected match and go on to the next one once the buffer is searched again"""
+        if self.search_pattern is None:
+            return
+        try:
+            match = self.search_pattern.fullmatch(self.text_area.get(tk.SEL_FIRST, tk.SEL_LAST))
+        except tk.TclError:
+            match = None
+        if match is None:
+            self.find_next()
+            return
+        try:
+            self.text_area.replace(tk.SEL_FIRST, tk.SEL_LAST, self.expand(match, replacement))
+        except re.error as e:
+            self.set_status(f"Replace failed: {e}")
+            return
+        self.run_search(jump=True)
+
+    def expand(self, match, replacement):
+        return replacement if self.search_literal else match.expand(replacement)
+
+    def replace_all(self, replacement):
+        """Have the worker rewrite the lines with matches; they come back as one undo step"""
+        if self.search_pattern is None:
+            return
+        template = replacement.replace("\\", "\\\\") if self.search_literal else replacement
+        # In a large file each run has to fit in the window around it
+        max_run_lines = self.window_size // 2 if self.document is not None else None
+        self.searcher.replace(self.get_text(), self.search_pattern, template, max_run_lines)
+        self.replacing = True
+        self.set_status("Replacing...")
+        self.schedule_search_poll()
+
+    def apply_replacements(self, runs, count):
+        # From the last run back, so the line numbers of the others stay put
+        self.journal.begin_group()
+        try:
+            for first, last, text in reversed(runs):
+                self.text_area.replace(*self.window_range(f"{first + 1}.0", f"{last + 1}.end"), text)
+        finally:
+            self.journal.end_group()
+        self.set_status(f"Replaced {count} matches")
+        self.redraw.mark("search")
+
+    def paint_search_matches(self):
+        self.text_area.tag_remove("search", "1.0", tk.END)
+        if not self.search_matches:
+            return
+        top = int(self.text_area.index("@0,0").split(".")[0])
+        bottom = int(self.text_area.index(f"@0,{self.text_area.winfo_height()}").split(".")[0])
+        first = bisect_left(self.search_matches, (top + self.window_first,))
+        last = bisect_right(self.search_matches, (bottom + self.window_first + 1,))
+        indices = []
+        for line, column, end_line, end_column in self.search_matches[first:last]:
+            indices += (f"{line - self.window_first}.{column}", f"{end_line - self.window_first}.{end_column}")
+        if indices:
+            self.text_area.tag_add("search", *indices)
+
+    def on_text_edit(self, line, removed, added, buffer=None):
+        if buffer is not None and buffer is not self.buffer:
+            # Edited in the background: keep its model in step, the screen shows another buffer
+            buffer.window_dirty = True
+            buffer.highlighter.on_edit(line, removed, added)
+            buffer.line_index.on_edit(line, removed, added,
+                                      buffer.text_area.get(f"{line + 1}.0", f"{line + added + 2}.0"))
+            if self.tokenizer is not None:
+                # Its copy in the tokenizer missed the edit, it gets the text again when switched to
+                self.tokenizer.forget(buffer)
+            return
+        if not self.loading_window:
+            self.window_dirty = True
+        self.gutter.on_edit(removed, added)
+        self.highlighter.on_edit(line, removed, added)
+        text = self.get_lines(line, line + added)
+        self.line_index.on_edit(line, removed, added, text)
+        if self.tokenizer is not None:
+            self.tokenizer.edit(line, removed, added, text)
+        if not self.loading_window:
+            self.search_stale()
+        if self.events.wants("edit"):
+            self.events.publish("edit", line=line + self.window_first + 1, removed=removed, added=added)
+        self.redraw.mark("gutter", "highlight")
+
+    def line_count(self):
+        return int(self.text_area.index("end-1c").split(".")[0])
+
+    def get_lines(self, first, last):
+        return self.text_area.get(f"{first + 1}.0", f"{last + 2}.0")
+
     def update_line_numbers_on_change(self, event=None):
-        self.update_line_numbers()
-        self.apply_syntax_highlighting()
-        self.line_number_bar.yview_moveto(self.text_area.yview()[0])
+        # The view may have moved, which can bring unhighlighted lines on screen
+        self.redraw.mark("highlight", "scroll", "search", "events")
+        if PROFILER.enabled and event is not None and event.type == tk.EventType.KeyPress and self.key_started is None:
+            self.key_started = time.perf_counter()
+            self.redraw.mark("keystroke")
+
+    def measure_keystroke(self):
+        # Runs last in the frame; the text widget repaints in the idle pass before the next idle callback
+        def record():
+            if self.key_started is not None:
+                PROFILER.record("keystroke", time.perf_counter() - self.key_started)
+                self.key_started = None
+        self.root.after_idle(record)
+
+    def toggle_hud(self):
+        if self.hud is not None:
+            self.root.after_cancel(self.hud_job)
+            self.hud_job = None
+            self.hud.destroy()
+            self.hud = None
+            PROFILER.enabled = os.environ.get("GVIM_PROFILE") == "1"
+            return
+        PROFILER.enabled = True
+        self.hud = tk.Label(self.main_frame, justify="left", anchor="ne", font=("Consolas", 9),
+                            bg=self.current_scheme["line_bar_color"], fg=self.current_scheme["foreground_color"])
+        self.hud.place(relx=1.0, rely=0.0, anchor="ne", x=-20)
+        self.update_hud()
+
+    def update_hud(self):
+        if self.hud is None:
+            return
+        lines = ["metric          p50 / p95 / p99 ms"]
+        for name, metric in sorted(PROFILER.summary().items()):
+            lines.append(f"{name[:15]:<15} {metric['p50']:.1f} / {metric['p95']:.1f} / {metric['p99']:.1f}")
+        lines.append(f"live tags       {self.plugin_manager.api.get_live_tag_count()}")
+        self.hud.config(text="\n".join(lines))
+        self.hud_job = self.root.after(500, self.update_hud)
+
+    def dump_profile(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON Files", "*.json")])
+        if path:
+            PROFILER.dump(path)
+
+    def flush_events(self):
+        """Publish cursor and scroll changes seen this frame, then deliver all batches"""
+        if self.events.wants("cursor"):
+            cursor = self.text_area.index(tk.INSERT)
+            if cursor != self.last_cursor:
+                self.last_cursor = cursor
+                self.events.publish("cursor", position=cursor)
+        if self.events.wants("scroll"):
+            view = self.text_area.yview()
+            if view != self.last_view:
+                self.last_view = view
+                self.events.publish("scroll", top=view[0], bottom=view[1])
+        self.events.flush()
+
+    def sync_scroll(self):
+        if self.document is not None:
+            self.check_window()
+        if self.gutter.virtual:
+            self.update_line_numbers()
+        else:
+            self.line_number_bar.yview_moveto(self.text_area.yview()[0])
 
     def apply_color_scheme(self, event=None):
         selected_scheme = self.scheme_select_combobox.get()
@@ -309,9 +1185,14 @@ class TextEditor:
         if json_file:
             with open(json_file) as f:
                 data = json.load(f)
+            # Every syntax is checked and compiled before anything is written
+            package = SyntaxPackage(data.get('syntaxes', {}))
+            if package.problems:
+                messagebox.showerror("Error", "Scheme Package not installed:\n" + "\n".join(package.problems[:20]))
+                return
             self.save_scheme(data)
-            if 'syntaxes' in data:
-                self.save_syntaxes(data['syntaxes'])
+            if package.grammars and not self.save_syntaxes(package):
+                return
             self.save_schemes_in_themes()
             messagebox.showinfo("Success", "Scheme Package installed successfully")
 
@@ -319,6 +1200,7 @@ class TextEditor:
         name = data['name']
         with open(f'themes/{name}.json', 'w') as f:
             json.dump(data['theme'], f)
+        self.themes.invalidate(name)
 
     def iterate_plugins(self, data):
         plugins = data.get("plugins", [])
@@ -330,33 +1212,28 @@ class TextEditor:
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to install plugin: {e}")
 
-    def save_syntaxes(self, syntaxes):
-        for lang, syntax_rules in syntaxes.items():
-            for syntax in syntax_rules:
-                self.update_syntax_file(syntax, lang)
-
-    def update_syntax_file(self, syntax, lang):
-        scope = syntax['scope']
-        for file in os.listdir('extensions'):
-            with open(f'extensions/{file}', 'r') as f:
-                file_data = json.load(f)
-                if file_data['scope'] == scope:
-                    if messagebox.askyesno("Overwrite", f"Overwrite {file} with {lang} syntax?"):
-                        with open(f'extensions/{file}', 'w') as f:
-                            json.dump(syntax, f)
+    def save_syntaxes(self, package):
+        """Write the package's grammars over the files with their scopes that the user agrees to, all at once"""
+        # One directory pass for the whole package, every syntax then uses the index
+        self.extension_index.refresh()
+        targets = []
+        for i, (lang, syntax, data, grammar) in enumerate(package.grammars):
+            for file in self.extension_index.files_with_scope(syntax['scope']):
+                if messagebox.askyesno("Overwrite", f"Overwrite {file} with {lang} syntax?"):
+                    targets.append((file, i))
+        try:
+            package.write(targets, self.extension_index, self.grammar_cache)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to install syntaxes: {e}")
+            return False
+        return True
 
     def save_schemes_in_themes(self):
-        for theme in os.listdir("themes"):
-            if theme.endswith(".json"):
-                with open(f"themes/{theme}", "r") as file:
-                    name = theme.split(".")[0]
-                    self.schemes[name] = json.load(file)
+        # Only the theme names are listed here, themes are parsed when selected
+        self.themes.ensure_current()
 
     def shift_color(self, color, shift):
-        color = color.lstrip("#")
-        rgb = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-        new_rgb = tuple(max(0, min(255, c + shift)) for c in rgb)
-        return f"#{new_rgb[0]:02x}{new_rgb[1]:02x}{new_rgb[2]:02x}"
+        return ThemeRegistry.shift_color(color, shift)
 
     def scheme_select(self):
         self.scheme_select = tk.Toplevel(self.root)
@@ -371,7 +1248,7 @@ class TextEditor:
         label.pack(pady=10)
 
         style = self.create_combobox_style()
-        self.scheme_select_combobox = ttk.Combobox(self.scheme_select, values=list(self.schemes.keys()), 
+        self.scheme_select_combobox = ttk.Combobox(self.scheme_select, values=self.themes.names(), 
                                                    style="CustomCombobox", width=20)
         self.scheme_select_combobox.pack(pady=10)
         self.scheme_select_combobox.bind("<<ComboboxSelected>>", self.apply_color_scheme)
@@ -379,102 +1256,648 @@ class TextEditor:
     def create_combobox_style(self):
         style = ttk.Style()
         style.theme_use('default')
-        shifted_background = self.shift_color(self.current_scheme["background_color"], 7)
+        shifted_background = self.palette["field_background"]
         style.layout("CustomCombobox", style.layout("TCombobox"))
         style.configure("CustomCombobox",
                         fieldbackground=shifted_background,
                         background=shifted_background,
                         foreground=self.current_scheme["foreground_color"],
-                        selectbackground=self.shift_color(self.current_scheme["background_color"], 5),
+                        selectbackground=self.palette["select_background"],
                         selectforeground=self.current_scheme["foreground_color"],
                         arrowcolor=self.current_scheme["foreground_color"],
                         borderwidth=0,
                         relief="flat")
         style.map("CustomCombobox", fieldbackground=[('readonly', shifted_background)],
-                  selectbackground=[('readonly', self.shift_color(self.current_scheme["background_color"], 5))],
+                  selectbackground=[('readonly', self.palette["select_background"])],
                   selectforeground=[('readonly', self.current_scheme["foreground_color"])],
                   arrowcolor=[('readonly', self.current_scheme["foreground_color"])])
         return style
 
-    def update_line_numbers(self):
-        line_count = self.text_area.get('1.0', 'end').count('\n')
-        self.line_number_bar.config(state=tk.NORMAL)
-        self.line_number_bar.delete('1.0', tk.END)
-        for i in range(1, line_count + 2):
-            self.line_number_bar.insert(tk.END, f'{i}\n')
-
-        # Add tag to center text
-        self.line_number_bar.tag_configure("center", justify='center')
-        self.line_number_bar.tag_add("center", 1.0, tk.END)
-
-        self.line_number_bar.config(state=tk.DISABLED)
-
-
     def new_file(self):
-        self.file_path = filedialog.asksaveasfilename(filetypes=[("All Files", "*.*")])
-        if self.file_path:
-            self.text_area.delete(1.0, tk.END)
+        path = filedialog.asksaveasfilename(filetypes=[("All Files", "*.*")])
+        if path:
+            self.open_buffer()
+            self.file_path = path
+            self.journal.start(self.file_path)
+            self.watcher.watch(self.file_path)
             self.update_title()
+            self.refresh_tabs()
             self.load_syntax_for_extension()
+            self.search_stale()
 
     def open_file(self):
-        self.file_path = filedialog.askopenfilename(filetypes=[("All Files", "*.*")])
-        if self.file_path:
+        path = filedialog.askopenfilename(filetypes=[("All Files", "*.*")])
+        if path:
+            self.load_file(path)
+
+    @PROFILER.timed("open_file")
+    def load_file(self, path):
+        if path:
+            buffer = self.buffers.find(path)
+            if buffer is not None:
+                # Already open, everything it needs is still in the buffer
+                self.activate(buffer)
+                return
+            self.open_buffer()
+            self.file_path = path
             self.plugin_manager.api.update_event("open_file", self.file_path)
-            with open(self.file_path, 'r') as file:
-                self.text_area.delete(1.0, tk.END)
-                self.text_area.insert(1.0, file.read())
+            if os.path.getsize(self.file_path) >= self.current_scheme["large_file_threshold_mb"] * 1024 * 1024:
+                self.open_large_file(self.file_path)
+            else:
+                with open(self.file_path, 'r') as file:
+                    self.loading_window = True
+                    try:
+                        self.text_area.delete(1.0, tk.END)
+                        self.text_area.insert(1.0, file.read())
+                    finally:
+                        self.loading_window = False
             self.update_title()
+            self.refresh_tabs()
             self.load_syntax_for_extension()
+            self.start_journal()
+            self.watcher.watch(self.file_path)
+            self.search_stale()
+            self.events.publish("open", path=self.file_path)
+            self.index_workspace(self.file_path)
+            self.plugin_manager.on_file_opened(os.path.splitext(self.file_path)[1][1:])
+
+    def start_journal(self):
+        """Begin the undo history and swap file for file_path, replaying edits a crash left behind"""
+        deltas = UndoJournal.recover(self.file_path)
+        self.journal.start(self.file_path)
+        if deltas and messagebox.askyesno("Recover", f"{os.path.basename(self.file_path)} has {len(deltas)} "
+                                          "unsaved edits from a session that did not close. Recover them?"):
+            self.replay(deltas, history=True)
+
+    def open_large_file(self, path):
+        self.document = PieceTable.open(path)
+        self.gutter.set_virtual(True)
+        self.load_window(0)
+
+    def close_document(self):
+        if self.document is not None:
+            self.document.close()
+            self.document = None
+            self.window_first = 0
+            self.gutter.set_offset(0)
+            self.gutter.set_virtual(self.current_scheme["virtual_line_numbers"])
+
+    def load_window(self, first):
+        """Fill the text area with the document lines around `first`"""
+        line_count = self.document.line_count()
+        first = max(0, min(first, line_count - self.window_size))
+        text = self.document.read(first, self.window_size)
+        # The line break ending the window belongs to the document, not the text area
+        self.window_trailing_newline = first + self.window_size < line_count and text.endswith("\n")
+        if self.window_trailing_newline:
+            text = text[:-1]
+        self.window_first = first
+        self.window_lines = text.count("\n") + 1
+        self.loading_window = True
+        try:
+            self.text_area.delete(1.0, tk.END)
+            self.text_area.insert(1.0, text)
+        finally:
+            self.loading_window = False
+        self.window_dirty = False
+        self.gutter.set_offset(first)
+
+    def sync_window(self):
+        """Write edits made in the text area back into the document"""
+        if self.document is None or not self.window_dirty:
+            return
+        text = self.text_area.get(1.0, "end-1c")
+        self.document.replace_lines(self.window_first, self.window_lines,
+                                    text + "\n" if self.window_trailing_newline else text)
+        self.window_lines = text.count("\n") + 1
+        self.window_dirty = False
+
+    def check_window(self):
+        """Slide the window when the view gets close to either end of it"""
+        top = int(self.text_area.index("@0,0").split(".")[0])
+        bottom = int(self.text_area.index(f"@0,{self.text_area.winfo_height()}").split(".")[0])
+        margin = self.window_size // 5
+        near_top = top <= margin and self.window_first > 0
+        near_bottom = (bottom >= self.line_count() - margin
+                       and self.window_first + self.window_lines < self.document.line_count())
+        if not (near_top or near_bottom):
+            return
+        self.sync_window()
+        view_line = self.window_first + top - 1
+        cursor_line, cursor_column = map(int, self.text_area.index(tk.INSERT).split("."))
+        cursor_line += self.window_first
+        self.load_window(view_line - self.window_size // 2)
+        self.text_area.yview(f"{view_line - self.window_first + 1}.0")
+        if self.window_first < cursor_line <= self.window_first + self.window_lines:
+            self.text_area.mark_set(tk.INSERT, f"{cursor_line - self.window_first}.{cursor_column}")
+
+    def get_text(self):
+        """The whole document as it would be saved, without the line break Tk keeps at the end; see PieceTable"""
+        if self.document is None:
+            return self.text_area.get("1.0", "end-1c")
+        self.sync_window()
+        return self.document.text()
 
-    def save_file(self):
-        if self.file_path:
+    def set_text(self, text):
+        if self.document is None:
+            self.text_area.delete(1.0, tk.END)
+            self.text_area.insert(1.0, text)
+            return
+        self.document.set_text(text)
+        self.load_window(0)
+
+    @PROFILER.timed("save_file")
+    def save_file(self, buffer=None):
+        buffer = buffer or self.buffer
+        if not buffer.file_path:
+            # Untitled: ask where to save it first
+            self.save_file_as(buffer)
+            return
+        if self.saver.busy():
+            # Save the newest snapshot once the running save is done
+            if buffer not in self.save_again:
+                self.save_again.append(buffer)
+            return
+        started = time.perf_counter()
+        self.saving_sequence = buffer.journal.sequence
+        if buffer is self.buffer:
+            self.sync_window()
+        if buffer.document is not None:
+            chunks, total = buffer.document.chunks()
+            self.saved_generation = buffer.document.generation
+            self.saver.start(buffer.file_path, chunks, total, binary=True, started=started)
+        else:
+            if buffer.text_area is not None:
+                text = buffer.text_area.get("1.0", "end-1c")
+            else:
+                text = buffer.text
+            self.saver.start(buffer.file_path, self.saver.text_chunks(text), len(text), started=started)
+        self.saving_buffer = buffer
+        self.saving_path = buffer.file_path
+        self.set_status("Saving...")
+        self.root.after(50, self.poll_save)
+
+    def poll_save(self):
+        self.take_save_messages()
+        if self.saver.busy() or not self.saver.messages.empty():
+            self.root.after(50, self.poll_save)
+        elif self.save_again:
+            self.save_file(self.save_again.pop(0))
+
+    def take_save_messages(self):
+        while True:
             try:
-                with open(self.file_path, 'w') as file:
-                    file.write(self.text_area.get(1.0, tk.END))
-                messagebox.showinfo("Success", "File saved successfully")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to save file: {e}")
+                message = self.saver.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                written, total = message[1:]
+                self.set_status(f"Saving... {written * 100 // max(total, 1)}%")
+            elif message[0] == "error":
+                self.set_status("Save failed")
+                messagebox.showerror("Error", f"Failed to save file: {message[1]}")
+            else:
+                self.finish_save(*message[1:])
+
+    def finish_saves(self):
+        """Wait for the running save and those queued behind it; the last step of a save runs on the UI thread"""
+        while self.saver.busy() or not self.saver.messages.empty() or self.save_again:
+            if self.saver.busy():
+                self.saver.thread.join()
+            self.take_save_messages()
+            if self.save_again and not self.saver.busy():
+                self.save_file(self.save_again.pop(0))
+
+    def finish_save(self, temp_path, started):
+        buffer = self.saving_buffer
+        try:
+            if buffer.document is not None and buffer.document.generation == self.saved_generation:
+                buffer.document.swap_in(temp_path, self.saving_path)
+            else:
+                # Edits made during the save still read from the old file, which stays mapped
+                os.replace(temp_path, self.saving_path)
+        except OSError as e:
+            self.set_status("Save failed")
+            messagebox.showerror("Error", f"Failed to save file: {e}")
+            return
+        self.watcher.watch(self.saving_path)
+        if self.workspace is not None and self.workspace.contains(self.saving_path):
+            self.refresh_workspace([self.saving_path])
+        if not buffer.closed:
+            buffer.journal.relocate(self.saving_path)
+            buffer.journal.mark_saved(self.saving_path, self.saving_sequence)
+        latency = self.saver.finish(started)
+        if PROFILER.enabled:
+            PROFILER.record("save", latency)
+        self.set_status(f"Saved {os.path.basename(self.saving_path)} in {latency * 1000:.0f} ms")
+        self.events.publish("save", path=self.saving_path, latency=latency)
+
+    def index_workspace(self, path):
+        """Index the repository `path` lies in, unless it is already the workspace"""
+        if self.workspace is not None and self.workspace.contains(path):
+            return
+        root = WorkspaceIndex.find_root(path)
+        if root is not None:
+            self.open_workspace(root)
+
+    def open_folder(self):
+        root = filedialog.askdirectory()
+        if root:
+            self.open_workspace(root)
+
+    def open_workspace(self, root):
+        self.workspace = WorkspaceIndex(root)
+        # Saves queued for the old workspace don't belong to this one
+        self.workspace_queue = []
+        self.workspace_walked = time.monotonic()
+        self.refresh_workspace()
+
+    def refresh_workspace(self, paths=None):
+        """Bring the workspace index up to date on a thread, all of it or just `paths`"""
+        self.workspace_queue.append(paths)
+        if self.workspace_thread is None or not self.workspace_thread.is_alive():
+            self.start_workspace_refresh()
+
+    def start_workspace_refresh(self):
+        pending, self.workspace_queue = self.workspace_queue, []
+        paths = None if None in pending else sorted({path for paths in pending for path in paths})
+        rules = WorkspaceIndex.symbol_rules(self.extension_index, self.grammar_cache)
+        self.workspace_thread = threading.Thread(target=self.workspace.refresh, args=(rules, paths), daemon=True)
+        self.workspace_thread.start()
+        self.root.after(100, self.wait_for_workspace)
+
+    def wait_for_workspace(self):
+        if self.workspace_thread.is_alive():
+            self.root.after(100, self.wait_for_workspace)
+        elif self.workspace_queue:
+            self.start_workspace_refresh()
         else:
-            self.save_file_as()
-
-    def save_file_as(self):
-        self.file_path = filedialog.asksaveasfilename(filetypes=[("All Files", "*.*")])
-        if self.file_path:
-            self.save_file()
+            if self.workspace.truncated:
+                self.set_status(f"Indexed the first {WorkspaceIndex.MAX_FILES} files of {self.workspace.root}")
+            if self.picker is not None:
+                self.update_picker()
+
+    def show_picker(self, event=None, prefix=""):
+        """Quick open a workspace file, or go to a symbol when the query starts with @"""
+        if self.workspace is None:
+            self.set_status("Open a file in a repository, or open a folder, to index it")
+            return "break"
+        if time.monotonic() - self.workspace_walked > self.WORKSPACE_WALK_SECONDS:
+            # Catch up with changes made outside the editor; unchanged files are only stat'ed
+            self.workspace_walked = time.monotonic()
+            self.refresh_workspace()
+        if self.picker is None:
+            self.create_picker()
+        self.picker_entry.delete(0, tk.END)
+        self.picker_entry.insert(0, prefix)
+        self.picker_entry.focus_set()
+        self.update_picker()
+        return "break"
+
+    def create_picker(self):
+        bg, fg = self.current_scheme["background_color"], self.current_scheme["foreground_color"]
+        self.picker = Toplevel(self.root, bg=self.current_scheme["line_bar_color"], padx=6, pady=6)
+        self.picker.overrideredirect(True)
+        x = self.root.winfo_rootx() + max(self.root.winfo_width() - 600, 0) // 2
+        self.picker.geometry(f"600x320+{x}+{self.root.winfo_rooty() + 60}")
+        self.picker_entry = tk.Entry(self.picker, bg=self.palette["field_background"], fg=fg,
+                                     insertbackground=fg, relief="flat")
+        self.picker_entry.pack(fill=tk.X)
+        self.picker_list = Listbox(self.picker, bg=bg, fg=fg, selectbackground=self.current_scheme["line_bar_color"],
+                                   selectforeground=fg, relief="flat", highlightthickness=0, activestyle="none")
+        self.picker_list.pack(fill=tk.BOTH, expand=True, pady=(6, 0))
+        # (path, line or None) of each row in the list
+        self.picker_choices = []
+        self.picker_entry.bind("<KeyRelease>", self.on_picker_key)
+        self.picker_entry.bind("<Return>", lambda e: self.pick())
+        self.picker_entry.bind("<Escape>", lambda e: self.close_picker())
+        self.picker_entry.bind("<Down>", lambda e: self.move_pick(1))
+        self.picker_entry.bind("<Up>", lambda e: self.move_pick(-1))
+        self.picker_list.bind("<Double-Button-1>", lambda e: self.pick())
+
+    def on_picker_key(self, event):
+        if event.keysym not in ("Return", "Escape", "Up", "Down"):
+            self.update_picker()
+
+    @PROFILER.timed("quick_open")
+    def update_picker(self):
+        query = self.picker_entry.get()
+        root = self.workspace.root
+        if query.startswith("@"):
+            symbols = self.workspace.find_symbols(query[1:])
+            self.picker_choices = [(path, line) for name, kind, path, line in symbols]
+            labels = [f"{name}    {kind}  {os.path.relpath(path, root)}:{line}" for name, kind, path, line in symbols]
+        else:
+            paths = self.workspace.find_files(query)
+            self.picker_choices = [(path, None) for path in paths]
+            labels = [os.path.relpath(path, root) for path in paths]
+        self.picker_list.delete(0, tk.END)
+        self.picker_list.insert(tk.END, *labels)
+        if labels:
+            self.picker_list.selection_set(0)
+
+    def move_pick(self, step):
+        selection = self.picker_list.curselection()
+        if not self.picker_choices:
+            return "break"
+        row = (selection[0] + step if selection else 0) % len(self.picker_choices)
+        self.picker_list.selection_clear(0, tk.END)
+        self.picker_list.selection_set(row)
+        self.picker_list.see(row)
+        return "break"
+
+    def pick(self):
+        selection = self.picker_list.curselection()
+        if not selection:
+            return
+        path, line = self.picker_choices[selection[0]]
+        self.close_picker()
+        self.goto_location(path, line)
+
+    def close_picker(self):
+        if self.picker is not None:
+            self.picker.destroy()
+            self.picker = None
+        self.text_area.focus_set()
+
+    def goto_location(self, path, line=None):
+        """Open `path` and put the cursor at the start of 1-based document `line`"""
+        self.load_file(path)
+        if line is None or self.file_path is None or os.path.abspath(self.file_path) != os.path.abspath(path):
+            return
+        self.text_area.mark_set(tk.INSERT, self.window_index(f"{line}.0"))
+        self.text_area.see(tk.INSERT)
+        self.redraw.mark("highlight", "scroll", "search", "events")
+
+    def poll_disk(self):
+        interval = self.current_scheme["file_watch_ms"]
+        if interval > 0:
+            self.check_disk()
+        self.root.after(interval or 1000, self.poll_disk)
+
+    def check_disk(self):
+        """Reload the buffer on screen if its file changed on disk since it was read or saved"""
+        path = self.file_path
+        if (not path or self.reloading or self.saving_path == path and self.saver.busy()
+                or not self.watcher.changed(path)):
+            return
+        self.watcher.watch(path)
+        name = os.path.basename(path)
+        if not os.path.exists(path):
+            self.set_status(f"{name} was deleted on disk")
+            return
+        if self.document is not None and self.document.changed():
+            # Rewritten under the mapping: the text it held is gone whatever the answer would be
+            self.reload_document()
+            return
+        if self.journal.modified() and not messagebox.askyesno(
+                "Reload", f"{name} changed on disk. Reload it and lose your unsaved edits?"):
+            return
+        if self.document is not None:
+            self.reload_document()
+            return
+        # Read and diff on a thread; only the hunks that differ touch the text area
+        old = self.text_area.get("1.0", "end-1c")
+        result = []
+
+        def read():
+            try:
+                with open(path, 'r') as file:
+                    result.append(FileWatcher.diff(old, file.read()))
+            except (OSError, UnicodeDecodeError) as e:
+                result.append(e)
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        self.reloading = True
+        self.root.after(20, self.wait_for_reload, thread, result, self.buffer, self.journal.sequence)
+
+    def wait_for_reload(self, thread, result, buffer, sequence):
+        if thread.is_alive():
+            self.root.after(20, self.wait_for_reload, thread, result, buffer, sequence)
+            return
+        self.reloading = False
+        if buffer.closed:
+            return
+        if isinstance(result[0], Exception):
+            self.set_status(f"Reload failed: {result[0]}")
+        elif buffer is not self.buffer or buffer.journal.sequence != sequence:
+            # Switched away or typed while reading; diff again on the next check
+            self.watcher.stamps[buffer.file_path] = None
+        else:
+            self.apply_reload(result[0])
+
+    def apply_reload(self, hunks):
+        """Edit the text area into the file on disk hunk by hunk, keeping the cursor and view on their lines"""
+        top = int(self.text_area.index("@0,0").split(".")[0]) - 1
+        cursor_line, cursor_column = map(int, self.text_area.index(tk.INSERT).split("."))
+        # From the last hunk back, so the line numbers of the others stay put
+        self.journal.begin_group()
+        try:
+            for first, last, text, added in reversed(hunks):
+                self.text_area.replace(f"{first + 1}.0", self.clamp_index(f"{last + 1}.0"), text)
+        finally:
+            self.journal.end_group()
+        self.journal.mark_saved(self.file_path)
+        self.text_area.mark_set(tk.INSERT, f"{FileWatcher.map_line(hunks, cursor_line - 1) + 1}.{cursor_column}")
+        self.text_area.yview(f"{FileWatcher.map_line(hunks, top) + 1}.0")
+        self.set_status(f"Reloaded {os.path.basename(self.file_path)}: {len(hunks)} changed hunks")
+        self.events.publish("reload", path=self.file_path, hunks=len(hunks))
+
+    def reload_document(self):
+        """Map a large file afresh, keeping the view and cursor on the same document lines"""
+        view_line = self.window_first + int(self.text_area.index("@0,0").split(".")[0]) - 1
+        cursor_line, cursor_column = map(int, self.text_area.index(tk.INSERT).split("."))
+        cursor_line += self.window_first
+        self.document.close()
+        self.document = PieceTable.open(self.file_path)
+        self.load_window(view_line - self.window_size // 2)
+        self.gutter.reset(self.line_count(), self.window_first)
+        self.text_area.yview(f"{view_line - self.window_first + 1}.0")
+        if self.window_first < cursor_line <= self.window_first + self.window_lines:
+            self.text_area.mark_set(tk.INSERT, f"{cursor_line - self.window_first}.{cursor_column}")
+        # The old edits no longer line up with the file
+        self.journal.start(self.file_path)
+        self.set_status(f"Reloaded {os.path.basename(self.file_path)}")
+        self.events.publish("reload", path=self.file_path, hunks=None)
+
+    def report_callback_exception(self, kind, value, trace):
+        if isinstance(value, DocumentChanged) and self.document is not None and self.document.changed():
+            self.watcher.watch(self.file_path)
+            self.reload_document()
+            self.set_status(f"{value}, reloaded it; edits since the last save are lost")
+            return
+        tk.Tk.report_callback_exception(self.root, kind, value, trace)
+
+    def set_status(self, text):
+        self.status_bar.config(text=text)
+
+    def save_file_as(self, buffer=None):
+        buffer = buffer or self.buffer
+        path = filedialog.asksaveasfilename(filetypes=[("All Files", "*.*")])
+        if path:
+            buffer.file_path = path
+            self.save_file(buffer)
             self.update_title()
+            self.refresh_tabs()
 
     def update_title(self):
         self.root.title(f"gVim - {self.file_path if self.file_path else 'Untitled'}")
 
     def load_syntax_for_extension(self):
         file_extension = os.path.splitext(self.file_path)[1][1:]
-        for file in os.listdir("extensions"):
-            with open(f"extensions/{file}", "r") as f:
-                data = json.load(f)
-                if file_extension in data["scope"]:
-                    self.load_syntax_rules(f"extensions/{file}")
-                    self.apply_syntax_highlighting()
+        grammar_path = self.extension_index.lookup(file_extension)
+        if grammar_path:
+            self.load_syntax_rules(grammar_path)
+            self.redraw.mark("highlight")
 
     def load_syntax_rules(self, file_path):
-        with open(file_path, "r") as file:
-            data = json.load(file)
-            self.syntax_rules = data["rules"]
-
+        grammar = CompiledGrammar.load(file_path, self.grammar_cache)
+        grammar.profiler = self.rule_profiler
+        entry = self.grammar_cache.get(grammar.digest) if grammar.digest else None
+        if not grammar.probed and entry is not None and "timings" in entry:
+            # Probed in an earlier session, no need for another process
+            self.rule_profiler.apply(grammar, entry["timings"])
+        sample = self.get_lines(0, min(self.line_count(), 2000) - 1)[:200000]
+        if grammar.probed or not sample.strip():
+            self.set_grammar(self.buffer, grammar)
+            return
+        # A new grammar first runs over this file in a process that can be killed if a rule gets stuck
+        probe = threading.Thread(target=self.rule_profiler.probe, args=(grammar, sample), daemon=True)
+        probe.start()
+        self.set_status(f"Checking {os.path.basename(file_path)}...")
+        self.root.after(20, self.wait_for_probe, probe, self.buffer, grammar)
+
+    def wait_for_probe(self, probe, buffer, grammar):
+        if probe.is_alive():
+            self.root.after(20, self.wait_for_probe, probe, buffer, grammar)
+            return
+        if grammar.disabled:
+            self.set_status(f"Disabled {len(grammar.disabled)} syntax rules that got stuck")
+        else:
+            self.set_status("")
+        if grammar.probed and grammar.digest:
+            self.grammar_cache.put(grammar.digest, grammar)
+            self.grammar_cache.save()
+        if not buffer.closed:
+            self.set_grammar(buffer, grammar)
+
+    def set_grammar(self, buffer, grammar):
+        buffer.syntax_rules = grammar.rules
+        buffer.highlighter.set_grammar(grammar)
+        if buffer.tag_pool is not None:
+            buffer.tag_pool.clear()
+            buffer.tag_pool.build(buffer.highlighter.rules, self.get_styles)
+        if buffer is self.buffer:
+            if self.tokenizer is not None:
+                self.tokenizer.set_grammar(grammar)
+            self.redraw.mark("highlight")
+
+    def show_rule_report(self):
+        if self.rule_report is not None:
+            self.rule_report.destroy()
+        self.rule_report = tk.Toplevel(self.root)
+        self.rule_report.title("Syntax rules")
+        self.rule_report.config(bg=self.current_scheme["background_color"])
+        lines = [f"{'ms':>9} {'slowest':>8} {'matches':>8} {'state':<8} pattern"]
+        for row in self.rule_profiler.report(self.highlighter.grammar, 20):
+            lines.append(f"{row['ms']:9.1f} {row['slowest_ms']:8.1f} {row['matches']:8} {row['state']:<8} "
+                         f"{row['pattern'][:60]}")
+        if not self.rule_profiler.recording:
+            lines.append("\nTurn on rule timing for per-rule numbers, scans are only split up when over budget")
+        tk.Label(self.rule_report, text="\n".join(lines), justify="left", font=("Consolas", 9), padx=10, pady=10,
+                 bg=self.current_scheme["background_color"], fg=self.current_scheme["foreground_color"]).pack()
+
+    def toggle_rule_timing(self):
+        self.rule_profiler.recording = not self.rule_profiler.recording
+        self.rule_profiler.reset()
+        self.set_status(f"Rule timing {'on' if self.rule_profiler.recording else 'off'}")
+
+    @PROFILER.timed("highlight")
     def apply_syntax_highlighting(self, event=None):
-        self.text_area.tag_remove('syntax', "1.0", tk.END)
-        text = self.text_area.get("1.0", tk.END)
-        sorted_rules = sorted(self.syntax_rules, key=lambda x: x.get("priority", 0), reverse=True)
-
-        for rule in sorted_rules:
-            pattern = rule["pattern"]
-            styles = self.get_styles(rule)
-            for match in re.finditer(pattern, text, re.MULTILINE):
-                start_index = f"1.0 + {match.start()} chars"
-                end_index = f"1.0 + {match.end()} chars"
-                tag_name = f"syntax_{match.start()}"
-                self.text_area.tag_add(tag_name, start_index, end_index)
-                self.text_area.tag_config(tag_name, **styles)
+        line_count = self.line_count()
+        if not self.current_scheme["viewport_highlighting"]:
+            for region in self.highlighter.highlight_lines(self.get_lines, line_count, 0, line_count - 1):
+                self.paint_syntax(region)
+            return
+
+        # Color what is on screen now and leave the rest of the file for idle time
+        first, last = self.visible_lines(line_count)
+        if self.tokenizer is not None:
+            self.tokenizer.set_view(first, last)
+            self.schedule_token_poll()
+            return
+        deadline = time.perf_counter() + self.current_scheme["highlight_chunk_ms"] / 1000
+        for region in self.highlighter.highlight_lines(self.get_lines, line_count, first - self.highlight_margin,
+                                                       last + self.highlight_margin, deadline):
+            self.paint_syntax(region)
+        self.schedule_background_highlighting()
+
+    def schedule_background_highlighting(self):
+        if self.highlighter.pending and self.background_highlight_job is None:
+            self.background_highlight_job = self.root.after_idle(self.continue_highlighting)
+
+    @PROFILER.timed("highlight_background")
+    def continue_highlighting(self):
+        """Tokenize pending lines, nearest to the viewport first, for one time slice"""
+        self.background_highlight_job = None
+        line_count = self.line_count()
+        first, last = self.visible_lines(line_count)
+        deadline = time.perf_counter() + self.current_scheme["highlight_chunk_ms"] / 1000
+        while self.highlighter.pending and time.perf_counter() < deadline:
+            self.paint_syntax(self.highlighter.highlight_next(self.get_lines, line_count, (first + last) // 2,
+                                                              self.highlight_chunk_lines, deadline))
+        self.schedule_background_highlighting()
+
+    def schedule_token_poll(self):
+        if self.token_poll_job is None and self.tokenizer is not None and self.tokenizer.busy():
+            self.token_poll_job = self.root.after(10, self.poll_tokens)
+
+    def poll_tokens(self):
+        """Paint one time slice of the tokenizer's results, handing back those made for older text"""
+        self.token_poll_job = None
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            return
+        deadline = time.perf_counter() + self.current_scheme["highlight_chunk_ms"] / 1000
+        while time.perf_counter() < deadline:
+            try:
+                key, generation, region = tokenizer.results.get_nowait()
+            except queue.Empty:
+                break
+            if key is tokenizer.key and generation == tokenizer.generation:
+                self.paint_syntax(region)
+            else:
+                tokenizer.retry(generation, region[0], region[1], key)
+        self.schedule_token_poll()
+
+    def set_background_tokenizer(self, enabled):
+        if enabled and self.tokenizer is None:
+            self.tokenizer = TokenizerWorker(self.highlight_margin, self.highlight_chunk_lines)
+            self.switch_tokenizer(self.buffer)
+        elif not enabled and self.tokenizer is not None:
+            self.tokenizer.stop()
+            self.tokenizer = None
+        self.redraw.mark("highlight")
+
+    def switch_tokenizer(self, buffer):
+        """Point the tokenizer at `buffer`, sending its text only when the tokenizer has no copy yet"""
+        known = self.tokenizer.switch(buffer)
+        self.tokenizer.set_grammar(buffer.highlighter.grammar)
+        if not known:
+            self.tokenizer.reset(self.get_lines(0, self.line_count() - 1))
+
+    def visible_lines(self, line_count):
+        top, bottom = self.text_area.yview()
+        return int(top * line_count), min(line_count - 1, int(bottom * line_count) + 1)
+
+    def paint_syntax(self, region):
+        if region is None:
+            return
+        first, last, matches = region
+        self.tag_pool.remove(f"{first + 1}.0", f"{last + 2}.0")
+        base = self.line_index.line_start(first)
+        index = self.line_index.index
+        self.tag_pool.paint(matches, lambda offset: index(base + offset))
 
     def get_styles(self, rule):
         styles = {"foreground": rule["color"], "font": self.text_font}
@@ -487,8 +1910,9 @@ class TextEditor:
         return styles
 
     def load_color_scheme(self, scheme_name="default"):
-        if scheme_name in self.schemes:
-            self.update_scheme(self.schemes[scheme_name])
+        scheme = self.themes.get(scheme_name)
+        if scheme is not None:
+            self.update_scheme(scheme)
 
     def load_default_color_scheme(self):
         self.load_color_scheme("default")
@@ -506,8 +1930,11 @@ class TextEditor:
         file_menu = tk.Menu(file_button, tearoff=0, bg=self.current_scheme["line_bar_color"], fg=self.current_scheme["foreground_color"])
         file_menu.add_command(label="New", command=self.new_file)
         file_menu.add_command(label="Open", command=self.open_file)
+        file_menu.add_command(label="Open Folder", command=self.open_folder)
         file_menu.add_command(label="Save", command=self.save_file)
         file_menu.add_command(label="Save As", command=self.save_file_as)
+        file_menu.add_command(label="Find/Replace", command=self.show_find_bar)
+        file_menu.add_command(label="Close", command=self.close_buffer)
         file_menu.add_separator()
         file_menu.add_command(label="Open Terminal Here", command=self.open_terminal)
         file_menu.add_separator()
@@ -525,6 +1952,8 @@ class TextEditor:
         extensions_menu.add_command(label="Install plugin", command=self.plugin_manager.install_plugin)
         extensions_menu.add_command(label="Uninstall/disable plugins", command=self.plugin_manager.uninstall_disable_plugin)
         extensions_button.config(menu=extensions_menu)
+        # Plugins with command activation events add their entries here
+        self.extensions_menu = extensions_menu
 
         # Add Window button for minimize and close
         window_button = tk.Menubutton(self.menu_bar_frame, text="Window", bg=self.current_scheme["line_bar_color"], fg=self.current_scheme["foreground_color"], relief="flat")
@@ -533,6 +1962,14 @@ class TextEditor:
         window_menu = tk.Menu(window_button, tearoff=0, bg=self.current_scheme["line_bar_color"], fg=self.current_scheme["foreground_color"])
         window_menu.add_command(label="Minimize", command=self.minimize_window)
         window_menu.add_command(label="Close", command=self.exit_editor)
+        window_menu.add_separator()
+        window_menu.add_command(label="Toggle performance HUD", command=self.toggle_hud)
+        window_menu.add_command(label="Dump performance data", command=self.dump_profile)
+        window_menu.add_command(label="Toggle syntax rule timing", command=self.toggle_rule_timing)
+        window_menu.add_command(label="Syntax rule report", command=self.show_rule_report)
+        window_menu.add_separator()
+        window_menu.add_command(label="Quick open", command=self.show_picker)
+        window_menu.add_command(label="Go to symbol", command=lambda: self.show_picker(prefix="@"))
         window_button.config(menu=window_menu)
 
 
@@ -556,21 +1993,40 @@ class TextEditor:
             messagebox.showerror("Error", f"Failed to open terminal: {e}")
 
     def exit_editor(self):
-        if messagebox.askokcancel("Quit", "Do you really want to quit?"):
-            self.root.destroy()
+        buffers = self.buffers.buffers
+        if any(buffer.journal.modified() for buffer in buffers):
+            discarded = self.settle_unsaved(buffers, "Quit")
+            if discarded is None:
+                return
+        elif messagebox.askokcancel("Quit", "Do you really want to quit?"):
+            discarded = set()
+        else:
+            return
+        # The worker thread dies with the window, a save it has not handed back would be lost
+        self.set_status("Finishing saves...")
+        self.root.update_idletasks()
+        self.finish_saves()
+        for buffer in buffers:
+            # Edits neither saved nor discarded keep their swap file for recovery
+            buffer.journal.close(remove=buffer in discarded or not buffer.journal.modified())
+        self.searcher.stop()
+        self.root.destroy()
 
     def update_scheme(self, scheme):
         # Update the current scheme with the new one
         self.current_scheme.update(scheme)
+        self.palette = ThemeRegistry.palette(self.current_scheme["background_color"])
+        self.root.config(bg=self.palette["window_background"])
     
         # Update the text area colors
         self.text_font = (self.current_scheme["font_face"], self.current_scheme["font_size"])
-        self.text_area.config(
-            fg=self.current_scheme["foreground_color"],
-            bg=self.current_scheme["background_color"],
-            insertbackground=self.current_scheme["insertbackground_color"],
-            font=self.text_font
-        )
+        for buffer in self.buffers.buffers:
+            buffer.journal.max_bytes = self.current_scheme["undo_memory_kb"] * 1024
+            if buffer.text_area is not None:
+                self.style_buffer_widget(buffer)
+        self.buffers.budget_bytes = self.current_scheme["buffer_memory_mb"] << 20
+        for buffer in self.buffers.evictions():
+            self.release_buffer_widget(buffer)
     
         # Update the line number bar colors
         self.line_number_bar.config(
@@ -584,9 +2040,30 @@ class TextEditor:
         if self.current_scheme["line_number_italic"]:
             font += " italic"
         self.line_number_bar.config(font=font)
+        self.gutter.set_virtual(self.current_scheme["virtual_line_numbers"] or self.document is not None)
+        self.redraw.fps = self.current_scheme["redraw_fps"]
+        self.rule_profiler.budget = self.current_scheme["rule_budget_ms"] / 1000
+        self.set_background_tokenizer(self.current_scheme["background_tokenizer"])
+        self.redraw.mark("gutter", "scroll")
     
-        # Update menu bar colors
+        self.events.publish("scheme", scheme=dict(self.current_scheme))
+
+        # Update menu bar and status bar colors
         self.update_menu_bar_colors()
+        self.tab_bar.config(bg=self.current_scheme["line_bar_color"])
+        self.refresh_tabs()
+        self.status_bar.config(bg=self.current_scheme["line_bar_color"], fg=self.current_scheme["foreground_color"])
+
+    def style_buffer_widget(self, buffer):
+        buffer.text_area.config(
+            fg=self.current_scheme["foreground_color"],
+            bg=self.current_scheme["background_color"],
+            insertbackground=self.current_scheme["insertbackground_color"],
+            font=self.text_font
+        )
+        # Syntax tags carry the font too, so restyle the pool in place
+        buffer.tag_pool.build(buffer.highlighter.rules, self.get_styles)
+        buffer.text_area.tag_configure("search", background=self.current_scheme["search_match_color"])
 
     def update_menu_bar_colors(self):
         """Update the background and text colors of the menu bar and its items."""
@@ -0,0 +1,3086 @@
+"""Editor core that runs without a display: documents, tokenizing, line
+numbers, themes, extensions, plugins and profiling.
+
+gvim.py builds the Tk editor on top of these; bench.py drives them headless.
+"""
+import json
+import re
+import os
+import hashlib
+import heapq
+import importlib.util
+import ast
+import difflib
+import mmap
+import multiprocessing
+import queue
+import stat
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import lru_cache, wraps
+from itertools import islice, repeat
+from bisect import bisect_left, bisect_right
+
+class Profiler:
+    """Latency samples for the editor's hot paths; timing is skipped while disabled"""
+
+    def __init__(self, enabled=False, max_samples=10000):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        # metric name -> recent durations in seconds, and the total count ever recorded
+        self.samples = {}
+        self.counts = {}
+
+    def timed(self, name):
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - started)
+            return wrapper
+        return decorate
+
+    def record(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, deque(maxlen=self.max_samples))
+        samples.append(seconds)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @staticmethod
+    def percentile(ordered, percent):
+        return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+    def summary(self):
+        """Per metric count, mean, p50/p95/p99 and max in milliseconds"""
+        result = {}
+        for name, samples in list(self.samples.items()):
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+            result[name] = {"count": self.counts.get(name, len(ordered)),
+                            "mean": sum(ordered) / len(ordered) * 1000,
+                            "p50": self.percentile(ordered, 50) * 1000,
+                            "p95": self.percentile(ordered, 95) * 1000,
+                            "p99": self.percentile(ordered, 99) * 1000,
+                            "max": ordered[-1] * 1000}
+        return result
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            json.dump({"timestamp": time.time(), "unit": "ms", "metrics": self.summary()}, file, indent=4)
+
+    def reset(self):
+        self.samples.clear()
+        self.counts.clear()
+
+
+PROFILER = Profiler(enabled=os.environ.get("GVIM_PROFILE") == "1")
+
+
+class PluginCancelled(Exception):
+    """Raised inside a plugin thread once its job is cancelled or over budget"""
+
+
+class EditorEvent:
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+
+    def __repr__(self):
+        return f"EditorEvent({self.kind!r}, {self.data!r})"
+
+
+class Subscription:
+    def __init__(self, kinds, callback, filter, max_pending):
+        self.kinds = kinds
+        self.callback = callback
+        self.filter = filter
+        self.pending = deque(maxlen=max_pending)
+        # kind -> newest event, for kinds where only the latest state matters
+        self.latest = {}
+        self.dropped = 0
+
+    def add(self, event):
+        if event.kind in EventBus.COALESCED:
+            self.latest[event.kind] = event
+            return
+        if event.kind == "edit" and self.pending and self.pending[-1].kind == "edit":
+            merged = EventBus.merge_edits(self.pending[-1].data, event.data)
+            if merged is not None:
+                # A new event, the old one may be in other subscribers' batches too
+                self.pending[-1] = EditorEvent("edit", merged)
+                return
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(event)
+
+    def take(self):
+        batch = list(self.pending) + list(self.latest.values())
+        if self.dropped:
+            batch.insert(0, EditorEvent("dropped", {"count": self.dropped}))
+        self.pending.clear()
+        self.latest = {}
+        self.dropped = 0
+        return batch
+
+
+class EventBus:
+    """Publish/subscribe bus for editor events, delivered in batches once per frame.
+
+    Event kinds are "open", "save", "edit", "cursor", "scroll" and "scheme".
+    A subscriber's callback gets a list of events per flush: every edit since
+    the last frame (up to `max_pending`; when older ones had to be dropped the
+    batch starts with a "dropped" event) but only the newest cursor, scroll
+    and scheme event. Callbacks run on the UI thread.
+
+    An edit event says that 1-based document lines line..line + removed
+    became lines line..line + added. One that touches or overlaps the lines
+    of the edit before it in the batch is merged into it, so typing a word
+    arrives as one edit.
+    """
+
+    COALESCED = ("cursor", "scroll", "scheme")
+
+    def __init__(self, request_flush=None, max_pending=1000):
+        self.request_flush = request_flush
+        self.max_pending = max_pending
+        # kind -> subscriptions, replaced rather than mutated so flushing can iterate safely
+        self.by_kind = {}
+        self.subscriptions = []
+
+    def subscribe(self, kinds, callback, filter=None):
+        """Call `callback(events)` for events of `kinds` that pass `filter(event)`"""
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        subscription = Subscription(tuple(kinds), callback, filter, self.max_pending)
+        self.subscriptions = self.subscriptions + [subscription]
+        self.index()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+        self.index()
+
+    def index(self):
+        by_kind = {}
+        for subscription in self.subscriptions:
+            for kind in subscription.kinds:
+                by_kind.setdefault(kind, []).append(subscription)
+        self.by_kind = by_kind
+
+    def wants(self, kind):
+        return kind in self.by_kind
+
+    @staticmethod
+    def merge_edits(first, second):
+        """One edit with the effect of edit `first` followed by `second`, or None when they are apart"""
+        line, removed, added = first["line"], first["removed"], first["added"]
+        next_line, next_removed, next_added = second["line"], second["removed"], second["added"]
+        if next_line > line + added + 1 or next_line + next_removed < line - 1:
+            return None
+        start = min(line, next_line)
+        # The end of both, in lines as they were between the two edits
+        end = max(line + added, next_line + next_removed)
+        old_end = end - added + removed if end > line + added else line + removed
+        new_end = end - next_removed + next_added if end > next_line + next_removed else next_line + next_added
+        return {"line": start, "removed": old_end - start, "added": new_end - start}
+
+    def publish(self, kind, **data):
+        subscriptions = self.by_kind.get(kind)
+        if not subscriptions:
+            return
+        event = EditorEvent(kind, data)
+        for subscription in subscriptions:
+            if subscription.filter is None or subscription.filter(event):
+                subscription.add(event)
+        if self.request_flush:
+            self.request_flush()
+
+    def flush(self):
+        for subscription in self.subscriptions:
+            if subscription.pending or subscription.latest:
+                batch = subscription.take()
+                try:
+                    subscription.callback(batch)
+                except Exception:
+                    traceback.print_exc()
+
+
+class EditorAPI:
+    """The calls plugins make on the editor; the windowed editor adds the text area ones"""
+
+    def __init__(self, editor):
+        self.editor = editor
+        # (name, value) pairs, oldest first; bounded in case nobody polls
+        self.event = deque(maxlen=100)
+        # Set by the PluginManager, plugin threads queue their UI calls on it
+        self.runner = None
+
+    def update_event(self, name, value):
+        """Queue an event with a name and value for plugins that poll pop_event"""
+        self.event.append((name, value))
+
+    def pop_event(self):
+        """Clear the oldest event after it is handled"""
+        if not self.event:
+            raise KeyError("pop_event(): no events")
+        return self.event.popleft()
+
+    def subscribe(self, kinds, callback, filter=None):
+        """Get batches of editor events, see EventBus. Returns a handle for unsubscribe"""
+        return self.editor.events.subscribe(kinds, callback, filter)
+
+    def unsubscribe(self, subscription):
+        self.editor.events.unsubscribe(subscription)
+    
+    def call_on_ui(self, function, *args):
+        """Run a UI-touching call now, or queue it for the mainloop when a plugin thread makes it"""
+        job = self.runner.current_job() if self.runner else None
+        if job is None:
+            return function(*args)
+        job.check()
+        job.queued += 1
+        self.runner.ui_calls.put((job, function, args))
+
+    def read_on_ui(self, function, *args):
+        """Make a reading call on the UI thread, as Tk is not thread-safe, and wait for what it returns"""
+        job = self.runner.current_job() if self.runner else None
+        if job is None:
+            return function(*args)
+        job.check()
+        result = Future()
+
+        def read():
+            try:
+                result.set_result(function(*args))
+            except Exception as e:
+                result.set_exception(e)
+        job.queued += 1
+        self.runner.ui_calls.put((job, read, ()))
+        while True:
+            try:
+                return result.result(timeout=0.05)
+            except FutureTimeout:
+                # A cancelled job's queued calls are dropped, so this is where it finds out
+                job.check()
+
+    def check_cancelled(self):
+        job = self.runner.current_job() if self.runner else None
+        if job is not None:
+            job.check()
+
+    def get_text(self):
+        return self.read_on_ui(self.editor.get_text)
+    
+    def set_text(self, text):
+        self.call_on_ui(self.editor.set_text, text)
+
+    def get_file_path(self):
+        return self.editor.file_path
+
+    def find_files(self, query, limit=50):
+        """Absolute paths of the workspace files best matching a fuzzy `query`, see WorkspaceIndex"""
+        self.check_cancelled()
+        workspace = self.editor.workspace
+        return workspace.find_files(query, limit) if workspace is not None else []
+
+    def find_symbols(self, query, limit=50):
+        """(name, kind, absolute path, 1-based line) of the workspace symbols best matching `query`"""
+        self.check_cancelled()
+        workspace = self.editor.workspace
+        return workspace.find_symbols(query, limit) if workspace is not None else []
+
+
+class PluginJob:
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.started = None
+        self.cancelled = threading.Event()
+        self.future = None
+        # UI calls the job queued and the ones the UI thread took, each counted by one thread only
+        self.queued = 0
+        self.applied = 0
+
+    def over_budget(self):
+        return self.started is not None and time.perf_counter() - self.started > self.budget
+
+    def check(self):
+        if self.cancelled.is_set() or self.over_budget():
+            self.cancelled.set()
+            raise PluginCancelled(self.name)
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def settled(self):
+        """Done running, with every UI call it queued applied or dropped"""
+        return self.future is not None and self.future.done() and self.applied == self.queued
+
+
+class PluginRunner:
+    """Runs plugin code on a thread pool with a time budget per plugin.
+
+    Python threads can't be killed, so cancelling is cooperative: once a job
+    is cancelled or over its budget, its next EditorAPI call raises
+    PluginCancelled and the UI calls it still had queued are dropped. UI calls
+    from plugin threads wait in `ui_calls` until the mainloop applies them in
+    batches.
+    """
+
+    def __init__(self, max_workers=4, budget=2.0, batch_size=200):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="plugin")
+        self.budget = budget
+        self.batch_size = batch_size
+        self.ui_calls = queue.Queue()
+        self.jobs = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # plugin name -> {"runs", "last", "max", "total", "timeouts", "errors"}
+        self.stats = {}
+
+    def submit(self, name, function, *args, budget=None):
+        job = PluginJob(name, self.budget if budget is None else budget)
+        job.future = self.executor.submit(self.call, job, function, args)
+        self.jobs.append(job)
+        return job
+
+    def call(self, job, function, args):
+        self.local.job = job
+        job.started = time.perf_counter()
+        outcome = None
+        try:
+            function(*args)
+        except PluginCancelled:
+            outcome = "timeouts"
+        except Exception:
+            outcome = "errors"
+            traceback.print_exc()
+        finally:
+            self.local.job = None
+        elapsed = time.perf_counter() - job.started
+        self.record(job.name, elapsed, outcome)
+        if PROFILER.enabled:
+            PROFILER.record(f"plugin:{job.name}", elapsed)
+
+    def record(self, name, elapsed, outcome):
+        with self.lock:
+            stats = self.stats.setdefault(name, {"runs": 0, "last": 0.0, "max": 0.0, "total": 0.0,
+                                                 "timeouts": 0, "errors": 0})
+            stats["runs"] += 1
+            stats["last"] = elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            stats["total"] += elapsed
+            if outcome:
+                stats[outcome] += 1
+
+    def current_job(self):
+        return getattr(self.local, "job", None)
+
+    def busy(self):
+        self.jobs = [job for job in self.jobs if not job.future.done()]
+        return bool(self.jobs) or not self.ui_calls.empty()
+
+    def pump(self):
+        """Cancel jobs over budget and apply one batch of queued UI calls, on the UI thread"""
+        for job in self.jobs:
+            if job.over_budget():
+                job.cancel()
+        for _ in range(self.batch_size):
+            try:
+                job, function, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            job.applied += 1
+            if not job.cancelled.is_set():
+                function(*args)
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+
+class PluginManager:
+    """Discovers plugins without importing them and activates each on its triggers.
+
+    A plugin declares when it should be imported and run, either with a
+    module-level ACTIVATION_EVENTS list or an "activation_events" list in
+    plugins/<name>.json:
+
+        "startup"           run while the editor starts (the default)
+        "extension:<ext>"   run when a file with that extension is opened
+        "key:<sequence>"    run the first time the key is pressed in the text area
+        "command:<label>"   add <label> to the Extensions menu, run when picked
+
+    A plugin whose `run` needs longer than the runner's default budget can ask
+    for its own, in seconds, with a module-level TIME_BUDGET number or a
+    "time_budget" in its JSON manifest.
+
+    Discovery results are cached in plugins/.plugin_cache.json and only
+    re-read for plugin files whose mtime or size changed.
+
+    Without a window, key and command triggers are only recorded and nothing
+    pumps the runner; call `drain` to apply queued UI calls. gvim.py subclasses
+    this to hook the triggers into the text area, menu and mainloop.
+    """
+
+    api_class = EditorAPI
+
+    def __init__(self, editor):
+        self.editor = editor
+        self.plugins = []
+        self.toggled_off_plugins = []
+        self.plugin_dir = "plugins"
+        self.cache_path = os.path.join(self.plugin_dir, ".plugin_cache.json")
+        # plugin name -> {"path", "stamp", "activation"}
+        self.manifests = {}
+        self.activated = set()
+        # key sequence or menu label -> plugin name, for editors that don't hook them up
+        self.key_triggers = {}
+        self.commands = {}
+        self.api = self.api_class(editor)
+        self.runner = PluginRunner()
+        self.api.runner = self.runner
+        self.pump_job = None
+        # (job, key) of plugins activated by a key, replayed once the job's bindings are in place
+        self.replays = []
+
+    def install_plugin(self, path):
+        with open(path, 'r') as p, open(f'plugins/{path}', 'w') as f: 
+            f.write(p.read())
+            self.load_plugin(f'plugins/{path}')
+
+    @PROFILER.timed("load_plugins")
+    def load_plugins(self):
+        if not os.path.exists(self.plugin_dir):
+            os.makedirs(self.plugin_dir)
+
+        self.discover()
+        for name, manifest in self.manifests.items():
+            for event in manifest["activation"]:
+                kind, _, argument = event.partition(":")
+                if kind == "startup":
+                    self.load_plugin(manifest["path"])
+                    self.activated.add(name)
+                elif kind == "key":
+                    self.bind_key_trigger(name, argument)
+                elif kind == "command":
+                    self.add_command_trigger(name, argument)
+
+    def bind_key_trigger(self, name, key):
+        self.key_triggers[key] = name
+
+    def add_command_trigger(self, name, label):
+        self.commands[label] = name
+
+    def replay_key(self, key):
+        """Hand a trigger key press to the bindings the plugin just made"""
+
+    def schedule(self, delay_ms, callback):
+        """Run `callback` on the UI thread later; returns a job handle, None when there is no mainloop"""
+        return None
+
+    def discover(self):
+        """Read every plugin's activation events, reusing the cache for unchanged files"""
+        try:
+            with open(self.cache_path, "r") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            cache = {}
+        manifests = {}
+        for file in sorted(os.listdir(self.plugin_dir)):
+            if not file.endswith(".py"):
+                continue
+            name = os.path.splitext(file)[0]
+            path = os.path.join(self.plugin_dir, file)
+            manifest_path = os.path.join(self.plugin_dir, f"{name}.json")
+            stamp = [self.file_stamp(path), self.file_stamp(manifest_path)]
+            cached = cache.get(name)
+            if cached and cached["stamp"] == stamp and "budget" in cached:
+                manifests[name] = cached
+            else:
+                try:
+                    metadata = self.read_metadata(path, manifest_path)
+                except (OSError, SyntaxError, ValueError, TypeError, AttributeError):
+                    # One broken plugin is left out, the editor still starts
+                    traceback.print_exc()
+                    continue
+                manifests[name] = dict(metadata, path=path, stamp=stamp)
+        if manifests != cache:
+            try:
+                with open(self.cache_path, "w") as file:
+                    json.dump(manifests, file)
+            except OSError:
+                pass
+        self.manifests = manifests
+
+    def file_stamp(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return [info.st_mtime, info.st_size]
+
+    def read_metadata(self, path, manifest_path):
+        """Find the activation events and time budget by parsing, not importing, the plugin; raises for a broken one"""
+        activation = budget = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                manifest = json.load(file)
+            activation = manifest.get("activation_events")
+            budget = manifest.get("time_budget")
+        with open(path, "r") as file:
+            tree = ast.parse(file.read(), path)
+        for node in tree.body:
+            if not isinstance(node, ast.Assign):
+                continue
+            names = {target.id for target in node.targets if isinstance(target, ast.Name)}
+            if activation is None and "ACTIVATION_EVENTS" in names:
+                try:
+                    activation = list(ast.literal_eval(node.value))
+                except ValueError:
+                    pass
+            elif budget is None and "TIME_BUDGET" in names:
+                budget = ast.literal_eval(node.value)
+        if activation is not None and not (isinstance(activation, list)
+                                           and all(isinstance(event, str) for event in activation)):
+            raise TypeError(f"{path}: activation events must be a list of strings")
+        if budget is not None and (isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget <= 0):
+            raise ValueError(f"{path}: the time budget must be a positive number of seconds")
+        return {"activation": activation or ["startup"], "budget": budget}
+
+    def activate(self, name):
+        """Import and run a plugin the first time one of its triggers fires"""
+        if name in self.activated:
+            return False
+        self.activated.add(name)
+        module = self.load_plugin(self.manifests[name]["path"])
+        if module is not None:
+            return self.run_plugin(module) or True
+        return True
+
+    def activate_on_key(self, name, key):
+        activated = self.activate(name)
+        if isinstance(activated, PluginJob):
+            # Bindings made from the plugin's thread are queued UI calls, the key waits for them
+            self.replays.append((activated, key))
+            self.schedule_pump()
+        elif activated:
+            self.replay_key(key)
+
+    def on_file_opened(self, extension):
+        for name, manifest in self.manifests.items():
+            if f"extension:{extension}" in manifest["activation"]:
+                self.activate(name)
+
+    def run_command(self, name):
+        if not self.activate(name):
+            module = self.find_plugin(name)
+            if module is not None:
+                self.run_plugin(module)
+
+    def find_plugin(self, name):
+        for plugin in self.plugins:
+            if plugin.__name__ == name:
+                return plugin
+        return None
+
+    def load_plugin(self, plugin_path):
+        plugin_name = os.path.splitext(os.path.basename(plugin_path))[0]
+        spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if hasattr(module, "run"):
+            self.plugins.append(module)
+            return module
+        return None
+
+    @PROFILER.timed("execute_plugins")
+    def execute_plugins(self):
+        for plugin in self.plugins:
+            self.run_plugin(plugin)
+
+    def run_plugin(self, plugin):
+        """Run a plugin's `run` on the thread pool unless it is toggled off"""
+        if plugin in self.toggled_off_plugins:
+            return None
+        budget = self.manifests.get(plugin.__name__, {}).get("budget")
+        job = self.runner.submit(plugin.__name__, plugin.run, self.api, budget=budget)
+        self.schedule_pump()
+        return job
+
+    def schedule_pump(self):
+        if self.pump_job is None:
+            self.pump_job = self.schedule(16, self.pump)
+
+    def pump(self):
+        self.pump_job = None
+        self.runner.pump()
+        for job, key in [replay for replay in self.replays if replay[0].settled()]:
+            self.replays.remove((job, key))
+            self.replay_key(key)
+        if self.runner.busy() or self.replays:
+            self.pump_job = self.schedule(16, self.pump)
+
+    def drain(self, timeout=None):
+        """Pump the runner until every plugin job is done, for editors without a mainloop"""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.runner.busy() or self.replays:
+            self.pump()
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def format_stats(self, plugin):
+        stats = self.runner.stats.get(plugin.__name__)
+        if not stats:
+            return "not run yet"
+        text = f"{stats['runs']} runs, last {stats['last'] * 1000:.0f} ms, max {stats['max'] * 1000:.0f} ms"
+        if stats["timeouts"]:
+            text += f", {stats['timeouts']} over budget"
+        if stats["errors"]:
+            text += f", {stats['errors']} errors"
+        return text
+
+
+class CompiledGrammar:
+    """Syntax rules merged into one regex so a buffer is tokenized in a single pass.
+
+    Every rule becomes a named group of one alternation in priority order, so
+    when two rules match at the same spot the higher priority one wins.
+    """
+
+    # (absolute path, mtime) -> CompiledGrammar
+    cache = {}
+    BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+    def __init__(self, rules, merge=None):
+        """`merge` says whether the rules are known to merge into one regex, as a GrammarCache entry does"""
+        self.rules = sorted(rules, key=lambda x: x.get("priority", 0), reverse=True)
+        # Each rule compiled on its own, left for later when the merged regex is known to work
+        self.pattern_list = None
+        # Rule indices the guard took out of the merged regex or switched off, see RuleProfiler
+        self.demoted = set()
+        self.disabled = set()
+        self.profiler = None
+        self.probed = False
+        # Set by load: the hash of the grammar file, and what RuleProfiler.probe found,
+        # rule index -> seconds over the sample or None for a rule that got stuck
+        self.digest = None
+        self.timings = None
+        # Seconds per character of the merged scan it is worth splitting up to find a slow rule
+        self.tolerated = 0.0
+        if merge is None:
+            self.compile_patterns()
+            # Numbered backreferences would point at the wrong group once merged
+            merge = bool(self.rules) and not any(self.BACKREFERENCE.search(rule["pattern"]) for rule in self.rules)
+        # wrapping group number -> rule index
+        self.combined, self.group_rules = self.merge_rules(range(len(self.rules))) if merge else (None, {})
+        # What scan uses, replaced as a whole when rules are demoted since the tokenizer thread reads it too
+        self.active = (self.combined, self.group_rules)
+
+    def merge_rules(self, indices):
+        """One regex with a named group for each rule at `indices`, or None when they do not merge"""
+        if not indices:
+            return None, {}
+        try:
+            combined = re.compile("|".join(f"(?P<_r{i}>{self.rules[i]['pattern']})" for i in indices), re.MULTILINE)
+        except re.error:
+            # e.g. two rules using the same group name, scan them one by one instead
+            return None, {}
+        return combined, {combined.groupindex[f"_r{i}"]: i for i in indices}
+
+    @property
+    def patterns(self):
+        if self.pattern_list is None:
+            self.compile_patterns()
+        return self.pattern_list
+
+    def compile_patterns(self):
+        self.pattern_list = [re.compile(rule["pattern"], re.MULTILINE) for rule in self.rules]
+
+    @staticmethod
+    def check(rules):
+        """Messages for every rule that could not highlight, empty when all of them can"""
+        if not isinstance(rules, list):
+            return ["'rules' is not a list"]
+        problems = []
+        for i, rule in enumerate(rules):
+            if not isinstance(rule, dict) or not isinstance(rule.get("pattern"), str):
+                problems.append(f"rule {i}: no pattern")
+                continue
+            if not isinstance(rule.get("color"), str):
+                problems.append(f"rule {i} ({rule['pattern']}): no color")
+            if not isinstance(rule.get("priority", 0), (int, float)):
+                problems.append(f"rule {i} ({rule['pattern']}): priority is not a number")
+            try:
+                re.compile(rule["pattern"], re.MULTILINE)
+            except re.error as e:
+                problems.append(f"rule {i} ({rule['pattern']}): {e}")
+        return problems
+
+    @classmethod
+    def load(cls, file_path, disk_cache=None):
+        """The grammar in a file, from memory while the file is unchanged, else from `disk_cache` by content"""
+        path = os.path.abspath(file_path)
+        key = (path, os.path.getmtime(path))
+        grammar = cls.cache.get(key)
+        if grammar is None:
+            with open(path, "rb") as file:
+                data = file.read()
+            digest = GrammarCache.digest(data)
+            entry = disk_cache.get(digest) if disk_cache is not None else None
+            if entry is not None:
+                grammar = cls(entry["rules"], entry["merge"])
+            else:
+                grammar = cls(json.loads(data)["rules"])
+                if disk_cache is not None:
+                    disk_cache.put(digest, grammar)
+                    disk_cache.save()
+            grammar.digest = digest
+            cls.cache = {k: v for k, v in cls.cache.items() if k[0] != path}
+            cls.cache[key] = grammar
+        return grammar
+
+    def demote(self, rule_index):
+        """Take a rule out of the merged regex and have it scan only the lines being painted"""
+        self.demoted.add(rule_index)
+        self.remerge()
+
+    def disable(self, rule_index):
+        self.disabled.add(rule_index)
+        self.remerge()
+
+    def remerge(self):
+        if self.combined is not None:
+            self.active = self.merge_rules([i for i in range(len(self.rules))
+                                            if i not in self.demoted and i not in self.disabled])
+
+    def separate_rules(self):
+        """Indices of the rules scanned one by one rather than in the merged regex"""
+        rules = self.demoted if self.combined is not None else range(len(self.rules))
+        # Set operations, not a loop, as the tokenizer thread may be scanning while the guard adds to them
+        return sorted(set(rules) - self.disabled)
+
+    def scan(self, text, limit):
+        """Yield (rule_index, start, end) for every match starting before `limit`"""
+        profiler = self.profiler
+        recording = profiler is not None and profiler.recording
+        if recording:
+            # Time every merged rule on its own so each gets its exact share, but
+            # keep the matches of the merged regex: where rules overlap they differ
+            for rule_index in set(self.active[1].values()):
+                self.scan_rule(rule_index, text, limit, profiler)
+        combined, group_rules = self.active
+        # Taken now: a rule the merged scan below blames already has its matches in it
+        separate = self.separate_rules()
+        if combined is not None:
+            started = time.perf_counter()
+            matches = []
+            for match in combined.finditer(text):
+                if match.start() >= limit:
+                    break
+                matches.append((group_rules[match.lastindex], match.start(), match.end()))
+            elapsed = time.perf_counter() - started
+            if (profiler is not None and not recording and profiler.over_budget(elapsed)
+                    and elapsed > self.tolerated * len(text)):
+                # Time the rules one by one to find the ones to blame
+                guarded = len(self.demoted) + len(self.disabled)
+                for rule_index in set(group_rules.values()):
+                    self.scan_rule(rule_index, text, limit, profiler)
+                if len(self.demoted) + len(self.disabled) == guarded:
+                    # Slow as a whole rather than by any one rule, only look again if it gets much slower
+                    self.tolerated = 2 * elapsed / len(text)
+            yield from matches
+        for rule_index in separate:
+            yield from self.scan_rule(rule_index, text, limit, profiler)
+
+    def scan_rule(self, rule_index, text, limit, profiler=None):
+        """Matches of one rule starting before `limit`; a demoted rule does not look past it either"""
+        demoted = rule_index in self.demoted
+        started = time.perf_counter()
+        matches = []
+        for match in self.patterns[rule_index].finditer(text, 0, limit if demoted else len(text)):
+            if match.start() >= limit:
+                break
+            matches.append((rule_index, match.start(), match.end()))
+        if profiler is not None:
+            elapsed = time.perf_counter() - started
+            profiler.record(self.rules[rule_index]["pattern"], elapsed, len(matches))
+            if profiler.over_budget(elapsed):
+                if demoted:
+                    self.disable(rule_index)
+                else:
+                    self.demote(rule_index)
+        return matches
+
+
+def time_rules(patterns, sample, connection):
+    """Child process of RuleProfiler.probe: scan `sample` with each (index, pattern), sending (index, seconds)"""
+    # A pipe rather than a queue: a queue's feeder thread would never get the GIL back from a stuck regex
+    connection.send(None)
+    for index, pattern in patterns:
+        started = time.perf_counter()
+        for _ in re.finditer(pattern, sample, re.MULTILINE):
+            pass
+        connection.send((index, time.perf_counter() - started))
+
+
+class RuleProfiler:
+    """Time and match counts per syntax rule, and the guard that reins in rules going over budget.
+
+    Grammars with a profiler attached time their scans. While `recording`,
+    every rule is also timed on its own so each gets its exact share, though
+    the matches still come from the merged regex; otherwise the merged regex
+    is timed as a whole and only split up to find the rules to blame when it
+    takes longer than `budget`. A rule over budget is demoted:
+    it leaves the merged regex and scans only the lines being painted, not
+    the lookahead below them. A demoted rule over budget again is disabled.
+
+    Python's re cannot be stopped halfway through a match, so a pattern that
+    backtracks for minutes would hang the editor before any of that kicks
+    in. `probe` runs a new grammar over a sample of the file in a child
+    process first, which can be killed, and disables whatever gets stuck.
+    The timings it leaves in `grammar.timings` can be kept in the
+    GrammarCache, and `apply` acts on them again without a process.
+    """
+
+    # Seconds a probe process gets to start, spawning a new interpreter can be slow
+    PROBE_STARTUP = 30
+
+    def __init__(self, budget_ms=50, probe_timeout=1.0):
+        self.budget = budget_ms / 1000
+        self.probe_timeout = probe_timeout
+        self.recording = False
+        # pattern -> [seconds, matches, scans, slowest scan]
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def over_budget(self, seconds):
+        return bool(self.budget) and seconds > self.budget
+
+    def record(self, pattern, seconds, matches):
+        with self.lock:
+            entry = self.stats.setdefault(pattern, [0.0, 0, 0, 0.0])
+            entry[0] += seconds
+            entry[1] += matches
+            entry[2] += 1
+            entry[3] = max(entry[3], seconds)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def report(self, grammar, count=10):
+        """The `count` rules of `grammar` that took the longest, slowest first"""
+        rows = []
+        with self.lock:
+            for i, rule in enumerate(grammar.rules):
+                seconds, matches, scans, slowest = self.stats.get(rule["pattern"], (0.0, 0, 0, 0.0))
+                state = "disabled" if i in grammar.disabled else "demoted" if i in grammar.demoted else "ok"
+                rows.append({"pattern": rule["pattern"], "ms": seconds * 1000, "matches": matches, "scans": scans,
+                             "slowest_ms": slowest * 1000, "state": state})
+        return sorted(rows, key=lambda row: row["ms"], reverse=True)[:count]
+
+    def probe(self, grammar, sample):
+        """Time every rule of `grammar` over `sample` in a child process, disabling rules that get stuck.
+
+        Blocks until done, so call it off the UI thread.
+        """
+        remaining = [(i, rule["pattern"]) for i, rule in enumerate(grammar.rules) if i not in grammar.disabled]
+        timings = {}
+        while remaining:
+            receiver, sender = SPAWN.Pipe(duplex=False)
+            process = SPAWN.Process(target=time_rules, args=(remaining, sample, sender), daemon=True)
+            process.start()
+            sender.close()
+            try:
+                if not receiver.poll(self.PROBE_STARTUP):
+                    # Could not even start; act on what is known and probe again next time
+                    self.apply(grammar, timings)
+                    grammar.probed = False
+                    return
+                receiver.recv()
+                while remaining:
+                    if not receiver.poll(self.probe_timeout):
+                        # Stuck on the next rule: drop it and go on with the rest in a new process
+                        timings[remaining.pop(0)[0]] = None
+                        break
+                    index, seconds = receiver.recv()
+                    remaining.pop(0)
+                    timings[index] = seconds
+            except EOFError:
+                # The process died, most likely of the next rule
+                timings[remaining.pop(0)[0]] = None
+            finally:
+                process.terminate()
+                process.join()
+                receiver.close()
+        self.apply(grammar, timings)
+
+    def apply(self, grammar, timings):
+        """Demote the rules of `grammar` over budget in `timings` and disable the stuck ones, as probe does"""
+        for index, seconds in dict(timings).items():
+            index = int(index)
+            if seconds is None:
+                if index not in grammar.disabled:
+                    grammar.disable(index)
+            elif self.over_budget(seconds) and index not in grammar.demoted:
+                grammar.demote(index)
+        grammar.timings = {int(index): seconds for index, seconds in dict(timings).items()}
+        grammar.probed = True
+
+
+class GrammarCache:
+    """Grammars already checked and compiled, kept on disk by a hash of their file's contents.
+
+    Python cannot store a compiled regex, so an entry keeps what compiling
+    found out: the rules in priority order and whether they merge into one
+    regex. A grammar loaded from it compiles only that one merged regex and
+    skips checking and compiling each rule. Once a grammar was probed the
+    entry also keeps its rule timings, see RuleProfiler.apply.
+    """
+
+    MAX_ENTRIES = 64
+
+    def __init__(self, path=None):
+        # Not in extensions/, writing there would make the ExtensionIndex rescan it
+        self.path = path or cache_directory("grammars.json")
+        # digest -> {"rules", "merge", "timings"}, oldest first
+        self.entries = None
+        self.changed = False
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                self.entries = json.load(file)["grammars"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def get(self, digest):
+        if self.entries is None:
+            self.load()
+        return self.entries.get(digest)
+
+    def put(self, digest, grammar):
+        if self.entries is None:
+            self.load()
+        self.entries.pop(digest, None)
+        self.entries[digest] = {"rules": grammar.rules, "merge": grammar.combined is not None}
+        if grammar.timings is not None:
+            self.entries[digest]["timings"] = {str(index): seconds for index, seconds in grammar.timings.items()}
+        while len(self.entries) > self.MAX_ENTRIES:
+            del self.entries[next(iter(self.entries))]
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            write_atomic(self.path, json.dumps({"grammars": self.entries}).encode("utf-8"))
+            self.changed = False
+        except OSError:
+            # Only a cache, grammars are compiled from their files without it
+            pass
+
+
+class SyntaxPackage:
+    """The syntaxes of a scheme package, all checked and compiled before any of them is written.
+
+    `problems` lists what is wrong with them; a package with problems should
+    not be installed at all. `write` puts the chosen grammar files in place
+    together, each through a temp file, and caches their compiled form.
+    """
+
+    def __init__(self, syntaxes):
+        # (lang, syntax, file contents, CompiledGrammar)
+        self.grammars = []
+        self.problems = []
+        if not isinstance(syntaxes, dict):
+            self.problems.append("'syntaxes' is not an object")
+            return
+        for lang, syntax_rules in syntaxes.items():
+            for i, syntax in enumerate(syntax_rules):
+                name = f"{lang} syntax {i}"
+                if not isinstance(syntax, dict) or "scope" not in syntax:
+                    self.problems.append(f"{name}: no scope")
+                    continue
+                problems = CompiledGrammar.check(syntax.get("rules"))
+                self.problems.extend(f"{name}: {problem}" for problem in problems)
+                if not problems:
+                    self.grammars.append((lang, syntax, json.dumps(syntax).encode("utf-8"),
+                                          CompiledGrammar(syntax["rules"])))
+
+    def write(self, targets, index, cache=None):
+        """Write grammars[i] contents to extensions/`name` for every (name, i) in `targets`"""
+        temp_paths = []
+        try:
+            for name, i in targets:
+                path = os.path.join(index.directory, name)
+                temp_paths.append((write_temp(path, self.grammars[i][2]), path))
+        except OSError:
+            for temp_path, path in temp_paths:
+                os.remove(temp_path)
+            raise
+        for temp_path, path in temp_paths:
+            os.replace(temp_path, path)
+        index.update_files([name for name, i in targets])
+        if cache is not None:
+            for name, i in targets:
+                cache.put(GrammarCache.digest(self.grammars[i][2]), self.grammars[i][3])
+            cache.save()
+
+
+# Read once while nothing else runs, setting the umask is the only way to read it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Worker processes start fresh: a fork would copy the Tk app and locks held by its threads
+SPAWN = multiprocessing.get_context("spawn")
+
+
+def file_mode(path):
+    """Permissions for a file written over `path`: the ones it has, or what a new file gets under the umask"""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return 0o666 & ~UMASK
+
+
+def write_temp(path, data):
+    """Write `data` to a synced temp file next to `path` and return its path"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp makes it owner-only
+        os.chmod(temp_path, file_mode(path))
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def write_atomic(path, data):
+    os.replace(write_temp(path, data), path)
+
+
+def cache_directory(*parts):
+    """Where per-user data the editor can rebuild goes, such as indexes; not created here"""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "gvim", *parts)
+
+
+class ExtensionIndex:
+    """Scope -> grammar file index for extensions/, kept on disk between runs.
+
+    Each entry remembers the mtime and size its grammar was read at, so only
+    files that changed are parsed again and lookups are a dict hit. The index
+    is saved under cache_directory, one file per extensions directory, unless
+    `index_path` says otherwise: saving it inside the directory would change
+    the directory's mtime and have the next lookup rescan everything.
+    """
+
+    def __init__(self, directory="extensions", index_path=None):
+        self.directory = directory
+        if index_path is None:
+            digest = hashlib.sha256(os.path.abspath(directory).encode("utf-8")).hexdigest()[:16]
+            index_path = cache_directory("scopes", digest + ".json")
+        self.index_path = index_path
+        # file name -> {"mtime", "size", "scope"}
+        self.entries = {}
+        # file extension -> file name
+        self.scopes = {}
+        self.directory_mtime = None
+        self.loaded = False
+
+    @staticmethod
+    def scope_names(scope):
+        if isinstance(scope, str):
+            scope = re.split(r"[\s,;|]+", scope)
+        return [name.lstrip(".") for name in scope if name]
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as file:
+                self.entries = json.load(file)["files"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+        self.loaded = True
+        self.refresh()
+
+    def ensure_current(self):
+        if not self.loaded:
+            self.load()
+        elif os.path.isdir(self.directory) and os.stat(self.directory).st_mtime != self.directory_mtime:
+            # A grammar was added or removed
+            self.refresh()
+
+    def refresh(self):
+        """Stat every grammar file and parse only the new or changed ones"""
+        if not self.loaded:
+            self.load()
+            return
+        if not os.path.isdir(self.directory):
+            self.entries, self.scopes = {}, {}
+            return
+        self.directory_mtime = os.stat(self.directory).st_mtime
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            info = entry.stat()
+            cached = self.entries.get(entry.name)
+            if cached and cached["mtime"] == info.st_mtime and cached["size"] == info.st_size:
+                entries[entry.name] = cached
+            else:
+                entries[entry.name] = self.read_entry(entry.path, info)
+        changed = entries != self.entries
+        self.entries = entries
+        self.rebuild()
+        if changed:
+            self.save()
+
+    def read_entry(self, path, info):
+        try:
+            with open(path, "r") as file:
+                scope = json.load(file).get("scope", [])
+        except (OSError, ValueError, AttributeError):
+            scope = []
+        return {"mtime": info.st_mtime, "size": info.st_size, "scope": scope}
+
+    def rebuild(self):
+        self.scopes = {}
+        for name in sorted(self.entries):
+            for scope in self.scope_names(self.entries[name]["scope"]):
+                self.scopes.setdefault(scope, name)
+
+    def update_file(self, name):
+        """Re-index one grammar file after it was written"""
+        self.update_files([name])
+
+    def update_files(self, names):
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                self.entries[name] = self.read_entry(path, os.stat(path))
+            else:
+                self.entries.pop(name, None)
+        self.directory_mtime = os.stat(self.directory).st_mtime
+        self.rebuild()
+        self.save()
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump({"files": self.entries}, file)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            # The index is only a cache, the next run rebuilds it
+            pass
+
+    def lookup(self, extension):
+        """Return the path of the grammar whose scope lists `extension`, or None"""
+        self.ensure_current()
+        name = self.scopes.get(extension)
+        if name is None:
+            return None
+        path = os.path.join(self.directory, name)
+        entry = self.entries[name]
+        try:
+            info = os.stat(path)
+        except OSError:
+            self.update_file(name)
+            return self.lookup(extension)
+        if entry["mtime"] != info.st_mtime or entry["size"] != info.st_size:
+            self.update_file(name)
+            if self.scopes.get(extension) != name:
+                return self.lookup(extension)
+        return path
+
+    def files_with_scope(self, scope):
+        self.ensure_current()
+        return [name for name in sorted(self.entries) if self.entries[name]["scope"] == scope]
+
+
+class ThemeRegistry:
+    """Theme names come from a cached manifest and a theme is only parsed when selected.
+
+    Parsed themes and the colors derived from their backgrounds are kept in
+    small LRU caches; a cached theme is parsed again once its file's mtime or
+    size changes.
+    """
+
+    def __init__(self, directory="themes", builtin=None, cache_size=8):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, ".manifest.json")
+        # Schemes that are not files, such as "default"
+        self.builtin = builtin or {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # theme name -> file name
+        self.files = None
+        self.directory_mtime = None
+
+    def names(self):
+        self.ensure_current()
+        return list(self.builtin) + [name for name in self.files if name not in self.builtin]
+
+    def ensure_current(self):
+        if not os.path.isdir(self.directory):
+            self.files = {}
+        elif self.files is None or os.stat(self.directory).st_mtime != self.directory_mtime:
+            self.refresh()
+
+    def refresh(self):
+        """Reload the name list, from the manifest when the directory did not change"""
+        self.directory_mtime = os.stat(self.directory).st_mtime
+        try:
+            with open(self.manifest_path, "r") as file:
+                manifest = json.load(file)
+            if manifest["mtime"] == self.directory_mtime:
+                self.files = manifest["files"]
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        self.files = {theme.split(".")[0]: theme for theme in sorted(os.listdir(self.directory))
+                      if theme.endswith(".json") and not theme.startswith(".")}
+        self.save_manifest()
+
+    def save_manifest(self):
+        try:
+            # Rewritten in place so only creating it changes the directory mtime
+            with open(self.manifest_path, "w") as file:
+                json.dump({"mtime": self.directory_mtime, "files": self.files}, file)
+        except OSError:
+            pass
+
+    def get(self, name):
+        """Return the parsed theme called `name`, or None"""
+        if name in self.builtin:
+            return self.builtin[name]
+        if name in self.cache:
+            path, stamp, theme = self.cache[name]
+            # A theme edited in place keeps its name, so the file has to be unchanged too
+            if self.stamp(path) == stamp:
+                self.cache.move_to_end(name)
+                return theme
+        self.ensure_current()
+        if name not in self.files:
+            return None
+        path = os.path.join(self.directory, self.files[name])
+        stamp = self.stamp(path)
+        with open(path, "r") as file:
+            theme = json.load(file)
+        self.cache[name] = (path, stamp, theme)
+        self.cache.move_to_end(name)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return theme
+
+    @staticmethod
+    def stamp(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def invalidate(self, name):
+        """Forget a theme whose file was (re)written"""
+        self.cache.pop(name, None)
+        self.files = None
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def palette(background):
+        """Colors derived from a theme background, computed once per background"""
+        return {
+            "window_background": ThemeRegistry.shift_color(background, 7),
+            "field_background": ThemeRegistry.shift_color(background, 7),
+            "select_background": ThemeRegistry.shift_color(background, 5),
+        }
+
+    @staticmethod
+    def shift_color(color, shift):
+        color = color.lstrip("#")
+        rgb = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
+        new_rgb = tuple(max(0, min(255, c + shift)) for c in rgb)
+        return f"#{new_rgb[0]:02x}{new_rgb[1]:02x}{new_rgb[2]:02x}"
+
+
+class SyntaxHighlighter:
+    """Incremental highlighter that only re-tokenizes the lines touched by edits.
+
+    For every line it remembers which rules have a match running past the end
+    of that line (the end-of-line state), so multi-line tokens such as block
+    comments keep spreading until the state settles again. Lines that still
+    need tokenizing are kept as pending ranges, which the editor works through
+    viewport first.
+    """
+
+    NEWLINE = re.compile("\n")
+
+    def __init__(self, rules=None, sync_lines=200, lookahead=2000):
+        self.grammar = None
+        self.rules = []
+        # Lines re-scanned above an edit so openers like "/*" without a state are found
+        self.sync_lines = sync_lines
+        # Extra lines handed to the regexes so matches can run past the dirty range,
+        # this is also the longest multi-line token that can be found
+        self.lookahead = lookahead
+        # None = never tokenized, () = no token open at the end of the line
+        self.line_states = [None]
+        # Sorted, non-overlapping (first, last) line ranges still to tokenize
+        self.pending = []
+        self.set_rules(rules or [])
+
+    def set_rules(self, rules):
+        self.set_grammar(CompiledGrammar(rules))
+
+    def set_grammar(self, grammar):
+        self.grammar = grammar
+        self.rules = grammar.rules
+        self.invalidate_all()
+
+    def invalidate_all(self):
+        self.line_states = [None] * len(self.line_states)
+        self.pending = [(0, len(self.line_states) - 1)]
+
+    def resize(self, line_count):
+        if len(self.line_states) != line_count:
+            self.line_states = [None] * line_count
+            self.invalidate_all()
+
+    def on_edit(self, line, removed, added):
+        """Record an edit starting at 0-based `line` that removed and added line breaks"""
+        # The last edited line keeps the old end state so the next pass can tell if it settled
+        end_state = self.line_states[min(line + removed, len(self.line_states) - 1)]
+        self.line_states[line:line + removed + 1] = [None] * added + [end_state]
+        delta = added - removed
+        shifted = []
+        for first, last in self.pending:
+            if first > line:
+                first = max(line, first + delta)
+            if last > line:
+                last = max(line, last + delta)
+            shifted.append((first, last))
+        self.pending = shifted
+        self.add_pending(line, line + added)
+
+    def add_pending(self, first, last):
+        merged = []
+        for a, b in sorted(self.pending + [(first, last)]):
+            if merged and a <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+            else:
+                merged.append((a, b))
+        self.pending = merged
+
+    def take_pending(self, first, last):
+        """Remove first..last from the pending ranges and return the parts that were pending"""
+        taken, remaining = [], []
+        for a, b in self.pending:
+            if b < first or a > last:
+                remaining.append((a, b))
+                continue
+            if a < first:
+                remaining.append((a, first - 1))
+            if b > last:
+                remaining.append((last + 1, b))
+            taken.append((max(a, first), min(b, last)))
+        self.pending = remaining
+        return taken
+
+    def tokenize(self, text, limit):
+        """Return the matches starting before `limit` and the end-of-line state of each line"""
+        newlines = [m.start() for m in self.NEWLINE.finditer(text, 0, limit)]
+        states = [set() for _ in newlines]
+        matches = []
+        for rule_index, start, end in self.grammar.scan(text, limit):
+            if end == start:
+                continue
+            matches.append((rule_index, start, end))
+            # Every line break the token runs past carries it into the next line
+            for line in range(bisect_left(newlines, start), bisect_left(newlines, end - 1)):
+                states[line].add(rule_index)
+        return matches, [tuple(sorted(state)) for state in states]
+
+    def highlight_lines(self, get_text, line_count, first, last, deadline=None):
+        """Tokenize whatever is pending in lines first..last and return the regions to paint.
+
+        `get_text(first, last)` returns lines first..last (0-based, inclusive),
+        each terminated by a newline. Each region is (first, last, matches) with
+        match offsets relative to the start of line `first`.
+        """
+        self.resize(line_count)
+        last = min(last, line_count - 1)
+        return [self.tokenize_range(get_text, line_count, a, b, deadline)
+                for a, b in self.take_pending(max(0, first), last)]
+
+    def highlight_next(self, get_text, line_count, near, chunk_lines, deadline=None):
+        """Tokenize one chunk of the pending range closest to line `near`"""
+        self.resize(line_count)
+        if not self.pending:
+            return None
+        first, last = min(self.pending, key=lambda r: 0 if r[0] <= near <= r[1]
+                          else min(abs(r[0] - near), abs(r[1] - near)))
+        if last < near:
+            first = max(first, last - chunk_lines + 1)
+        else:
+            first = max(first, min(near, last))
+            last = min(last, first + chunk_lines - 1)
+        self.take_pending(first, last)
+        return self.tokenize_range(get_text, line_count, first, last, deadline)
+
+    def tokenize_range(self, get_text, line_count, first, last, deadline=None):
+        # Start on a line that no known token runs into
+        first = max(0, first - self.sync_lines)
+        while first > 0 and self.line_states[first - 1]:
+            first -= 1
+
+        while True:
+            text = get_text(first, min(line_count - 1, last + self.lookahead))
+            limit = self.line_end_offset(text, last - first)
+            matches, states = self.tokenize(text, limit)
+            # Lines below that were never tokenized are still pending, so () or None is fine
+            settled = states[-1] == () and not self.line_states[last]
+            self.line_states[first:last + 1] = states
+            if settled or last >= line_count - 1:
+                return first, last, matches
+            if deadline is not None and time.perf_counter() > deadline:
+                # Out of time: leave the rest of the spreading token to a later pass
+                self.add_pending(last + 1, last + 1)
+                return first, last, matches
+            # The state changed at the end of the range, so keep going further down
+            extended = min(line_count - 1, last + max(self.lookahead, last - first + 1))
+            self.take_pending(last + 1, extended)
+            last = extended
+
+    def line_end_offset(self, text, line):
+        offset = -1
+        for _ in range(line + 1):
+            offset = text.find("\n", offset + 1)
+            if offset == -1:
+                return len(text)
+        return offset + 1
+
+
+class TokenizerWorker:
+    """Tokenizes on a background thread from its own copy of the buffer.
+
+    The UI thread sends every edit with the new text of the lines it touched,
+    stamped with a generation number, and says which lines are on screen.
+    The worker runs a SyntaxHighlighter over its copy, visible lines first and
+    the rest nearest to them, and posts (generation, region) to `results`.
+    A region is only valid for the generation it was made at: the UI thread
+    drops older ones and hands their lines back with `retry`, so fast typing
+    never paints stale colors and the worker never falls behind on edits it
+    has queued, as it takes every request before the next slice of work.
+
+    It keeps one such copy per document, by the key given to `switch`, so
+    a document switched back to still has its line states and generation;
+    results are (key, generation, region).
+    """
+
+    def __init__(self, margin=50, chunk_lines=200, slice_ms=20):
+        self.margin = margin
+        self.chunk_lines = chunk_lines
+        self.slice_ms = slice_ms
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        # UI thread: the newest generation sent and the recent edits, to move retried lines,
+        # for the current document; documents holds them for the others by key
+        self.key = None
+        self.generation = 0
+        self.edits = deque(maxlen=1000)
+        self.documents = {}
+        # Worker thread: the buffer copy and the generation it matches, likewise
+        self.worker_key = None
+        self.highlighter = SyntaxHighlighter()
+        self.lines = [""]
+        self.worker_generation = 0
+        self.worker_documents = {}
+        self.view = (0, 0)
+        # Requests sent by the UI thread and handled by the worker, each counted by one thread only
+        self.sent = 0
+        self.handled = 0
+        self.working = False
+        self.thread = threading.Thread(target=self.work, name="tokenizer", daemon=True)
+        self.thread.start()
+
+    def edit(self, line, removed, added, text):
+        """An edit like SyntaxHighlighter.on_edit; `text` is the new lines line..line + added, each with its break"""
+        self.generation += 1
+        self.edits.append((self.generation, line, removed, added))
+        self.send("edit", self.generation, line, removed, added, text)
+
+    def reset(self, text):
+        """Replace the worker's copy of the whole buffer, lines terminated by line breaks"""
+        self.generation += 1
+        self.edits.clear()
+        self.send("reset", self.generation, text)
+
+    def switch(self, key):
+        """Work on document `key` from now on; False if it is new to the worker and wants a reset"""
+        if key is self.key:
+            return True
+        if self.key is not None:
+            self.documents[self.key] = (self.generation, self.edits)
+        known = key in self.documents
+        self.generation, self.edits = self.documents.pop(key, (0, deque(maxlen=1000)))
+        self.key = key
+        self.send("switch", key)
+        return known
+
+    def forget(self, key):
+        """Drop the copy of a closed document, or of one edited behind the worker's back"""
+        self.documents.pop(key, None)
+        if key is self.key:
+            self.key = None
+            self.edits = deque(maxlen=1000)
+        self.send("forget", key)
+
+    def set_grammar(self, grammar):
+        self.send("grammar", grammar)
+
+    def set_view(self, first, last):
+        self.send("view", first, last)
+
+    def retry(self, generation, first, last, key=None):
+        """Tokenize lines first..last of an older generation again, wherever they are now"""
+        if key is None or key is self.key:
+            key, current, edits = self.key, self.generation, self.edits
+        elif key in self.documents:
+            current, edits = self.documents[key]
+        else:
+            return
+        if generation < current and (not edits or edits[0][0] > generation + 1):
+            # The edits in between are no longer known, start over at the top
+            first, last = 0, float("inf")
+        for edit_generation, line, removed, added in edits:
+            if edit_generation > generation:
+                delta = added - removed
+                first = max(line, first + delta) if first > line else first
+                last = max(line, last + delta) if last > line else last
+        self.send("retry", first, last, key)
+
+    def send(self, *message):
+        self.sent += 1
+        self.requests.put(message)
+
+    def busy(self):
+        # A request taken off the queue but not yet handled still counts
+        return self.handled != self.sent or self.working or not self.results.empty()
+
+    def stop(self):
+        self.requests.put(("stop",))
+
+    def work(self):
+        while True:
+            pending = bool(self.highlighter.pending)
+            self.working = pending
+            try:
+                message = self.requests.get(block=not pending)
+            except queue.Empty:
+                self.tokenize_slice()
+                continue
+            self.working = True
+            if message[0] == "stop":
+                return
+            self.handle(message)
+            self.handled += 1
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == "edit":
+            self.worker_generation, line, removed, added, text = message[1:]
+            self.lines[line:line + removed + 1] = text.split("\n")[:added + 1]
+            self.highlighter.on_edit(line, removed, added)
+        elif kind == "reset":
+            self.worker_generation, text = message[1:]
+            self.lines = text.split("\n")[:-1] or [""]
+            self.highlighter.resize(len(self.lines))
+            self.highlighter.invalidate_all()
+        elif kind == "switch":
+            if self.worker_key is not None:
+                self.worker_documents[self.worker_key] = (self.highlighter, self.lines, self.worker_generation)
+            self.worker_key = message[1]
+            self.highlighter, self.lines, self.worker_generation = self.worker_documents.pop(
+                self.worker_key, (SyntaxHighlighter(), [""], 0))
+        elif kind == "forget":
+            if message[1] is self.worker_key:
+                self.worker_key = None
+                self.highlighter, self.lines = SyntaxHighlighter(), [""]
+            self.worker_documents.pop(message[1], None)
+        elif kind == "grammar":
+            if message[1] is not self.highlighter.grammar:
+                self.highlighter.set_grammar(message[1])
+                self.highlighter.resize(len(self.lines))
+        elif kind == "view":
+            self.view = message[1:]
+        elif kind == "retry":
+            first, last, key = message[1:]
+            if key is self.worker_key:
+                highlighter, lines = self.highlighter, self.lines
+            elif key in self.worker_documents:
+                highlighter, lines = self.worker_documents[key][:2]
+            else:
+                return
+            if first < len(lines):
+                highlighter.add_pending(max(0, first), min(last, len(lines) - 1))
+
+    def get_lines(self, first, last):
+        return "\n".join(self.lines[first:last + 1]) + "\n"
+
+    def tokenize_slice(self):
+        """Tokenize pending lines on screen, or else the chunk nearest to them, and post the regions"""
+        line_count = len(self.lines)
+        first, last = self.view
+        deadline = time.perf_counter() + self.slice_ms / 1000
+        regions = self.highlighter.highlight_lines(self.get_lines, line_count, first - self.margin,
+                                                   last + self.margin, deadline)
+        if not regions:
+            regions = [self.highlighter.highlight_next(self.get_lines, line_count, (first + last) // 2,
+                                                       self.chunk_lines, deadline)]
+        for region in regions:
+            if region is not None:
+                self.results.put((self.worker_key, self.worker_generation, region))
+
+
+class LineIndex:
+    """Start offset of every line of a buffer, kept up to date from edit deltas.
+
+    Line lengths, line break included, are kept in blocks of up to BLOCK
+    lines. An edit rewrites only the blocks it touches and the running totals
+    before each block are summed again on the next lookup, so offset <-> line
+    conversions are two bisects: over the block totals, then within a block.
+    Plugin threads read it through EditorAPI, so every public call holds `lock`.
+    """
+
+    BLOCK = 512
+
+    def __init__(self):
+        # A buffer always holds at least one line, Tk counts its closing line break
+        self.blocks = [[1]]
+        # Offsets of each line within its block, None until a lookup needs them
+        self.starts = [None]
+        # Lines and characters before each block, valid up to block `stale`
+        self.lines_before = [0]
+        self.chars_before = [0]
+        self.stale = 0
+        self.lock = threading.RLock()
+
+    def reset(self, text):
+        """Index `text`, every line terminated by a line break"""
+        with self.lock:
+            self.build(text)
+
+    def build(self, text):
+        lengths = [len(line) + 1 for line in text.split("\n")[:-1]] or [1]
+        self.blocks = [lengths[i:i + self.BLOCK] for i in range(0, len(lengths), self.BLOCK)]
+        self.starts = [None] * len(self.blocks)
+        self.lines_before = [0]
+        self.chars_before = [0]
+        self.stale = 0
+
+    def on_edit(self, line, removed, added, text):
+        """Lines line..line + removed became `text`, the new lines line..line + added with their breaks"""
+        lengths = [len(part) + 1 for part in text.split("\n")[:added + 1]]
+        with self.lock:
+            first, offset = self.locate(line)
+            last, end = self.locate(min(line + removed, self.lines_before[-1] - 1))
+            merged = self.blocks[first][:offset] + lengths + self.blocks[last][end + 1:]
+            blocks = [merged[i:i + self.BLOCK] for i in range(0, len(merged), self.BLOCK)] or [[1]]
+            self.blocks[first:last + 1] = blocks
+            self.starts[first:last + 1] = [None] * len(blocks)
+            self.stale = min(self.stale, first)
+
+    def refresh(self):
+        if self.stale >= len(self.blocks):
+            return
+        # Entries up to `stale` only depend on blocks that did not change; one past the last block holds the totals
+        del self.lines_before[self.stale + 1:]
+        del self.chars_before[self.stale + 1:]
+        lines, chars = self.lines_before[-1], self.chars_before[-1]
+        for block in self.blocks[self.stale:]:
+            lines += len(block)
+            chars += sum(block)
+            self.lines_before.append(lines)
+            self.chars_before.append(chars)
+        self.stale = len(self.blocks)
+
+    def block_starts(self, block):
+        starts = self.starts[block]
+        if starts is None:
+            starts, offset = [], 0
+            for length in self.blocks[block]:
+                starts.append(offset)
+                offset += length
+            self.starts[block] = starts
+        return starts
+
+    def locate(self, line):
+        """(block, line within the block) of a 0-based line"""
+        self.refresh()
+        block = bisect_right(self.lines_before, line, 0, len(self.blocks)) - 1
+        return block, line - self.lines_before[block]
+
+    def line_count(self):
+        with self.lock:
+            self.refresh()
+            return self.lines_before[-1]
+
+    def char_count(self):
+        with self.lock:
+            self.refresh()
+            return self.chars_before[-1]
+
+    def line_start(self, line):
+        """Offset where 0-based `line` starts"""
+        with self.lock:
+            block, offset = self.locate(line)
+            return self.chars_before[block] + self.block_starts(block)[offset]
+
+    def position(self, offset):
+        """(0-based line, column) of a character offset"""
+        with self.lock:
+            self.refresh()
+            offset = max(0, min(offset, self.chars_before[-1] - 1))
+            block = bisect_right(self.chars_before, offset, 0, len(self.blocks)) - 1
+            local = offset - self.chars_before[block]
+            starts = self.block_starts(block)
+            line = bisect_right(starts, local) - 1
+            return self.lines_before[block] + line, local - starts[line]
+
+    def index(self, offset):
+        """Tk "line.column" index of a character offset"""
+        line, column = self.position(offset)
+        return f"{line + 1}.{column}"
+
+    def offset(self, index):
+        """Character offset of a Tk "line.column" index"""
+        line, column = index.split(".")
+        return self.line_start(int(line) - 1) + int(column)
+
+
+class UndoJournal:
+    """Undo/redo history of compact edit deltas, capped in memory and backed by a swap file.
+
+    A delta is (index, removed, inserted) with index a "line.column" position
+    in document lines; runs of typing or backspacing merge into one delta.
+    Once the history in memory passes `max_bytes`, the oldest undo groups are
+    appended to the swap file next to the edited file and read back only if
+    undo reaches them. Every edit is appended there as well, numbered, and a
+    save appends a marker with the file's stamp and the last edit it holds,
+    so after a crash `recover` finds the edits the file on disk is missing.
+
+    Appends are buffered: the editor calls `flush` within FLUSH_SECONDS of
+    an edit, a save marker is flushed at once. Once the swap file has grown
+    to twice its size after the last `compact` plus `max_bytes`, it is
+    rewritten with only the steps still spilled and the edits since the save.
+    """
+
+    MERGE_SECONDS = 1.0
+    FLUSH_SECONDS = 1.0
+    # Rough bookkeeping cost of a delta on top of its text
+    DELTA_OVERHEAD = 64
+
+    def __init__(self, max_bytes=1 << 20):
+        self.max_bytes = max_bytes
+        # Groups of deltas, oldest first; the groups beyond both ends are in the swap file,
+        # at the offsets in spilled and spilled_redo
+        self.undo = []
+        self.redo = []
+        self.size = 0
+        self.spilled = []
+        self.spilled_redo = []
+        self.swap = None
+        self.swap_path = None
+        # Bytes in the swap file, and how many were left by the last compact
+        self.swap_size = 0
+        self.compacted = 0
+        self.unflushed = False
+        self.sequence = 0
+        # Last edit the file on disk holds
+        self.saved = 0
+        self.depth = 0
+        self.merge = False
+        self.last_edit = 0.0
+
+    @staticmethod
+    def swap_path_for(path):
+        directory, name = os.path.split(os.path.abspath(path))
+        return os.path.join(directory, f".{name}.swp")
+
+    @staticmethod
+    def stamp(path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return [info.st_mtime, info.st_size]
+
+    @staticmethod
+    def advance(index, text):
+        """The index `text` ends at when it starts at `index`"""
+        line, column = map(int, index.split("."))
+        breaks = text.count("\n")
+        if breaks:
+            column = len(text) - text.rfind("\n") - 1
+            return f"{line + breaks}.{column}"
+        return f"{line}.{column + len(text)}"
+
+    @classmethod
+    def recover(cls, path):
+        """Deltas made after the last save of `path` as it is on disk now, or None"""
+        try:
+            with open(cls.swap_path_for(path), "rb") as file:
+                records = []
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A write cut short by the crash
+                        break
+        except OSError:
+            return None
+        stamp = cls.stamp(path)
+        saved = [record["n"] for record in records if "saved" in record and record["saved"] == stamp]
+        if not saved:
+            return None
+        deltas = [tuple(record["e"]) for record in records if "e" in record and record["n"] > saved[-1]]
+        return deltas or None
+
+    def start(self, path=None):
+        """Start a new history for the file at `path`, which is taken to match the buffer"""
+        self.close()
+        self.swap_path = self.swap_path_for(path) if path else None
+        try:
+            self.swap = open(self.swap_path, "w+b") if path else tempfile.TemporaryFile()
+        except OSError:
+            self.swap, self.swap_path = tempfile.TemporaryFile(), None
+        if path:
+            self.mark_saved(path)
+
+    def close(self, remove=True):
+        if self.swap is not None:
+            self.swap.close()
+            if remove and self.swap_path:
+                try:
+                    os.remove(self.swap_path)
+                except OSError:
+                    pass
+        self.swap = None
+        self.swap_path = None
+        self.swap_size = self.compacted = 0
+        self.unflushed = False
+        self.undo, self.redo, self.spilled, self.spilled_redo = [], [], [], []
+        self.size = 0
+        self.sequence = 0
+        self.saved = 0
+
+    def relocate(self, path):
+        """Move the swap file next to `path` after a save as"""
+        new_path = self.swap_path_for(path)
+        if self.swap_path is None or new_path == self.swap_path:
+            return
+        self.swap.close()
+        try:
+            os.replace(self.swap_path, new_path)
+            self.swap_path = new_path
+        except OSError:
+            pass
+        self.swap = open(self.swap_path, "r+b")
+
+    def mark_saved(self, path, sequence=None):
+        """Record that `path` now holds every edit up to `sequence`, the current one by default"""
+        self.saved = self.sequence if sequence is None else sequence
+        self.append({"saved": self.stamp(path), "n": self.saved})
+        self.flush()
+
+    def modified(self):
+        return self.sequence != self.saved
+
+    def append(self, record):
+        if self.swap is None:
+            return None
+        data = json.dumps(record).encode("utf-8") + b"\n"
+        self.swap.seek(0, os.SEEK_END)
+        offset = self.swap.tell()
+        self.swap.write(data)
+        self.swap_size = offset + len(data)
+        self.unflushed = True
+        return offset
+
+    def flush(self):
+        if self.swap is not None and self.unflushed:
+            self.swap.flush()
+            self.unflushed = False
+
+    def record(self, index, removed, inserted, history=True):
+        """Log an edit; with `history` it also becomes undoable and clears the redo history"""
+        self.sequence += 1
+        self.append({"e": [index, removed, inserted], "n": self.sequence})
+        if not history:
+            return
+        for group in self.redo:
+            self.size -= self.group_size(group)
+        self.redo, self.spilled_redo = [], []
+        now = time.monotonic()
+        delta = (index, removed, inserted)
+        merged = None
+        if self.undo and not self.depth and self.merge and now - self.last_edit < self.MERGE_SECONDS:
+            merged = self.merged(self.undo[-1][-1], delta)
+        if self.depth or merged:
+            group = self.undo[-1]
+            self.size -= self.group_size(group)
+            if merged:
+                group[-1] = merged
+            else:
+                group.append(delta)
+            self.size += self.group_size(group)
+        else:
+            self.undo.append([delta])
+            self.size += self.group_size(self.undo[-1])
+        self.merge = not self.depth and bool(inserted) != bool(removed)
+        self.last_edit = now
+        self.spill()
+
+    def merged(self, last, delta):
+        """One delta for typing or backspacing straight on from `last`, or None"""
+        index, removed, inserted = delta
+        if not removed and not last[1] and index == self.advance(last[0], last[2]):
+            return last[0], "", last[2] + inserted
+        if not inserted and not last[2]:
+            if self.advance(index, removed) == last[0]:
+                return index, removed + last[1], ""
+            if index == last[0]:
+                return index, last[1] + removed, ""
+        return None
+
+    def group_size(self, group):
+        return sum(len(removed) + len(inserted) + self.DELTA_OVERHEAD for index, removed, inserted in group)
+
+    def begin_group(self):
+        """Make every edit until the matching end_group one undo step"""
+        if self.depth == 0:
+            self.undo.append([])
+        self.depth += 1
+
+    def end_group(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if self.undo and not self.undo[-1]:
+                self.undo.pop()
+            self.separate()
+
+    def separate(self):
+        """Start a new undo step with the next edit"""
+        self.merge = False
+
+    def spill(self):
+        """Move the steps furthest from the present to the swap file until the rest fits in memory"""
+        while self.size > self.max_bytes and self.swap is not None:
+            if len(self.undo) > 1:
+                groups, spilled = self.undo, self.spilled
+            elif len(self.redo) > 1:
+                groups, spilled = self.redo, self.spilled_redo
+            else:
+                break
+            group = groups.pop(0)
+            self.size -= self.group_size(group)
+            spilled.append(self.append({"u": group}))
+        if self.swap_size > 2 * self.compacted + self.max_bytes:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the swap file with the steps still spilled, the last save marker and the edits after it"""
+        if self.swap is None:
+            return
+        spilled = set(self.spilled) | set(self.spilled_redo)
+        kept = []
+        marker = None
+        moved = {}
+        size = 0
+        offset = 0
+        self.swap.seek(0)
+        for line in self.swap:
+            if offset in spilled:
+                moved[offset] = size
+                kept.append(line)
+                size += len(line)
+            elif not line.startswith(b'{"u"'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = {}
+                if "saved" in record:
+                    marker = line
+                elif "e" in record and record["n"] > self.saved:
+                    kept.append(line)
+                    size += len(line)
+            offset += len(line)
+        if marker is not None:
+            # First, so the offsets of the steps move along with it
+            kept.insert(0, marker)
+            moved = {old: new + len(marker) for old, new in moved.items()}
+        data = b"".join(kept)
+        try:
+            if self.swap_path:
+                # Through a temp file, a crash halfway must not lose the edits since the save
+                temp_path = write_temp(self.swap_path, data)
+                try:
+                    os.replace(temp_path, self.swap_path)
+                except OSError:
+                    os.remove(temp_path)
+                    raise
+                swap = open(self.swap_path, "r+b")
+                self.swap.close()
+                self.swap = swap
+            else:
+                self.swap.seek(0)
+                self.swap.write(data)
+                self.swap.truncate()
+        except OSError:
+            # Keep appending to the old file, and only try again once it has doubled
+            self.compacted = self.swap_size
+            return
+        self.spilled = [moved[offset] for offset in self.spilled]
+        self.spilled_redo = [moved[offset] for offset in self.spilled_redo]
+        self.swap_size = self.compacted = len(data)
+        self.unflushed = False
+
+    def unspill(self, spilled, groups):
+        self.swap.seek(spilled.pop())
+        groups.append([tuple(delta) for delta in json.loads(self.swap.readline())["u"]])
+        self.size += self.group_size(groups[-1])
+
+    def take_undo(self):
+        """The newest undo step, now moved to redo; apply it backwards. None when there is nothing"""
+        if self.depth:
+            return None
+        if not self.undo and self.spilled:
+            self.unspill(self.spilled, self.undo)
+        if not self.undo:
+            return None
+        group = self.undo.pop()
+        self.redo.append(group)
+        self.separate()
+        self.spill()
+        return group
+
+    def take_redo(self):
+        if self.depth:
+            return None
+        if not self.redo and self.spilled_redo:
+            self.unspill(self.spilled_redo, self.redo)
+        if not self.redo:
+            return None
+        group = self.redo.pop()
+        self.undo.append(group)
+        self.separate()
+        self.spill()
+        return group
+
+
+class LineNumbers:
+    """Line numbers for the gutter, following the line count from edit deltas.
+
+    In the normal mode only the numbers that appeared or disappeared are
+    produced. In virtual mode just the visible window is produced and the bar
+    itself never scrolls. LineNumberGutter in gvim.py puts the text on screen.
+    """
+
+    def __init__(self, virtual=False):
+        self.virtual = virtual
+        self.line_count = 1
+        # Added to every number, used when the text area only holds part of a document
+        self.offset = 0
+        # Numbers currently in the bar: a count in normal mode, (top, bottom) in virtual mode
+        self.drawn = 0
+        self.window = None
+
+    def on_edit(self, removed, added):
+        self.line_count += added - removed
+
+    def set_virtual(self, virtual):
+        """Switch modes; returns True when the bar has to be emptied"""
+        if virtual == self.virtual:
+            return False
+        self.virtual = virtual
+        self.drawn = 0
+        self.window = None
+        return True
+
+    def set_offset(self, offset):
+        self.offset = offset
+        self.window = None
+
+    def reset(self, line_count, offset=0):
+        """Start over for another buffer; the bar has to be emptied"""
+        self.line_count = line_count
+        self.offset = offset
+        self.drawn = 0
+        self.window = None
+
+    def delta(self):
+        """Return ("append", text) or ("truncate", line) to bring the bar up to date, or None"""
+        if self.drawn == self.line_count:
+            return None
+        if self.line_count > self.drawn:
+            numbers = "\n".join(map(str, range(self.drawn + 1, self.line_count + 1)))
+            change = ("append", ("\n" if self.drawn else "") + numbers)
+        else:
+            change = ("truncate", self.line_count)
+        self.drawn = self.line_count
+        return change
+
+    def window_text(self, top, bottom):
+        """Numbers for the 1-based lines top..bottom, or None when they are already drawn"""
+        window = (top, min(bottom, self.line_count))
+        if window == self.window:
+            return None
+        self.window = window
+        return "\n".join(map(str, range(window[0] + self.offset, window[1] + self.offset + 1)))
+
+    def width(self):
+        return max(2, len(str(self.line_count + self.offset)))
+
+
+class DocumentChanged(OSError):
+    """The file under a PieceTable's mapping was rewritten in place, so its text can no longer be trusted"""
+
+
+class PieceTable:
+    """Document kept as pieces of a memory mapped file plus an append-only add buffer.
+
+    Pieces always start on a line boundary and know how many line breaks they
+    hold, so finding a line only touches the pieces before it. Lines of the
+    original file are found through a per-block line count built when mapping.
+
+    Text in and out is the file's contents, decoded: it ends with a line break
+    only when the file does, and a file ending in one has an empty last line.
+    `text`, `read` and `replace_lines` all keep to that, and so does the
+    editor's get_text, which leaves out the line break Tk adds at the end.
+
+    The file stays mapped, so it must not be rewritten in place while open;
+    replacing it through a rename is fine, the mapping keeps the old file.
+    Reads check the file's size and mtime first and raise DocumentChanged
+    rather than touch a truncated mapping, which would kill the process with
+    SIGBUS. A write racing a read can still get through that check.
+    """
+
+    BLOCK_SIZE = 1 << 16
+    WRITE_CHUNK = 1 << 20
+
+    def __init__(self):
+        self.file = None
+        self.path = None
+        # (size, mtime) of the mapped file
+        self.stamp = None
+        self.original = b""
+        self.add = bytearray()
+        # Line breaks in the original before each BLOCK_SIZE block
+        self.block_lines = [0]
+        # [buffer, start, end, line breaks, first original line (original buffer only)]
+        self.pieces = []
+        self.newline = "\n"
+        # Bumped on every change so a finished save can tell if the document moved on
+        self.generation = 0
+
+    @classmethod
+    def open(cls, path):
+        table = cls()
+        table.map(path)
+        return table
+
+    def map(self, path):
+        self.close()
+        self.file = open(path, "rb")
+        self.path = path
+        info = os.fstat(self.file.fileno())
+        size = info.st_size
+        self.stamp = (size, info.st_mtime_ns)
+        self.original = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.add = bytearray()
+        self.block_lines = [0]
+        for start in range(0, size, self.BLOCK_SIZE):
+            self.block_lines.append(self.block_lines[-1] + self.original[start:start + self.BLOCK_SIZE].count(b"\n"))
+        self.pieces = [[self.original, 0, size, self.block_lines[-1], 0]] if size else []
+        first_break = self.original.find(b"\n")
+        self.newline = "\r\n" if first_break > 0 and self.original[first_break - 1] == 13 else "\n"
+
+    def close(self):
+        if isinstance(self.original, mmap.mmap):
+            self.original.close()
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.original = b""
+
+    def changed(self):
+        if not isinstance(self.original, mmap.mmap):
+            return False
+        info = os.fstat(self.file.fileno())
+        return (info.st_size, info.st_mtime_ns) != self.stamp
+
+    def check(self):
+        if self.changed():
+            raise DocumentChanged(f"{os.path.basename(self.path)} was rewritten on disk while mapped")
+
+    def line_count(self):
+        return sum(piece[3] for piece in self.pieces) + 1
+
+    def original_line_offset(self, line):
+        if line == 0:
+            return 0
+        block = bisect_left(self.block_lines, line) - 1
+        offset = block * self.BLOCK_SIZE - 1
+        for _ in range(line - self.block_lines[block]):
+            offset = self.original.find(b"\n", offset + 1)
+        return offset + 1
+
+    def line_offset(self, piece, line):
+        """Byte offset where the piece's `line`-th line starts"""
+        buffer, start, end, lines, first_line = piece
+        if line == 0:
+            return start
+        if buffer is self.original:
+            return self.original_line_offset(first_line + line)
+        offset = start - 1
+        for _ in range(line):
+            offset = buffer.find(b"\n", offset + 1, end)
+        return offset + 1
+
+    def find(self, line):
+        """Return (piece index, byte offset) where `line` starts, (len(pieces), 0) past the end"""
+        for i, piece in enumerate(self.pieces):
+            if line <= piece[3]:
+                offset = self.line_offset(piece, line)
+                if offset < piece[2]:
+                    return i, offset
+            line -= piece[3]
+        return len(self.pieces), 0
+
+    def split(self, line):
+        """Make `line` start a piece and return that piece's index"""
+        i, offset = self.find(line)
+        if i == len(self.pieces) or offset == self.pieces[i][1]:
+            return i
+        buffer, start, end, lines, first_line = self.pieces[i]
+        before = self.count_lines(buffer, start, offset)
+        self.pieces[i:i + 1] = [[buffer, start, offset, before, first_line],
+                                [buffer, offset, end, lines - before, first_line + before]]
+        return i + 1
+
+    def count_lines(self, buffer, start, end):
+        return sum(buffer[i:min(end, i + self.BLOCK_SIZE)].count(b"\n") for i in range(start, end, self.BLOCK_SIZE))
+
+    def read(self, first, count):
+        """Return `count` lines starting at `first` as text, line breaks included"""
+        self.check()
+        i, start = self.find(first)
+        j, stop = self.find(first + count)
+        chunks = []
+        for k in range(i, min(j + 1, len(self.pieces))):
+            buffer, piece_start, piece_end = self.pieces[k][:3]
+            chunks.append(bytes(buffer[start if k == i else piece_start:stop if k == j else piece_end]))
+        return self.decode(b"".join(chunks))
+
+    def replace_lines(self, first, count, text):
+        """Replace `count` lines starting at `first` with `text`"""
+        self.check()
+        a = self.split(first)
+        b = self.split(first + count)
+        data = self.encode(text)
+        new = []
+        if data:
+            start = len(self.add)
+            self.add += data
+            new = [[self.add, start, len(self.add), data.count(b"\n"), 0]]
+        self.pieces[a:b] = new
+        self.generation += 1
+
+    def text(self):
+        """The whole document, exactly as it would be saved"""
+        return self.read(0, self.line_count())
+
+    def set_text(self, text):
+        self.replace_lines(0, self.line_count(), text)
+
+    def decode(self, data):
+        text = data.decode("utf-8", "surrogateescape")
+        return text.replace("\r\n", "\n") if self.newline == "\r\n" else text
+
+    def encode(self, text):
+        if self.newline != "\n":
+            text = text.replace("\n", self.newline)
+        return text.encode("utf-8", "surrogateescape")
+
+    def chunks(self):
+        """Snapshot the document and return (byte chunk generator, total bytes)"""
+        # The add buffer only ever grows, so the snapshot ranges stay valid while editing goes on
+        pieces = [piece[:3] for piece in self.pieces]
+
+        def generate():
+            for buffer, start, end in pieces:
+                for offset in range(start, end, self.WRITE_CHUNK):
+                    if buffer is not self.add:
+                        self.check()
+                    yield bytes(buffer[offset:min(end, offset + self.WRITE_CHUNK)])
+
+        return generate(), sum(end - start for buffer, start, end in pieces)
+
+    def swap_in(self, temp_path, path):
+        """Move a finished save over `path` and map the new file"""
+        # Windows refuses to replace a file that is still mapped
+        self.close()
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            # The temp file holds exactly this document, keep working from it
+            self.map(temp_path)
+            raise
+        self.map(path)
+
+
+class SaveWorker:
+    """Streams buffer snapshots to disk on a background thread.
+
+    The data goes to a temp file in the target's directory and is fsynced
+    before the UI thread swaps it in with os.replace, so a crash mid-save
+    never leaves a truncated file. Progress and results are posted to
+    `messages` for the UI thread to poll.
+    """
+
+    CHUNK = 1 << 20
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.thread = None
+        # Seconds from save request to the file being in place, most recent last
+        self.latencies = deque(maxlen=100)
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, path, chunks, total, binary=False, started=None):
+        started = time.perf_counter() if started is None else started
+        self.thread = threading.Thread(target=self.write, args=(path, chunks, total, binary, started), daemon=True)
+        self.thread.start()
+
+    def text_chunks(self, text):
+        return (text[i:i + self.CHUNK] for i in range(0, len(text), self.CHUNK))
+
+    def write(self, path, chunks, total, binary, started):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            written = 0
+            with os.fdopen(fd, "wb" if binary else "w") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    written += len(chunk)
+                    self.messages.put(("progress", written, total))
+                file.flush()
+                os.fsync(file.fileno())
+            # mkstemp makes it owner-only
+            os.chmod(temp_path, file_mode(path))
+        except Exception as e:
+            os.remove(temp_path)
+            self.messages.put(("error", e))
+            return
+        self.messages.put(("written", temp_path, started))
+
+    def finish(self, started):
+        self.latencies.append(time.perf_counter() - started)
+        return self.latencies[-1]
+
+
+class FileWatcher:
+    """Notices files changed on disk by polling their stat, and diffs their text against a buffer.
+
+    `watch` records the stamp a buffer's file had when it was read or
+    written; `changed` compares it with a fresh stat, which is cheap enough
+    to poll. `diff` turns the old text into the new by line hunks,
+    (first, last, text, added) over old lines first..last-1, so a reload
+    replaces only the lines that differ.
+    """
+
+    def __init__(self):
+        self.stamps = {}
+
+    @staticmethod
+    def stamp(path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    def watch(self, path):
+        self.stamps[path] = self.stamp(path)
+
+    def forget(self, path):
+        self.stamps.pop(path, None)
+
+    def changed(self, path):
+        return path in self.stamps and self.stamp(path) != self.stamps[path]
+
+    @staticmethod
+    def split_lines(text):
+        """Lines with their breaks, split on line feeds only as a Text widget does, unlike str.splitlines"""
+        lines = [line + "\n" for line in text.split("\n")]
+        lines[-1] = lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        return lines
+
+    @staticmethod
+    def diff(old, new):
+        old_lines = FileWatcher.split_lines(old)
+        new_lines = FileWatcher.split_lines(new)
+        # Trim the common ends first so the matcher only sees the edited middle
+        limit = min(len(old_lines), len(new_lines))
+        prefix = 0
+        while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+            suffix += 1
+        a = old_lines[prefix:len(old_lines) - suffix]
+        b = new_lines[prefix:len(new_lines) - suffix]
+        hunks = []
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+            if tag != "equal":
+                hunks.append((prefix + i1, prefix + i2, "".join(b[j1:j2]), j2 - j1))
+        return hunks
+
+    @staticmethod
+    def map_line(hunks, line):
+        """Where 0-based old `line` lands after `hunks`; inside a hunk it keeps its offset, clamped"""
+        shift = 0
+        for first, last, text, added in hunks:
+            if line < first:
+                break
+            if line < last:
+                return first + shift + min(line - first, max(added - 1, 0))
+            shift += added - (last - first)
+        return line + shift
+
+
+class SearchWorker:
+    """Finds and replaces in buffer snapshots on a background thread.
+
+    Each request carries a copy of the text and gets the next generation
+    number. A search posts ("matches", generation, batch) while it scans,
+    matches being (line, column, end_line, end_column) with 1-based lines,
+    then ("done", generation, count). A replace posts ("replaced",
+    generation, runs, count), runs being (first, last, text) with the new
+    text of the 0-based lines first..last, in order. Only the newest
+    generation is worth anything: the worker drops a request as soon as a
+    newer one is made or `cancel` is called, and so should the UI thread.
+    """
+
+    BATCH = 500
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.generation = 0
+        self.working = False
+        self.thread = threading.Thread(target=self.work, name="search", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def compile(pattern, regex=False, case=True, word=False):
+        """The regex for a query; raises re.error for a bad one"""
+        if not regex:
+            pattern = re.escape(pattern)
+        if word:
+            pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+        return re.compile(pattern, re.MULTILINE | (0 if case else re.IGNORECASE))
+
+    @staticmethod
+    def locator(text):
+        """A function turning offsets into `text`, asked in increasing order, into (1-based line, column)"""
+        state = [1, 0, 0]  # line, offset it starts at, offset counted up to
+
+        def locate(offset):
+            breaks = text.count("\n", state[2], offset)
+            if breaks:
+                state[0] += breaks
+                state[1] = text.rindex("\n", state[2], offset) + 1
+            state[2] = offset
+            return state[0], offset - state[1]
+        return locate
+
+    def search(self, text, pattern):
+        self.generation += 1
+        self.requests.put(("search", self.generation, text, pattern))
+        return self.generation
+
+    def replace(self, text, pattern, template, max_run_lines=None):
+        """Replace every match with `template`, as re.sub takes it; runs span about `max_run_lines` at most"""
+        self.generation += 1
+        self.requests.put(("replace", self.generation, text, pattern, template, max_run_lines))
+        return self.generation
+
+    def cancel(self):
+        self.generation += 1
+
+    def busy(self):
+        return self.working or not self.requests.empty() or not self.results.empty()
+
+    def stop(self):
+        self.requests.put(("stop",))
+
+    def work(self):
+        while True:
+            message = self.requests.get()
+            if message[0] == "stop":
+                return
+            if message[1] != self.generation:
+                continue
+            self.working = True
+            try:
+                if message[0] == "search":
+                    self.find_all(*message[1:])
+                else:
+                    self.replace_all(*message[1:])
+            except re.error as e:
+                # A replacement template referring to a group the pattern does not have
+                self.results.put(("error", message[1], e))
+            finally:
+                self.working = False
+
+    def find_all(self, generation, text, pattern):
+        locate = self.locator(text)
+        batch = []
+        count = 0
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if start == end:
+                continue
+            batch.append(locate(start) + locate(end))
+            if len(batch) == self.BATCH:
+                if generation != self.generation:
+                    return
+                self.results.put(("matches", generation, batch))
+                count += len(batch)
+                batch = []
+        if generation != self.generation:
+            return
+        if batch:
+            self.results.put(("matches", generation, batch))
+        self.results.put(("done", generation, count + len(batch)))
+
+    def replace_all(self, generation, text, pattern, template, max_run_lines):
+        locate = self.locator(text)
+        runs = []
+        run = None  # first line, last line, pieces of new text, offset the old text goes on from
+        count = 0
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            line, column = locate(start)
+            line -= 1
+            if run is not None and line > run[1] and max_run_lines and line - run[0] >= max_run_lines:
+                runs.append(self.finish_run(text, run))
+                run = None
+            if run is None:
+                run = [line, line, [text[start - column:start]], end]
+            else:
+                run[2].append(text[run[3]:start])
+            run[2].append(match.expand(template))
+            run[1] = locate(end)[0] - 1
+            run[3] = end
+            count += 1
+            if count % self.BATCH == 0 and generation != self.generation:
+                return
+        if run is not None:
+            runs.append(self.finish_run(text, run))
+        if generation == self.generation:
+            self.results.put(("replaced", generation, runs, count))
+
+    def finish_run(self, text, run):
+        first, last, pieces, position = run
+        end = text.find("\n", position)
+        pieces.append(text[position:] if end < 0 else text[position:end])
+        return first, last, "".join(pieces)
+
+
+class Buffer:
+    """One open file: its document, grammar and highlighter state, line index, undo journal and view.
+
+    The editor gives a text widget only to the buffers used most recently.
+    A buffer whose widget was released keeps the widget's text in `text`
+    and its syntax tags in `tag_ranges`, and the rest of its model as is, so it can get a widget back without
+    reading the file or re-deriving anything.
+    """
+
+    # Rough cost of a line in a Text widget on top of its characters
+    LINE_BYTES = 100
+
+    def __init__(self, undo_bytes=1 << 20):
+        self.file_path = None
+        # Large-file mode: the document lives in a piece table and the text widget
+        # only holds window_lines lines of it starting at window_first
+        self.document = None
+        self.window_first = 0
+        self.window_lines = 0
+        self.window_trailing_newline = False
+        self.window_dirty = False
+        self.syntax_rules = []
+        self.highlighter = SyntaxHighlighter()
+        self.line_index = LineIndex()
+        self.journal = UndoJournal(undo_bytes)
+        # Set by the editor while the buffer has a widget
+        self.text_area = None
+        self.text_area_command = None
+        self.tag_pool = None
+        self.text = ""
+        # Syntax tag ranges of a released widget, by tag name, to paint on the next one
+        self.tag_ranges = {}
+        self.cursor = "1.0"
+        self.view = 0.0
+        self.closed = False
+
+    def widget_bytes(self):
+        if self.text_area is None:
+            return 0
+        return self.line_index.char_count() + self.line_index.line_count() * self.LINE_BYTES
+
+    def is_blank(self):
+        """True for an untitled buffer nothing was typed into, which opening a file can reuse"""
+        # An empty text widget still counts the line break closing its only line
+        return self.file_path is None and self.journal.sequence == 0 and self.line_index.char_count() == 1
+
+
+class BufferList:
+    """The open buffers in tab order, and in most recently used order to pick whose widgets to release"""
+
+    def __init__(self, budget_bytes=64 << 20):
+        self.budget_bytes = budget_bytes
+        self.buffers = []
+        self.recent = []
+
+    def add(self, buffer):
+        self.buffers.append(buffer)
+        self.recent.append(buffer)
+
+    def touch(self, buffer):
+        self.recent.remove(buffer)
+        self.recent.insert(0, buffer)
+
+    def remove(self, buffer):
+        """Forget `buffer`; returns the one used most recently before it, or None"""
+        self.buffers.remove(buffer)
+        self.recent.remove(buffer)
+        return self.recent[0] if self.recent else None
+
+    def find(self, path):
+        path = os.path.abspath(path)
+        for buffer in self.buffers:
+            if buffer.file_path and os.path.abspath(buffer.file_path) == path:
+                return buffer
+        return None
+
+    def next(self, buffer, step=1):
+        return self.buffers[(self.buffers.index(buffer) + step) % len(self.buffers)]
+
+    def evictions(self):
+        """Buffers with widgets past the budget, counting from the most recent; never the most recent"""
+        used = 0
+        evicted = []
+        for buffer in self.recent:
+            size = buffer.widget_bytes()
+            if not size:
+                continue
+            if used and used + size > self.budget_bytes:
+                evicted.append(buffer)
+            else:
+                used += size
+        return evicted
+
+
+# Directories the workspace index never walks into, besides hidden ones
+WORKSPACE_SKIP = {"node_modules", "__pycache__", "venv", "build", "dist"}
+
+
+def walk_workspace(root, top, max_depth, max_files):
+    """Process pool task of WorkspaceIndex.refresh: (path relative to `root`, mtime, size) of the files under `top`.
+
+    `top` is one level below `root`; directories `max_depth` levels down are
+    not entered and the walk stops at `max_files` files.
+    """
+    files = []
+    directories = [(top, 1)]
+    while directories and len(files) < max_files:
+        directory, depth = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name in WORKSPACE_SKIP:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth + 1 < max_depth:
+                        directories.append((entry.path, depth + 1))
+                elif entry.is_file():
+                    info = entry.stat()
+                    files.append((entry.path[len(root) + 1:], info.st_mtime, info.st_size))
+            except OSError:
+                pass
+    return files
+
+
+def extract_symbols(root, paths, rules):
+    """Process pool task of WorkspaceIndex.refresh: (path, [[name, kind, line], ...]) for each of `paths`.
+
+    `rules` maps a file extension to its [pattern, kind] symbol rules; a
+    symbol is the pattern's first group, or the whole match without groups.
+    """
+    compiled = {extension: [(re.compile(pattern, re.MULTILINE), kind) for pattern, kind in pairs]
+                for extension, pairs in rules.items()}
+    results = []
+    for path in paths:
+        symbols = []
+        patterns = compiled.get(os.path.splitext(path)[1][1:])
+        try:
+            with open(os.path.join(root, path), "r", errors="replace") as file:
+                text = file.read() if patterns else ""
+        except OSError:
+            results.append((path, symbols))
+            continue
+        for pattern, kind in patterns or []:
+            group = 1 if pattern.groups else 0
+            line, position = 1, 0
+            for match in pattern.finditer(text):
+                start = match.start(group)
+                if start < 0:
+                    continue
+                line += text.count("\n", position, start)
+                position = start
+                symbols.append([match.group(group), kind, line])
+        symbols.sort(key=lambda symbol: symbol[2])
+        results.append((path, symbols))
+    return results
+
+
+class FuzzyList:
+    """Items picked by a fuzzy query on their keys: the query's characters in order, anywhere in a key.
+
+    The distinct keys, and their last path components, are joined into
+    lowercase strings so regex scans in C find the candidates. Candidates
+    are gathered best kind first: the name equal to the query, starting with
+    it, containing it, the key containing it, then fuzzy matches. Gathering
+    stops at MAX_CANDIDATES, which keeps a query's time bounded however many
+    items there are, and only ever cuts off the weakest matches.
+    """
+
+    MAX_CANDIDATES = 2000
+
+    def __init__(self, items, keys):
+        self.items = items
+        # Distinct lowercase key -> the items under it, in order
+        groups = {}
+        for item, key in zip(items, keys):
+            groups.setdefault(key.lower(), []).append(item)
+        self.groups = list(groups.values())
+        names = [key[max(key.rfind("/"), key.rfind("\\")) + 1:] for key in groups]
+        self.text, self.starts = self.join(groups)
+        self.names, self.name_starts = self.join(names)
+
+    @staticmethod
+    def join(keys):
+        """Keys between line breaks, so a literal search can anchor on them, and where each starts"""
+        starts = [1]
+        for key in keys:
+            starts.append(starts[-1] + len(key) + 1)
+        return "\n" + "\n".join(keys) + "\n", starts
+
+    @staticmethod
+    def find_all(text, needle, skip=0):
+        """Offsets of `needle` in `text`, plus `skip`; str.find beats a regex scan on a plain string"""
+        offset = text.find(needle)
+        while offset != -1:
+            yield offset + skip
+            offset = text.find(needle, offset + 1)
+
+    def __len__(self):
+        return len(self.items)
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def pattern(query):
+        # Each gap stops at the first occurrence of the next character, so a scan never backtracks
+        parts = [re.escape(query[0])]
+        for char in query[1:]:
+            parts.append(f"[^{re.escape(char)}\n]*{re.escape(char)}")
+        return re.compile("".join(parts))
+
+    def match(self, query, limit=50):
+        """The best `limit` items for `query`: by kind of match, then tighter and shorter matches"""
+        query = "".join(query.lower().split())
+        if not query:
+            return self.items[:limit]
+        ranked = []
+        seen = set()
+        # (offsets of the matches, starts of what they are in, match length or None for fuzzy) by rank
+        scans = [(self.find_all(self.names, f"\n{query}\n", 1), self.name_starts),
+                 (self.find_all(self.names, f"\n{query}", 1), self.name_starts),
+                 (self.find_all(self.names, query), self.name_starts),
+                 (self.find_all(self.text, query), self.starts)]
+        fuzzy = self.pattern(query).finditer(self.text)
+        for rank, (offsets, starts) in enumerate(scans + [(fuzzy, self.starts)]):
+            for found in islice(offsets, self.MAX_CANDIDATES - len(ranked)):
+                start, length = (found, len(query)) if rank < len(scans) else (found.start(), found.end() - found.start())
+                i = bisect_right(starts, start) - 1
+                if i in seen:
+                    continue
+                seen.add(i)
+                ranked.append((rank, length, self.starts[i + 1] - self.starts[i], i))
+            if len(ranked) >= self.MAX_CANDIDATES:
+                break
+        items = []
+        for rank in heapq.nsmallest(limit, ranked):
+            items += self.groups[rank[-1]]
+            if len(items) >= limit:
+                break
+        return items[:limit]
+
+
+class WorkspaceIndex:
+    """Files and symbols under a workspace root, for quick open and goto symbol, kept on disk between runs.
+
+    The index of each root is a JSON file in the user's cache directory,
+    see cache_directory, unless `directory` says otherwise.
+
+    Every file remembers the mtime and size it was indexed at, so a refresh
+    stats the tree and reads only the files that changed. Walking and symbol
+    extraction run on a process pool. Symbols come from SYMBOL_RULES, or for
+    an extension whose grammar has rules with a "symbol" key naming their
+    kind, e.g. "function", from those rules instead. Queries go to FuzzyList
+    snapshots that a refresh replaces when it is done.
+
+    The walk goes at most MAX_DEPTH directories deep and keeps the
+    MAX_FILES shallowest files, setting `truncated` when it dropped some.
+    """
+
+    # Bigger files are listed but not searched for symbols
+    MAX_FILE_BYTES = 1 << 20
+    BATCH = 200
+    MAX_FILES = 100000
+    MAX_DEPTH = 16
+    # A directory holding one of these is the root of the workspace of the files below it
+    MARKERS = (".git", ".hg", ".svn")
+    # extension -> [[pattern, kind], ...] for languages whose grammars bring no symbol rules
+    C_SYMBOLS = [[r"^(?:[A-Za-z_][\w \t\*]*?[ \t\*])?(\w+)[ \t]*\([^;{]*\)\s*\{", "function"],
+                 [r"^(?:typedef\s+)?struct\s+(\w+)", "struct"], [r"^#define\s+(\w+)", "macro"]]
+    JS_SYMBOLS = [[r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)", "function"],
+                  [r"^\s*(?:export\s+)?(?:default\s+)?class\s+(\w+)", "class"]]
+    SYMBOL_RULES = {
+        "py": [[r"^\s*(?:async\s+)?def\s+(\w+)", "function"], [r"^\s*class\s+(\w+)", "class"]],
+        "c": C_SYMBOLS, "h": C_SYMBOLS, "cpp": C_SYMBOLS, "hpp": C_SYMBOLS, "cc": C_SYMBOLS,
+        "js": JS_SYMBOLS, "jsx": JS_SYMBOLS, "ts": JS_SYMBOLS, "tsx": JS_SYMBOLS,
+        "go": [[r"^func\s+(?:\([^)]*\)\s*)?(\w+)", "function"], [r"^type\s+(\w+)", "type"]],
+        "rs": [[r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?fn\s+(\w+)", "function"],
+               [r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait)\s+(\w+)", "type"]],
+        "java": [[r"^\s*(?:(?:public|protected|private|static|final|abstract)\s+)*(?:class|interface|enum)\s+(\w+)",
+                  "class"]],
+    }
+
+    def __init__(self, root, directory=None, workers=None):
+        self.root = os.path.abspath(root)
+        digest = hashlib.sha256(self.root.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory or cache_directory("workspaces"), digest + ".json")
+        self.workers = workers
+        # relative path -> [mtime, size, [[name, kind, line], ...]]
+        self.entries = {}
+        # extension -> [[pattern, kind], ...] the symbols were extracted with
+        self.rules = {}
+        self.files = FuzzyList([], [])
+        self.symbols = FuzzyList([], [])
+        self.loaded = False
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def find_root(cls, path):
+        """The nearest directory above `path` with a version control marker, or None.
+
+        The home directory and the file system root never count, as a marker
+        there would make the whole disk the workspace.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        home = os.path.expanduser("~")
+        while True:
+            parent = os.path.dirname(directory)
+            if parent == directory or directory == home:
+                return None
+            if any(os.path.exists(os.path.join(directory, marker)) for marker in cls.MARKERS):
+                return directory
+            directory = parent
+
+    @classmethod
+    def symbol_rules(cls, extension_index, grammar_cache=None):
+        """extension -> [[pattern, kind], ...]: SYMBOL_RULES, overridden by grammars in extensions/ with symbol rules"""
+        extension_index.ensure_current()
+        rules = {extension: list(pairs) for extension, pairs in cls.SYMBOL_RULES.items()}
+        for extension in extension_index.scopes:
+            path = extension_index.lookup(extension)
+            if path is None:
+                continue
+            try:
+                grammar = CompiledGrammar.load(path, grammar_cache)
+            except (OSError, ValueError, KeyError, re.error):
+                continue
+            pairs = [[rule["pattern"], rule["symbol"]] for i, rule in enumerate(grammar.rules)
+                     if rule.get("symbol") and i not in grammar.disabled]
+            if pairs:
+                rules[extension] = pairs
+        return rules
+
+    def contains(self, path):
+        path = os.path.abspath(path)
+        return path.startswith(self.root + os.sep)
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            self.entries, self.rules = data["files"], data["rules"]
+        except (OSError, ValueError, KeyError):
+            self.entries, self.rules = {}, {}
+        self.loaded = True
+        self.rebuild()
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_atomic(self.path, json.dumps({"root": self.root, "rules": self.rules,
+                                                "files": self.entries}).encode("utf-8"))
+        except OSError:
+            # Only a cache, the next refresh walks the whole tree again
+            pass
+
+    def refresh(self, rules, paths=None):
+        """Bring the index up to date with the tree, or with just `paths` after they were saved.
+
+        Blocks until done, so call it off the UI thread.
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            # Files whose grammar's symbol rules changed are read again
+            stale = {extension for extension in set(rules) | set(self.rules)
+                     if rules.get(extension) != self.rules.get(extension)}
+            if paths is None:
+                entries, changed = self.walk(rules, stale)
+            else:
+                entries, changed = dict(self.entries), []
+                for path in filter(self.contains, paths):
+                    relative = os.path.abspath(path)[len(self.root) + 1:]
+                    try:
+                        info = os.stat(path)
+                    except OSError:
+                        entries.pop(relative, None)
+                        continue
+                    entries[relative] = [info.st_mtime, info.st_size, []]
+                    if os.path.splitext(relative)[1][1:] in rules and info.st_size <= self.MAX_FILE_BYTES:
+                        changed.append(relative)
+            if paths is None and len(changed) > self.BATCH:
+                batches = [changed[i:i + self.BATCH] for i in range(0, len(changed), self.BATCH)]
+                with ProcessPoolExecutor(self.workers, mp_context=SPAWN) as pool:
+                    results = [result for batch in pool.map(extract_symbols, repeat(self.root), batches,
+                                                            repeat(rules)) for result in batch]
+            else:
+                results = extract_symbols(self.root, changed, rules)
+            for path, symbols in results:
+                entries[path][2] = symbols
+            if paths is not None:
+                # The other files still hold symbols from the old rules until a full refresh
+                rules = self.rules
+            modified = entries != self.entries or rules != self.rules
+            self.entries, self.rules = entries, rules
+            if modified:
+                self.rebuild()
+                self.save()
+
+    def walk(self, rules, stale):
+        """Stat the tree on a process pool, one task per top-level directory; returns (entries, paths to read)"""
+        tops, files = [], []
+        try:
+            for entry in os.scandir(self.root):
+                if entry.name.startswith(".") or entry.name in WORKSPACE_SKIP:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    tops.append(entry.path)
+                elif entry.is_file():
+                    info = entry.stat()
+                    files.append((entry.name, info.st_mtime, info.st_size))
+        except OSError:
+            return {}, []
+        if tops:
+            with ProcessPoolExecutor(self.workers, mp_context=SPAWN) as pool:
+                for found in pool.map(walk_workspace, repeat(self.root), tops,
+                                      repeat(self.MAX_DEPTH), repeat(self.MAX_FILES)):
+                    files += found
+        self.truncated = len(files) > self.MAX_FILES
+        if self.truncated:
+            files.sort(key=lambda file: (file[0].count(os.sep), file[0]))
+            del files[self.MAX_FILES:]
+        entries, changed = {}, []
+        for path, mtime, size in files:
+            extension = os.path.splitext(path)[1][1:]
+            cached = self.entries.get(path)
+            if cached and cached[0] == mtime and cached[1] == size and extension not in stale:
+                entries[path] = cached
+                continue
+            entries[path] = [mtime, size, []]
+            if extension in rules and size <= self.MAX_FILE_BYTES:
+                changed.append(path)
+        return entries, changed
+
+    def rebuild(self):
+        paths = sorted(self.entries)
+        symbols = [(name, kind, path, line) for path in paths for name, kind, line in self.entries[path][2]]
+        self.files = FuzzyList(paths, paths)
+        self.symbols = FuzzyList(symbols, [symbol[0] for symbol in symbols])
+
+    def find_files(self, query, limit=50):
+        """Absolute paths of the files best matching `query`"""
+        return [os.path.join(self.root, path) for path in self.files.match(query, limit)]
+
+    def find_symbols(self, query, limit=50):
+        """(name, kind, absolute path, line) of the symbols best matching `query`"""
+        return [(name, kind, os.path.join(self.root, path), line)
+                for name, kind, path, line in self.symbols.match(query, limit)]
@@ -0,0 +1,77 @@
+import json
+import os
+import re
+
+from gvim_core import CompiledGrammar
+
+RULES = [{"pattern": r"\b(?:def|return)\b", "color": "blue", "priority": 2},
+         {"pattern": r"#.*", "color": "grey", "priority": 3},
+         {"pattern": r"\d+", "color": "red", "priority": 1}]
+
+
+def test_rules_are_ordered_by_priority_and_merged():
+    grammar = CompiledGrammar(RULES)
+    assert [rule["color"] for rule in grammar.rules] == ["grey", "blue", "red"]
+    assert grammar.combined is not None
+    # Known to merge, as from a GrammarCache entry: each rule compiles only when needed
+    cached = CompiledGrammar(grammar.rules, True)
+    assert cached.pattern_list is None
+    assert list(cached.scan("# 1", 3)) == [(0, 0, 3)]
+
+
+def test_the_higher_priority_rule_wins_where_rules_overlap():
+    grammar = CompiledGrammar(RULES)
+    text = "def f(): return 42 # 7 def"
+    assert list(grammar.scan(text, len(text))) == [(1, 0, 3), (1, 9, 15), (2, 16, 18), (0, 19, 26)]
+
+
+def test_scan_stops_at_the_limit():
+    grammar = CompiledGrammar(RULES)
+    assert list(grammar.scan("1 2 3 4", 3)) == [(2, 0, 1), (2, 2, 3)]
+
+
+def test_backreferences_are_scanned_rule_by_rule():
+    rules = [{"pattern": r"(['\"]).*?\1", "color": "green"}, {"pattern": r"\d+", "color": "red"}]
+    grammar = CompiledGrammar(rules)
+    assert grammar.combined is None
+    assert sorted(grammar.scan("'a\"b' 12", 8)) == [(0, 0, 5), (1, 6, 8)]
+
+
+def test_demoted_rules_leave_the_merged_regex():
+    grammar = CompiledGrammar(RULES)
+    grammar.demote(2)
+    assert "_r2" not in grammar.active[0].groupindex
+    assert sorted(grammar.scan("def 1", 5)) == [(1, 0, 3), (2, 4, 5)]
+    grammar.disable(2)
+    assert list(grammar.scan("def 1", 5)) == [(1, 0, 3)]
+
+
+def test_check_lists_every_problem():
+    problems = CompiledGrammar.check([{"pattern": "(", "color": "red"}, {"color": "red"},
+                                      {"pattern": "x", "priority": "high"}])
+    assert len(problems) == 4
+    assert problems[0].startswith("rule 0 ((): ")
+    assert problems[1] == "rule 1: no pattern"
+    assert problems[2:] == ["rule 2 (x): no color", "rule 2 (x): priority is not a number"]
+    assert CompiledGrammar.check({}) == ["'rules' is not a list"]
+
+
+def test_load_compiles_a_file_once_until_it_changes(tmp_path):
+    path = tmp_path / "python.json"
+    path.write_text(json.dumps({"rules": RULES}))
+    grammar = CompiledGrammar.load(str(path))
+    assert CompiledGrammar.load(str(path)) is grammar
+    path.write_text(json.dumps({"rules": RULES[:1]}))
+    os.utime(path, (0, 1))
+    reloaded = CompiledGrammar.load(str(path))
+    assert reloaded is not grammar
+    assert len(reloaded.rules) == 1
+    assert [key for key in CompiledGrammar.cache if key[0] == str(path)] == [(str(path), 1)]
+
+
+def test_merged_scan_matches_each_rule_scanned_on_its_own_where_they_do_not_overlap():
+    grammar = CompiledGrammar(RULES)
+    text = "x = 12\n# note\ndef g():\n    return 3\n"
+    expected = sorted((i, m.start(), m.end()) for i, rule in enumerate(grammar.rules)
+                      for m in re.finditer(rule["pattern"], text, re.MULTILINE))
+    assert sorted(grammar.scan(text, len(text))) == expected
@@ -0,0 +1,106 @@
+import random
+
+from gvim_core import EventBus
+
+
+def test_cursor_scroll_and_scheme_keep_only_the_newest_event():
+    bus = EventBus()
+    batches = []
+    bus.subscribe(("cursor", "scroll", "save"), batches.append)
+    for position in ("1.0", "1.5", "2.3"):
+        bus.publish("cursor", position=position)
+    bus.publish("save", path="a")
+    bus.publish("save", path="b")
+    bus.publish("scroll", top=0.1, bottom=0.5)
+    bus.flush()
+    assert [(e.kind, e.data) for e in batches[0]] == [("save", {"path": "a"}), ("save", {"path": "b"}),
+                                                      ("cursor", {"position": "2.3"}),
+                                                      ("scroll", {"top": 0.1, "bottom": 0.5})]
+    bus.flush()
+    assert len(batches) == 1
+
+
+def test_filter_and_unsubscribe():
+    bus = EventBus()
+    saved = []
+    subscription = bus.subscribe("save", saved.append, filter=lambda event: event.data["path"].endswith(".py"))
+    bus.publish("save", path="a.txt")
+    bus.publish("save", path="b.py")
+    bus.flush()
+    assert [[e.data["path"] for e in batch] for batch in saved] == [["b.py"]]
+    bus.unsubscribe(subscription)
+    assert not bus.wants("save")
+    bus.publish("save", path="c.py")
+    bus.flush()
+    assert len(saved) == 1
+
+
+def test_overflow_starts_the_batch_with_a_dropped_event():
+    bus = EventBus(max_pending=3)
+    batches = []
+    bus.subscribe("open", batches.append)
+    for i in range(5):
+        bus.publish("open", path=str(i))
+    bus.flush()
+    assert [(e.kind, e.data) for e in batches[0]] == [("dropped", {"count": 2}), ("open", {"path": "2"}),
+                                                      ("open", {"path": "3"}), ("open", {"path": "4"})]
+
+
+def test_publish_requests_a_flush_only_when_someone_listens():
+    requests = []
+    bus = EventBus(request_flush=lambda: requests.append(1))
+    bus.publish("save", path="a")
+    assert requests == []
+    bus.subscribe("save", lambda events: None)
+    bus.publish("save", path="a")
+    assert requests == [1]
+
+
+def test_a_failing_callback_does_not_stop_the_others(capsys):
+    bus = EventBus()
+    got = []
+    bus.subscribe("save", lambda events: 1 / 0)
+    bus.subscribe("save", got.append)
+    bus.publish("save", path="a")
+    bus.flush()
+    assert len(got) == 1
+    assert "ZeroDivisionError" in capsys.readouterr().err
+
+
+def test_edits_to_adjacent_lines_arrive_as_one():
+    bus = EventBus()
+    batches = []
+    bus.subscribe("edit", batches.append)
+    for _ in range(5):
+        bus.publish("edit", line=10, removed=0, added=0)
+    bus.publish("edit", line=10, removed=0, added=1)
+    bus.publish("edit", line=11, removed=0, added=0)
+    bus.publish("edit", line=400, removed=2, added=0)
+    bus.publish("edit", line=9, removed=1, added=0)
+    bus.flush()
+    assert [e.data for e in batches[0]] == [{"line": 10, "removed": 0, "added": 1},
+                                            {"line": 400, "removed": 2, "added": 0},
+                                            {"line": 9, "removed": 1, "added": 0}]
+
+
+def test_a_merged_edit_describes_both():
+    rng = random.Random(11)
+    merges = 0
+    for _ in range(2000):
+        lines = list(range(30))
+        edits = []
+        for _ in range(2):
+            line = rng.randint(1, len(lines))
+            removed = rng.randint(0, min(3, len(lines) - line))
+            added = rng.randint(0, 3)
+            lines[line - 1:line + removed] = [-1] * (added + 1)
+            edits.append({"line": line, "removed": removed, "added": added})
+        merged = EventBus.merge_edits(*edits)
+        if merged is None:
+            continue
+        merges += 1
+        start, removed, added = merged["line"], merged["removed"], merged["added"]
+        assert len(lines) == 30 - removed + added
+        assert lines[:start - 1] == list(range(start - 1))
+        assert lines[start + added:] == list(range(start + removed, 30))
+    assert merges > 200
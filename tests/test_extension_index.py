@@ -0,0 +1,94 @@
+import json
+import os
+
+from gvim_core import ExtensionIndex
+
+
+def write_grammar(directory, name, scope):
+    path = directory / name
+    path.write_text(json.dumps({"scope": scope, "rules": []}))
+    return str(path)
+
+
+class CountingIndex(ExtensionIndex):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parsed = []
+
+    def read_entry(self, path, info):
+        self.parsed.append(os.path.basename(path))
+        return super().read_entry(path, info)
+
+
+def test_lookup_by_any_listed_scope(tmp_path):
+    python = write_grammar(tmp_path, "python.json", "py, .pyw")
+    write_grammar(tmp_path, "c.json", ["c", "h"])
+    index = ExtensionIndex(str(tmp_path))
+    assert index.lookup("py") == python
+    assert index.lookup("pyw") == python
+    assert index.lookup("h") == str(tmp_path / "c.json")
+    assert index.lookup("rs") is None
+    assert index.files_with_scope(["c", "h"]) == ["c.json"]
+
+
+def test_a_new_index_reads_the_saved_one_instead_of_parsing(tmp_path):
+    write_grammar(tmp_path, "python.json", "py")
+    write_grammar(tmp_path, "c.json", "c")
+    first = CountingIndex(str(tmp_path))
+    first.lookup("py")
+    assert sorted(first.parsed) == ["c.json", "python.json"]
+
+    second = CountingIndex(str(tmp_path))
+    assert second.lookup("c") == str(tmp_path / "c.json")
+    assert second.parsed == []
+    assert second.entries == first.entries
+
+
+def test_only_changed_grammars_are_parsed_again(tmp_path):
+    write_grammar(tmp_path, "python.json", "py")
+    write_grammar(tmp_path, "c.json", "c")
+    CountingIndex(str(tmp_path)).lookup("py")
+
+    write_grammar(tmp_path, "python.json", "py pyi")
+    os.remove(tmp_path / "c.json")
+    index = CountingIndex(str(tmp_path))
+    assert index.lookup("pyi") == str(tmp_path / "python.json")
+    assert index.lookup("c") is None
+    assert index.parsed == ["python.json"]
+
+
+def test_update_files_after_an_install(tmp_path):
+    index = ExtensionIndex(str(tmp_path))
+    assert index.lookup("go") is None
+    write_grammar(tmp_path, "go.json", "go")
+    index.update_files(["go.json"])
+    assert index.lookup("go") == str(tmp_path / "go.json")
+
+
+def test_saving_the_index_leaves_the_directory_alone(tmp_path, cache_home):
+    write_grammar(tmp_path, "python.json", "py")
+    write_grammar(tmp_path, "c.json", "c")
+    mtime = os.stat(tmp_path).st_mtime_ns
+    index = CountingIndex(str(tmp_path))
+    index.lookup("py")
+    assert sorted(os.listdir(tmp_path)) == ["c.json", "python.json"]
+    assert os.stat(tmp_path).st_mtime_ns == mtime
+    assert index.index_path.startswith(str(cache_home))
+    assert os.path.exists(index.index_path)
+
+    # Saving after an install does not make the next lookup stat everything again
+    refreshes = []
+    index.refresh = lambda: refreshes.append(1)
+    index.update_files(["python.json"])
+    assert index.lookup("c") == str(tmp_path / "c.json")
+    assert refreshes == []
+
+
+def test_each_directory_gets_its_own_index(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    write_grammar(tmp_path / "a", "python.json", "py")
+    write_grammar(tmp_path / "b", "go.json", "go")
+    assert ExtensionIndex(str(tmp_path / "a")).lookup("go") is None
+    assert ExtensionIndex(str(tmp_path / "b")).lookup("go") == str(tmp_path / "b" / "go.json")
+    assert ExtensionIndex(str(tmp_path / "a")).index_path != ExtensionIndex(str(tmp_path / "b")).index_path
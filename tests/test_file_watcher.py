@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from gvim_core import FileWatcher
+
+
+def apply(old, hunks):
+    """Apply hunks to `old` the way TextEditor.apply_reload does, on lines split like a Text widget"""
+    lines = old.split("\n")
+    lines = [line + "\n" for line in lines[:-1]] + [lines[-1]]
+    for first, last, text, added in reversed(hunks):
+        lines[first:last] = [text]
+    return "".join(lines)
+
+
+@pytest.mark.parametrize("old, new", [
+    ("a\nb\nc", "a\nB\nc"),
+    ("a\nb\nc\n", "a\nb\nc\nd\n"),
+    ("", "a\n"),
+    ("a\n", ""),
+    ("a\nb", "a\nb\n"),
+    ("a\n\x0cb\nc\n", "a\n\x0cb\nC\n"),
+    ("x y\nz\x85w\n\x1cq\n", "x y\nZ\x85w\n\x1cq\n"),
+])
+def test_diff_applies(old, new):
+    assert apply(old, FileWatcher.diff(old, new)) == new
+
+
+def test_diff_counts_lines_like_tk():
+    # A form feed is not a line break in a Text widget, so the change is on line 2
+    assert FileWatcher.diff("a\n\x0cb\nc\n", "a\n\x0cb\nC\n") == [(2, 3, "C\n", 1)]
+
+
+def test_diff_random():
+    rng = random.Random(1)
+    pieces = ["a\n", "b\n", "c", "\n", "\x0c\n", "d e\n"]
+    for _ in range(500):
+        old = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+        new = "".join(rng.choice(pieces + ["x\n"]) for _ in range(rng.randint(0, 12)))
+        assert apply(old, FileWatcher.diff(old, new)) == new
+
+
+def test_map_line():
+    hunks = FileWatcher.diff("a\nb\nc\nd\ne\n", "a\nB1\nB2\nc\ne\n")
+    assert [FileWatcher.map_line(hunks, line) for line in range(5)] == [0, 1, 3, 4, 4]
+
+
+def test_changed(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_text("one\n")
+    watcher = FileWatcher()
+    watcher.watch(str(path))
+    assert not watcher.changed(str(path))
+    path.write_text("one\ntwo\n")
+    assert watcher.changed(str(path))
+    watcher.forget(str(path))
+    assert not watcher.changed(str(path))
@@ -0,0 +1,34 @@
+from gvim_core import FuzzyList
+
+
+def files(paths):
+    return FuzzyList(paths, paths)
+
+
+def test_exact_name_beats_earlier_partial_matches():
+    paths = [f"a/mod{i:05d}/main_helper.py" for i in range(5000)] + ["zz/main.py"]
+    assert files(paths).match("main.py", 5)[0] == "zz/main.py"
+
+
+def test_ranks_by_kind_of_match():
+    paths = ["src/xmainx.c", "main/other.c", "src/m_a_i_n.c", "lib/main.c", "lib/maintenance.c"]
+    assert files(paths).match("main", 10) == ["lib/main.c", "lib/maintenance.c", "src/xmainx.c",
+                                              "main/other.c", "src/m_a_i_n.c"]
+
+
+def test_fuzzy_prefers_tighter_then_shorter():
+    paths = ["parse_long_buffer.py", "parse_buffer.py", "p_a_r_s_e_b.py"]
+    assert files(paths).match("parsebuf", 3) == ["parse_buffer.py", "parse_long_buffer.py"]
+
+
+def test_case_whitespace_and_no_match():
+    items = files(["Render.py", "view.py"])
+    assert items.match("REN der") == ["Render.py"]
+    assert items.match("zzz") == []
+    assert items.match("", 1) == ["Render.py"]
+
+
+def test_duplicate_keys_keep_every_item():
+    symbols = [("init", "function", "a.py", 1), ("init", "function", "b.py", 7), ("other", "class", "a.py", 3)]
+    found = FuzzyList(symbols, [symbol[0] for symbol in symbols]).match("init")
+    assert found == symbols[:2]
@@ -0,0 +1,73 @@
+import random
+
+from gvim_core import LineIndex
+
+
+def check(index, text):
+    lines = text.split("\n")[:-1]
+    assert index.line_count() == len(lines)
+    assert index.char_count() == len(text)
+    offset = 0
+    for line, content in enumerate(lines):
+        assert index.line_start(line) == offset
+        for column in range(len(content) + 1):
+            assert index.position(offset + column) == (line, column)
+            assert index.index(offset + column) == f"{line + 1}.{column}"
+            assert index.offset(f"{line + 1}.{column}") == offset + column
+        offset += len(content) + 1
+
+
+def test_reset_indexes_every_line():
+    index = LineIndex()
+    text = "one\n\ntwo lines\nthree\n"
+    index.reset(text)
+    check(index, text)
+    assert index.index(4) == "2.0"
+    assert index.offset("3.4") == 9
+
+
+def test_empty_buffer_has_one_line():
+    index = LineIndex()
+    check(index, "\n")
+
+
+def test_insert_and_delete_lines():
+    index = LineIndex()
+    index.reset("a\nb\nc\n")
+    # "b" became "b1\nb2\nb3"
+    index.on_edit(1, 0, 2, "b1\nb2\nb3\n")
+    check(index, "a\nb1\nb2\nb3\nc\n")
+    # Lines 1..3 joined back into "b"
+    index.on_edit(1, 2, 0, "b\n")
+    check(index, "a\nb\nc\n")
+
+
+def test_offsets_past_the_end_are_clamped():
+    index = LineIndex()
+    index.reset("ab\ncd\n")
+    assert index.position(100) == (1, 2)
+    assert index.position(-5) == (0, 0)
+
+
+def test_random_edits_across_blocks(monkeypatch):
+    monkeypatch.setattr(LineIndex, "BLOCK", 4)
+    rng = random.Random(7)
+    index = LineIndex()
+    text = "\n"
+    for step in range(1500):
+        if rng.random() < 0.6 or len(text) < 3:
+            at = rng.randint(0, len(text) - 1)
+            insert = rng.choice(["a", "\n", "xy\nz", "\n\n\n\n\n", "qqq"])
+            line, removed, added = text.count("\n", 0, at), 0, insert.count("\n")
+            text = text[:at] + insert + text[at:]
+        else:
+            start = rng.randint(0, len(text) - 2)
+            end = min(len(text) - 1, start + rng.randint(1, 12))
+            line, removed, added = text.count("\n", 0, start), text.count("\n", start, end), 0
+            text = text[:start] + text[end:]
+        lines = text.split("\n")[:-1]
+        index.on_edit(line, removed, added, "".join(part + "\n" for part in lines[line:line + added + 1]))
+        if step % 100 == 0:
+            check(index, text)
+    check(index, text)
+    assert len(index.blocks) > 1
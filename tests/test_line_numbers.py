@@ -0,0 +1,60 @@
+from gvim_core import LineNumbers
+
+
+class Bar:
+    """The gutter text, changed only through the deltas LineNumbers hands out"""
+
+    def __init__(self):
+        self.text = ""
+
+    def apply(self, change):
+        if change is None:
+            return
+        kind, value = change
+        if kind == "append":
+            self.text += value
+        else:
+            self.text = "\n".join(self.text.split("\n")[:value])
+
+
+def test_deltas_keep_the_bar_numbered_through_edits():
+    numbers = LineNumbers()
+    bar = Bar()
+    bar.apply(numbers.delta())
+    assert bar.text == "1"
+    for removed, added in ((0, 4), (2, 0), (0, 1), (3, 0), (0, 0), (0, 7)):
+        numbers.on_edit(removed, added)
+        bar.apply(numbers.delta())
+        assert bar.text == "\n".join(map(str, range(1, numbers.line_count + 1)))
+    assert numbers.delta() is None
+
+
+def test_only_the_new_numbers_are_appended():
+    numbers = LineNumbers()
+    numbers.delta()
+    numbers.on_edit(0, 2)
+    assert numbers.delta() == ("append", "\n2\n3")
+    numbers.on_edit(1, 0)
+    assert numbers.delta() == ("truncate", 2)
+
+
+def test_virtual_mode_draws_only_the_visible_window():
+    numbers = LineNumbers(virtual=True)
+    numbers.reset(1000, offset=5000)
+    assert numbers.window_text(10, 12) == "5010\n5011\n5012"
+    assert numbers.window_text(10, 12) is None
+    assert numbers.window_text(998, 1010) == "5998\n5999\n6000"
+    numbers.set_offset(0)
+    assert numbers.window_text(998, 1010) == "998\n999\n1000"
+    assert numbers.width() == 4
+
+
+def test_switching_modes_empties_the_bar():
+    numbers = LineNumbers()
+    numbers.on_edit(0, 9)
+    numbers.delta()
+    assert not numbers.set_virtual(False)
+    assert numbers.set_virtual(True)
+    assert numbers.set_virtual(False)
+    assert numbers.delta() == ("append", "\n".join(map(str, range(1, 11))))
+    assert LineNumbers().width() == 2
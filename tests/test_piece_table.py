@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+from gvim_core import DocumentChanged, PieceTable
+
+
+@pytest.fixture
+def document(tmp_path):
+    path = tmp_path / "large.txt"
+    path.write_bytes(b"".join(b"line %d\n" % i for i in range(10000)))
+    table = PieceTable.open(str(path))
+    yield table
+    table.close()
+
+
+def test_rewritten_file_raises_instead_of_faulting(document):
+    with open(document.path, "r+b") as file:
+        file.truncate(10)
+    assert document.changed()
+    with pytest.raises(DocumentChanged):
+        document.read(9990, 5)
+    with pytest.raises(DocumentChanged):
+        document.replace_lines(0, 1, "x\n")
+    chunks, total = document.chunks()
+    with pytest.raises(DocumentChanged):
+        list(chunks)
+
+
+def test_replaced_file_keeps_old_mapping(document, tmp_path):
+    other = tmp_path / "other.txt"
+    other.write_text("new\n")
+    other.replace(document.path)
+    assert not document.changed()
+    assert document.read(9999, 1) == "line 9999\n"
+
+
+def test_replace_lines_reads_back(document):
+    document.replace_lines(2, 3, "two\nthree\n")
+    assert document.read(0, 5) == "line 0\nline 1\ntwo\nthree\nline 5\n"
+    assert document.line_count() == 10000
+    document.replace_lines(0, 2, "")
+    assert document.read(0, 3) == "two\nthree\nline 5\n"
+    assert document.read(9996, 2) == "line 9999\n"
+
+
+def test_random_edits_match_a_list_of_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(PieceTable, "BLOCK_SIZE", 64)
+    lines = [f"line {i}\n" for i in range(500)]
+    path = tmp_path / "edits.txt"
+    path.write_text("".join(lines))
+    rng = random.Random(5)
+    table = PieceTable.open(str(path))
+    try:
+        for _ in range(300):
+            first = rng.randint(0, len(lines))
+            count = rng.randint(0, min(4, len(lines) - first))
+            new = [f"edit {rng.randint(0, 99)}\n" for _ in range(rng.randint(0, 3))]
+            lines[first:first + count] = new
+            table.replace_lines(first, count, "".join(new))
+            start = rng.randint(0, len(lines))
+            assert table.read(start, 5) == "".join(lines[start:start + 5])
+        assert table.line_count() == len(lines) + 1
+        assert table.text() == "".join(lines)
+        chunks, total = table.chunks()
+        data = b"".join(chunks)
+        assert len(data) == total
+        assert data.decode() == "".join(lines)
+    finally:
+        table.close()
+
+
+def test_crlf_file_keeps_its_line_breaks(tmp_path):
+    path = tmp_path / "dos.txt"
+    path.write_bytes(b"one\r\ntwo\r\n")
+    table = PieceTable.open(str(path))
+    try:
+        assert table.text() == "one\ntwo\n"
+        table.replace_lines(1, 1, "2\n3\n")
+        chunks, total = table.chunks()
+        assert b"".join(chunks) == b"one\r\n2\r\n3\r\n"
+    finally:
+        table.close()
+
+
+@pytest.mark.parametrize("data", [b"one\ntwo\n", b"one\ntwo", b"", b"\n"])
+def test_text_is_the_file_with_or_without_a_final_line_break(tmp_path, data):
+    path = tmp_path / "file.txt"
+    path.write_bytes(data)
+    table = PieceTable.open(str(path))
+    try:
+        text = data.decode()
+        assert table.text() == text
+        assert table.line_count() == text.count("\n") + 1
+        assert table.read(table.line_count() - 1, 1) == text[text.rfind("\n") + 1:]
+        table.set_text(table.text())
+        chunks, total = table.chunks()
+        assert b"".join(chunks) == data
+    finally:
+        table.close()
@@ -0,0 +1,130 @@
+import os
+import threading
+import types
+
+from gvim_core import PluginCancelled, PluginManager
+
+
+class RecordingManager(PluginManager):
+    def __init__(self):
+        super().__init__(editor=None)
+        self.log = []
+
+    def replay_key(self, key):
+        self.log.append(("replay", key))
+
+
+def key_plugin(run):
+    module = types.ModuleType("key_plugin")
+    module.run = run
+    return module
+
+
+def test_trigger_key_replays_after_queued_bindings():
+    manager = RecordingManager()
+    release = threading.Event()
+
+    def run(api):
+        api.call_on_ui(manager.log.append, ("bind", "<Control-k>"))
+        release.wait(5)
+        api.call_on_ui(manager.log.append, ("bind", "<Control-j>"))
+
+    manager.manifests["keys"] = {"path": "keys.py", "activation": ["key:<Control-k>"]}
+    manager.load_plugin = lambda path: key_plugin(run)
+    manager.activate_on_key("keys", "<Control-k>")
+    manager.pump()
+    assert ("replay", "<Control-k>") not in manager.log
+    release.set()
+    assert manager.drain(timeout=5)
+    assert manager.log == [("bind", "<Control-k>"), ("bind", "<Control-j>"), ("replay", "<Control-k>")]
+    assert manager.replays == []
+
+
+def test_trigger_key_replays_at_once_without_a_job():
+    manager = RecordingManager()
+    module = key_plugin(lambda api: None)
+    manager.toggled_off_plugins.append(module)
+    manager.manifests["keys"] = {"path": "keys.py", "activation": ["key:<Control-k>"]}
+    manager.load_plugin = lambda path: module
+    manager.activate_on_key("keys", "<Control-k>")
+    assert manager.log == [("replay", "<Control-k>")]
+
+
+def test_reads_from_plugin_threads_run_on_the_pumping_thread():
+    manager = RecordingManager()
+    pumping = threading.get_ident()
+    seen = []
+
+    def run(api):
+        seen.append(api.read_on_ui(threading.get_ident))
+
+    manager.run_plugin(key_plugin(run))
+    assert manager.drain(timeout=5)
+    assert seen == [pumping]
+
+
+def test_reads_without_a_job_are_direct():
+    manager = RecordingManager()
+    assert manager.api.read_on_ui(threading.get_ident) == threading.get_ident()
+
+
+def test_cancelled_job_stops_waiting_for_its_read():
+    manager = RecordingManager()
+    started = threading.Event()
+    outcome = []
+
+    def run(api):
+        started.set()
+        try:
+            api.read_on_ui(threading.get_ident)
+        except PluginCancelled:
+            outcome.append("cancelled")
+
+    job = manager.run_plugin(key_plugin(run))
+    assert started.wait(5)
+    job.cancel()
+    job.future.result(timeout=5)
+    assert outcome == ["cancelled"]
+
+
+def test_discover_skips_broken_plugins(tmp_path):
+    (tmp_path / "good.py").write_text('ACTIVATION_EVENTS = ["key:<Control-g>"]\n')
+    (tmp_path / "syntax.py").write_text("def run(api:\n")
+    (tmp_path / "number.py").write_text("ACTIVATION_EVENTS = 5\n")
+    (tmp_path / "manifest.py").write_text("def run(api):\n    pass\n")
+    (tmp_path / "manifest.json").write_text("{not json")
+    manager = RecordingManager()
+    manager.plugin_dir = str(tmp_path)
+    manager.cache_path = os.path.join(str(tmp_path), ".plugin_cache.json")
+    manager.discover()
+    assert list(manager.manifests) == ["good"]
+    assert manager.manifests["good"]["activation"] == ["key:<Control-g>"]
+
+
+def test_slow_plugin_is_cancelled_at_its_own_budget(tmp_path):
+    (tmp_path / "slow.py").write_text(
+        "import time\n"
+        "TIME_BUDGET = 0.05\n"
+        "def run(api):\n"
+        "    while True:\n"
+        "        api.check_cancelled()\n"
+        "        time.sleep(0.005)\n")
+    manager = RecordingManager()
+    manager.plugin_dir = str(tmp_path)
+    manager.cache_path = os.path.join(str(tmp_path), ".plugin_cache.json")
+    manager.discover()
+    assert manager.manifests["slow"]["budget"] == 0.05
+    job = manager.activate("slow")
+    assert job.budget == 0.05
+    job.future.result(timeout=1)
+    assert manager.runner.stats["slow"]["timeouts"] == 1
+    assert job.budget < manager.runner.budget
+
+
+def test_bad_budget_skips_the_plugin(tmp_path):
+    (tmp_path / "bad.py").write_text('TIME_BUDGET = "soon"\n')
+    manager = RecordingManager()
+    manager.plugin_dir = str(tmp_path)
+    manager.cache_path = os.path.join(str(tmp_path), ".plugin_cache.json")
+    manager.discover()
+    assert manager.manifests == {}
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from gvim_core import Profiler
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    calls = []
+    timed = profiler.timed("work")(lambda x: calls.append(x) or x * 2)
+    assert timed(3) == 6
+    assert calls == [3]
+    assert profiler.summary() == {}
+
+
+def test_timed_records_even_when_the_call_raises():
+    profiler = Profiler(enabled=True)
+
+    @profiler.timed("fail")
+    def fail():
+        raise ValueError
+
+    for _ in range(3):
+        try:
+            fail()
+        except ValueError:
+            pass
+    assert profiler.summary()["fail"]["count"] == 3
+
+
+def test_summary_keeps_the_total_count_past_max_samples():
+    profiler = Profiler(enabled=True, max_samples=100)
+    for i in range(1, 201):
+        profiler.record("key", i / 1000)
+    row = profiler.summary()["key"]
+    assert row["count"] == 200
+    # Only the newest 100 samples, 101 to 200 ms, are kept
+    assert row["max"] == pytest.approx(200)
+    assert row["p50"] == pytest.approx(151)
+    assert row["p99"] == pytest.approx(199)
+    assert row["mean"] == pytest.approx(150.5)
+
+
+def test_dump_and_reset(tmp_path):
+    profiler = Profiler(enabled=True)
+    profiler.record("draw", 0.002)
+    path = tmp_path / "profile.json"
+    profiler.dump(str(path))
+    data = json.loads(path.read_text())
+    assert data["unit"] == "ms"
+    assert data["metrics"]["draw"]["p95"] == pytest.approx(2)
+    profiler.reset()
+    assert profiler.summary() == {}
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+from gvim_core import CompiledGrammar, GrammarCache, RuleProfiler
+
+RULES = [{"pattern": r"\b(?:if|else)\b", "priority": 3}, {"pattern": r"(a+)+b", "priority": 2},
+         {"pattern": r"\d+", "priority": 1}]
+
+
+def test_probe_disables_a_rule_that_gets_stuck():
+    grammar = CompiledGrammar(RULES)
+    profiler = RuleProfiler(budget_ms=0, probe_timeout=1.0)
+    profiler.probe(grammar, "if 12 " + "a" * 40 + " else")
+    assert grammar.probed
+    assert grammar.disabled == {1}
+    assert grammar.timings[1] is None
+    assert grammar.timings[0] >= 0 and grammar.timings[2] >= 0
+
+
+def test_apply_acts_on_timings_kept_in_the_cache(tmp_path):
+    cache = GrammarCache(str(tmp_path / "grammars.json"))
+    grammar = CompiledGrammar(RULES)
+    RuleProfiler().apply(grammar, {0: 0.0001, 1: None, 2: 0.5})
+    cache.put("digest", grammar)
+    cache.save()
+
+    entry = json.loads((tmp_path / "grammars.json").read_text())["grammars"]["digest"]
+    loaded = CompiledGrammar(entry["rules"], entry["merge"])
+    RuleProfiler(budget_ms=50).apply(loaded, entry["timings"])
+    assert loaded.probed
+    assert loaded.disabled == {1}
+    assert loaded.demoted == {2}
+    assert loaded.timings == {0: 0.0001, 1: None, 2: 0.5}
+    assert [m[0] for m in loaded.scan("if 7", 10)] == [0, 2]
+
+
+def test_load_keeps_the_digest_of_the_grammar_file(tmp_path):
+    path = tmp_path / "syntax.json"
+    path.write_text(json.dumps({"rules": RULES}))
+    cache = GrammarCache(str(tmp_path / "grammars.json"))
+    grammar = CompiledGrammar.load(str(path), cache)
+    assert grammar.digest == GrammarCache.digest(path.read_bytes())
+    assert cache.get(grammar.digest)["rules"] == grammar.rules
+
+
+def test_recording_times_every_rule_without_changing_the_matches():
+    rules = [{"pattern": r"#.*", "priority": 2}, {"pattern": r"\w+", "priority": 1}]
+    grammar = CompiledGrammar(rules)
+    text = "x = 1 # note it\ny"
+    plain = list(grammar.scan(text, len(text)))
+    profiler = RuleProfiler(budget_ms=0)
+    profiler.recording = True
+    grammar.profiler = profiler
+    assert list(grammar.scan(text, len(text))) == plain
+    assert (0, 6, 15) in plain and (1, 8, 10) not in plain
+    assert {row["pattern"]: row["scans"] for row in profiler.report(grammar)} == {r"#.*": 1, r"\w+": 1}
+
+
+
+class BlamingProfiler(RuleProfiler):
+    """Finds the merged scan and one chosen rule over budget, whatever the clock says"""
+
+    def __init__(self, slow_pattern):
+        super().__init__(budget_ms=10)
+        self.slow_pattern = slow_pattern
+        self.last = None
+
+    def record(self, pattern, seconds, matches):
+        super().record(pattern, seconds, matches)
+        self.last = pattern
+
+    def over_budget(self, seconds):
+        pattern, self.last = self.last, None
+        return pattern in (None, self.slow_pattern)
+
+
+def test_the_guard_demotes_then_disables_a_rule_over_budget():
+    grammar = CompiledGrammar(RULES[:1] + RULES[2:])
+    grammar.profiler = BlamingProfiler(RULES[2]["pattern"])
+    text = "if 12 else 3"
+    assert sorted(grammar.scan(text, len(text))) == [(0, 0, 2), (0, 6, 10), (1, 3, 5), (1, 11, 12)]
+    assert (grammar.demoted, grammar.disabled) == ({1}, set())
+    assert sorted(grammar.scan(text, len(text))) == [(0, 0, 2), (0, 6, 10), (1, 3, 5), (1, 11, 12)]
+    assert grammar.disabled == {1}
+    assert list(grammar.scan(text, len(text))) == [(0, 0, 2), (0, 6, 10)]
+
+    profiler = grammar.profiler
+    rows = profiler.report(grammar)
+    assert {row["pattern"]: row["state"] for row in rows} == {RULES[0]["pattern"]: "ok",
+                                                              RULES[2]["pattern"]: "disabled"}
+    assert {row["pattern"]: row["scans"] for row in rows} == {RULES[0]["pattern"]: 2, RULES[2]["pattern"]: 2}
+    profiler.reset()
+    assert all(row["scans"] == 0 for row in profiler.report(grammar))
+
+
+def test_report_lists_the_slowest_rules_first():
+    grammar = CompiledGrammar(RULES)
+    profiler = RuleProfiler()
+    profiler.record(RULES[2]["pattern"], 0.004, 3)
+    profiler.record(RULES[2]["pattern"], 0.002, 1)
+    profiler.record(RULES[0]["pattern"], 0.001, 9)
+    rows = profiler.report(grammar, count=2)
+    assert [row["pattern"] for row in rows] == [RULES[2]["pattern"], RULES[0]["pattern"]]
+    assert rows[0]["ms"] == pytest.approx(6)
+    assert rows[0]["slowest_ms"] == pytest.approx(4)
+    assert (rows[0]["matches"], rows[0]["scans"]) == (4, 2)
+    assert not RuleProfiler(budget_ms=0).over_budget(60)
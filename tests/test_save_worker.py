@@ -0,0 +1,43 @@
+import os
+import stat
+
+from gvim_core import UMASK, SaveWorker, write_atomic
+
+
+def save(path, text):
+    worker = SaveWorker()
+    worker.start(str(path), worker.text_chunks(text), len(text))
+    worker.thread.join()
+    while True:
+        message = worker.messages.get()
+        if message[0] != "progress":
+            break
+    assert message[0] == "written"
+    os.replace(message[1], str(path))
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_new_file_gets_umask_permissions(tmp_path):
+    path = tmp_path / "new.txt"
+    save(path, "hello\n")
+    assert path.read_text() == "hello\n"
+    assert mode(path) == 0o666 & ~UMASK
+
+
+def test_existing_file_keeps_its_permissions(tmp_path):
+    path = tmp_path / "old.txt"
+    path.write_text("old\n")
+    os.chmod(path, 0o640)
+    save(path, "new\n")
+    assert path.read_text() == "new\n"
+    assert mode(path) == 0o640
+
+
+def test_write_atomic_new_file(tmp_path):
+    path = tmp_path / "cache.json"
+    write_atomic(str(path), b"{}")
+    assert mode(path) == 0o666 & ~UMASK
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
@@ -0,0 +1,89 @@
+import random
+import re
+
+import pytest
+
+from gvim_core import SearchWorker
+
+
+@pytest.fixture
+def worker():
+    worker = SearchWorker()
+    yield worker
+    worker.stop()
+
+
+def results(worker, generation, timeout=10):
+    """Everything posted for `generation`, up to its final message"""
+    got = []
+    while True:
+        message = worker.results.get(timeout=timeout)
+        if message[1] != generation:
+            continue
+        got.append(message)
+        if message[0] != "matches":
+            return got
+
+
+def apply_runs(text, runs):
+    lines = text.split("\n")
+    for first, last, new in reversed(runs):
+        lines[first:last + 1] = new.split("\n")
+    return "\n".join(lines)
+
+
+def test_matches_come_in_batches_with_line_and_column(worker, monkeypatch):
+    monkeypatch.setattr(SearchWorker, "BATCH", 2)
+    text = "ab\nxab ab\n\nab"
+    got = results(worker, worker.search(text, SearchWorker.compile("ab")))
+    assert [message[0] for message in got] == ["matches", "matches", "done"]
+    assert got[0][2] + got[1][2] == [(1, 0, 1, 2), (2, 1, 2, 3), (2, 4, 2, 6), (4, 0, 4, 2)]
+    assert got[-1][2] == 4
+
+
+def test_compile_options():
+    assert SearchWorker.compile("a.b").search("axb") is None
+    assert SearchWorker.compile("a.b", regex=True).search("axb")
+    assert SearchWorker.compile("AB", case=False).search("xab")
+    assert SearchWorker.compile("ab", word=True).findall("ab abc cab ab") == ["ab", "ab"]
+
+
+def test_empty_matches_are_skipped(worker):
+    got = results(worker, worker.search("a\n\nb", SearchWorker.compile("^", regex=True)))
+    assert got == [("done", got[0][1], 0)]
+
+
+def test_a_newer_request_is_answered_under_its_own_generation(worker):
+    old = worker.search("a" * 1000, SearchWorker.compile("a"))
+    new = worker.search("bab", SearchWorker.compile("b"))
+    assert old != new
+    assert results(worker, new)[-1] == ("done", new, 2)
+
+
+def test_replace_all_runs_rebuild_the_replaced_text(worker):
+    rng = random.Random(7)
+    text = "\n".join("".join(rng.choice("ab \n") for _ in range(rng.randrange(12))) for _ in range(200))
+    pattern = SearchWorker.compile(r"a(b*)", regex=True)
+    for max_run_lines in (None, 1, 5):
+        generation = worker.replace(text, pattern, r"<\1>\n", max_run_lines)
+        kind, _, runs, count = results(worker, generation)[-1]
+        assert kind == "replaced"
+        assert count == len(pattern.findall(text))
+        assert apply_runs(text, runs) == pattern.sub(r"<\1>\n", text)
+        firsts = [run[0] for run in runs]
+        assert firsts == sorted(firsts)
+
+
+def test_runs_split_at_max_run_lines(worker):
+    text = "\n".join(["x a x"] * 10)
+    generation = worker.replace(text, SearchWorker.compile("a"), "b", max_run_lines=3)
+    runs = results(worker, generation)[-1][2]
+    assert [(first, last) for first, last, new in runs] == [(0, 2), (3, 5), (6, 8), (9, 9)]
+    assert runs[0][2] == "x b x\nx b x\nx b x"
+
+
+def test_a_bad_template_posts_an_error(worker):
+    generation = worker.replace("abc", SearchWorker.compile("b"), r"\1")
+    kind, got_generation, error = results(worker, generation)[-1]
+    assert (kind, got_generation) == ("error", generation)
+    assert isinstance(error, re.error)
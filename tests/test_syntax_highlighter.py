@@ -0,0 +1,133 @@
+import random
+
+from gvim_core import SyntaxHighlighter
+
+RULES = [{"pattern": r"/\*[\s\S]*?\*/", "priority": 3}, {"pattern": r"//.*", "priority": 2},
+         {"pattern": r"\bint\b", "priority": 1}]
+
+
+class Document:
+    """Lines of text and the rule painted on each character, as the text area would keep them"""
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.paint = [[None] * len(line) for line in self.lines]
+        self.requested = []
+
+    def get_text(self, first, last):
+        self.requested.append((first, last))
+        return "".join(line + "\n" for line in self.lines[first:last + 1])
+
+    def edit(self, highlighter, line, removed, new_lines):
+        self.lines[line:line + removed + 1] = new_lines
+        self.paint[line:line + removed + 1] = [[None] * len(text) for text in new_lines]
+        highlighter.on_edit(line, removed, len(new_lines) - 1)
+
+    def apply(self, region):
+        first, last, matches = region
+        for line in range(first, last + 1):
+            self.paint[line] = [None] * len(self.lines[line])
+        starts = [0]
+        for line in self.lines[first:last + 1]:
+            starts.append(starts[-1] + len(line) + 1)
+        for rule_index, start, end in matches:
+            for offset in range(start, end):
+                line = first + max(i for i, s in enumerate(starts) if s <= offset)
+                column = offset - starts[line - first]
+                if line <= last and column < len(self.lines[line]):
+                    self.paint[line][column] = rule_index
+
+
+def expected_paint(lines):
+    document = Document(lines)
+    document.apply(SyntaxHighlighter(RULES).highlight_lines(document.get_text, len(lines), 0, len(lines))[0])
+    return document.paint
+
+
+def test_an_edit_retokenizes_only_near_the_edited_line():
+    lines = [f"int x{i}; // {i}" for i in range(1000)]
+    highlighter = SyntaxHighlighter(RULES, sync_lines=5, lookahead=20)
+    document = Document(lines)
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, len(lines)):
+        document.apply(region)
+    assert highlighter.pending == []
+
+    document.requested = []
+    document.edit(highlighter, 500, 0, ["int y; int z;"])
+    assert highlighter.pending == [(500, 500)]
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, len(lines)):
+        document.apply(region)
+    assert document.requested == [(495, 520)]
+    assert document.paint == expected_paint(document.lines)
+
+
+def test_an_opened_block_comment_spreads_until_it_closes():
+    lines = ["int a;"] * 50 + ["*/ int b;"] + ["int c;"] * 150
+    # The lookahead is the longest token that can be found, 41 lines here
+    highlighter = SyntaxHighlighter(RULES, sync_lines=2, lookahead=45)
+    document = Document(lines)
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, len(lines)):
+        document.apply(region)
+
+    document.edit(highlighter, 10, 0, ["/* int a;"])
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, 20):
+        document.apply(region)
+    assert document.paint == expected_paint(document.lines)
+    assert document.paint[30] == [0] * 6
+    assert document.paint[50] == [0, 0, None, 2, 2, 2, None, None, None]
+
+    document.edit(highlighter, 10, 0, ["int a;"])
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, 20):
+        document.apply(region)
+    assert document.paint == expected_paint(document.lines)
+    assert document.paint[30] == [2, 2, 2, None, None, None]
+
+
+def test_random_edits_end_up_painted_as_a_full_pass_would():
+    rng = random.Random(3)
+    pieces = ["int", " ", "x", "/*", "*/", "//", ";"]
+    lines = ["".join(rng.choice(pieces) for _ in range(rng.randrange(6))) for _ in range(80)]
+    highlighter = SyntaxHighlighter(RULES, sync_lines=3, lookahead=400)
+    document = Document(lines)
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 0, len(lines)):
+        document.apply(region)
+    for _ in range(100):
+        line = rng.randrange(len(document.lines))
+        removed = rng.randrange(min(3, len(document.lines) - line))
+        new_lines = ["".join(rng.choice(pieces) for _ in range(rng.randrange(6)))
+                     for _ in range(rng.randrange(1, 4))]
+        document.edit(highlighter, line, removed, new_lines)
+        for region in highlighter.highlight_lines(document.get_text, len(document.lines), 0, len(document.lines)):
+            document.apply(region)
+        assert document.paint == expected_paint(document.lines)
+
+
+def test_background_chunks_start_at_the_viewport_and_work_outwards():
+    lines = [f"int x{i};" for i in range(100)]
+    highlighter = SyntaxHighlighter(RULES, sync_lines=0, lookahead=0)
+    document = Document(lines)
+    highlighter.resize(len(lines))
+    for region in highlighter.highlight_lines(document.get_text, len(lines), 40, 49):
+        document.apply(region)
+    assert highlighter.pending == [(0, 39), (50, 99)]
+
+    chunks = []
+    while highlighter.pending:
+        first, last, matches = highlighter.highlight_next(document.get_text, len(lines), 45, 10)
+        document.apply((first, last, matches))
+        chunks.append((first, last))
+    assert chunks[:2] == [(50, 59), (30, 39)]
+    assert sorted(chunks) == [(i, i + 9) for i in range(0, 40, 10)] + [(i, i + 9) for i in range(50, 100, 10)]
+    assert document.paint == expected_paint(lines)
+
+
+def test_a_pass_out_of_time_leaves_the_rest_pending():
+    lines = ["/* open"] + ["still a comment"] * 3 + ["*/"] + ["int x;"] * 95
+    highlighter = SyntaxHighlighter(RULES, sync_lines=0, lookahead=5)
+    document = Document(lines)
+    highlighter.resize(len(lines))
+    highlighter.take_pending(0, len(lines) - 1)
+    first, last, matches = highlighter.tokenize_range(document.get_text, len(lines), 0, 0, deadline=0)
+    assert (first, last) == (0, 0)
+    assert highlighter.pending == [(1, 1)]
+    assert highlighter.line_states[0] == (0,)
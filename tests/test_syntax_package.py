@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+import gvim_core
+from gvim_core import CompiledGrammar, ExtensionIndex, GrammarCache, SyntaxPackage
+
+PYTHON = {"scope": "py", "rules": [{"pattern": r"#.*", "color": "grey"}, {"pattern": r"\d+", "color": "red"}]}
+C = {"scope": "c h", "rules": [{"pattern": r"//.*", "color": "grey", "priority": 1}]}
+
+
+def test_problems_of_every_syntax_are_listed_together():
+    package = SyntaxPackage({"python": [PYTHON, {"rules": []}],
+                             "c": [{"scope": "c", "rules": [{"pattern": "(", "color": "red"}]}]})
+    assert package.problems[0] == "python syntax 1: no scope"
+    assert package.problems[1].startswith("c syntax 0: rule 0 ((): ")
+    assert len(package.problems) == 2
+    assert [lang for lang, *_ in package.grammars] == ["python"]
+    assert SyntaxPackage([]).problems == ["'syntaxes' is not an object"]
+
+
+def test_write_installs_indexes_and_caches_the_grammars(tmp_path):
+    extensions = tmp_path / "extensions"
+    extensions.mkdir()
+    index = ExtensionIndex(str(extensions))
+    cache = GrammarCache(str(tmp_path / "grammars.json"))
+    package = SyntaxPackage({"python": [PYTHON], "c": [C]})
+    package.write([("python.json", 0), ("c.json", 1)], index, cache)
+
+    assert index.lookup("h") == str(extensions / "c.json")
+    assert json.loads((extensions / "python.json").read_text()) == PYTHON
+    assert not [name for name in os.listdir(extensions) if name.endswith(".tmp")]
+
+    # A fresh cache finds the installed file by its contents and skips compiling each rule
+    fresh = GrammarCache(str(tmp_path / "grammars.json"))
+    grammar = CompiledGrammar.load(index.lookup("py"), fresh)
+    assert grammar.pattern_list is None
+    assert list(grammar.scan("1 # x", 5)) == [(1, 0, 1), (0, 2, 5)]
+
+
+def test_a_failed_write_leaves_nothing_behind(tmp_path, monkeypatch):
+    extensions = tmp_path / "extensions"
+    extensions.mkdir()
+    (extensions / "python.json").write_text("old")
+    index = ExtensionIndex(str(extensions))
+    package = SyntaxPackage({"python": [PYTHON], "c": [C]})
+    calls = []
+    real_write_temp = gvim_core.write_temp
+
+    def write_temp(path, data):
+        calls.append(path)
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return real_write_temp(path, data)
+
+    monkeypatch.setattr(gvim_core, "write_temp", write_temp)
+    with pytest.raises(OSError):
+        package.write([("python.json", 0), ("c.json", 1)], index)
+    assert sorted(os.listdir(extensions)) == ["python.json"]
+    assert (extensions / "python.json").read_text() == "old"
+
+
+def test_grammar_cache_keeps_the_newest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(GrammarCache, "MAX_ENTRIES", 2)
+    cache = GrammarCache(str(tmp_path / "grammars.json"))
+    grammar = CompiledGrammar(PYTHON["rules"])
+    for digest in ("a", "b", "a", "c"):
+        cache.put(digest, grammar)
+    cache.save()
+    assert list(GrammarCache(str(tmp_path / "grammars.json")).get("a")) == ["rules", "merge"]
+    reloaded = GrammarCache(str(tmp_path / "grammars.json"))
+    reloaded.load()
+    assert list(reloaded.entries) == ["a", "c"]
+
+
+def test_a_broken_cache_file_is_ignored(tmp_path):
+    path = tmp_path / "grammars.json"
+    path.write_text("{not json")
+    assert GrammarCache(str(path)).get("a") is None
@@ -0,0 +1,26 @@
+import json
+import os
+
+from gvim_core import ThemeRegistry
+
+
+def write_theme(path, background):
+    path.write_text(json.dumps({"background_color": background}))
+
+
+def test_theme_edited_in_place_is_parsed_again(tmp_path):
+    theme = tmp_path / "night.json"
+    write_theme(theme, "#000000")
+    registry = ThemeRegistry(str(tmp_path))
+    assert registry.get("night")["background_color"] == "#000000"
+    write_theme(theme, "#101010")
+    # Same size, so only the mtime tells the edit apart
+    stat = os.stat(theme)
+    os.utime(theme, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert registry.get("night")["background_color"] == "#101010"
+
+
+def test_unchanged_theme_comes_from_the_cache(tmp_path):
+    write_theme(tmp_path / "night.json", "#000000")
+    registry = ThemeRegistry(str(tmp_path))
+    assert registry.get("night") is registry.get("night")
@@ -0,0 +1,147 @@
+import queue
+import random
+import time
+
+import pytest
+
+from gvim_core import CompiledGrammar, SyntaxHighlighter, TokenizerWorker
+
+RULES = [{"pattern": r"/\*[\s\S]*?\*/", "priority": 5}, {"pattern": r"//.*", "priority": 4},
+         {"pattern": r'"[^"\n]*"', "priority": 3}, {"pattern": r"\b(?:if|int)\b", "priority": 2}]
+GRAMMAR = CompiledGrammar(RULES)
+
+
+@pytest.fixture
+def worker():
+    worker = TokenizerWorker(margin=5, chunk_lines=7, slice_ms=1)
+    worker.set_grammar(GRAMMAR)
+    yield worker
+    worker.stop()
+
+
+def settle(worker, handle, timeout=10):
+    """Hand every result to `handle` until the worker has nothing left to do"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            handle(*worker.results.get(timeout=0.01))
+        except queue.Empty:
+            if not worker.busy():
+                return
+    raise AssertionError("the tokenizer did not settle")
+
+
+class Screen:
+    """What the text area shows: the text and the rule painted on each character"""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.text = ""
+        self.paint = []
+
+    def lines(self):
+        return self.text.split("\n")
+
+    def line_start(self, line):
+        offset = 0
+        for _ in range(line):
+            offset = self.text.index("\n", offset) + 1
+        return offset
+
+    def get_lines(self, first, last):
+        return "".join(line + "\n" for line in self.lines()[first:last + 1])
+
+    def insert(self, offset, text):
+        line = self.text.count("\n", 0, offset)
+        self.text = self.text[:offset] + text + self.text[offset:]
+        self.paint[offset:offset] = [None] * len(text)
+        added = text.count("\n")
+        self.worker.edit(line, 0, added, self.get_lines(line, line + added))
+
+    def delete(self, start, end):
+        line = self.text.count("\n", 0, start)
+        removed = self.text.count("\n", start, end)
+        self.text = self.text[:start] + self.text[end:]
+        del self.paint[start:end]
+        self.worker.edit(line, removed, 0, self.get_lines(line, line))
+
+    def take(self, key, generation, region):
+        first, last, matches = region
+        if generation != self.worker.generation:
+            self.worker.retry(generation, first, last)
+            return
+        start = self.line_start(first)
+        end = self.line_start(last + 1) if last + 1 < len(self.lines()) else len(self.text)
+        self.paint[start:end] = [None] * (end - start)
+        for rule, match_start, match_end in matches:
+            for offset in range(start + match_start, min(start + match_end, len(self.text))):
+                self.paint[offset] = rule
+
+
+def reference(text):
+    highlighter = SyntaxHighlighter()
+    highlighter.set_grammar(GRAMMAR)
+    lines = text.split("\n")
+    paint = [None] * len(text)
+    get_lines = lambda first, last: "".join(line + "\n" for line in lines[first:last + 1])
+    for first, last, matches in highlighter.highlight_lines(get_lines, len(lines), 0, len(lines) - 1):
+        for rule, start, end in matches:
+            for offset in range(start, min(end, len(text))):
+                paint[offset] = rule
+    return paint
+
+
+def test_results_carry_the_generation_they_were_made_at(worker):
+    worker.reset("int a;\n")
+    worker.edit(0, 0, 0, "if a\n")
+    results = []
+    settle(worker, lambda key, generation, region: results.append(generation))
+    assert worker.generation == 2
+    assert results and max(results) == 2
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_fast_edits_end_up_painted_like_a_full_pass(worker, seed):
+    rng = random.Random(seed)
+    screen = Screen(worker)
+    screen.insert(0, "\n".join(rng.choice(["int a;", "// c", "/* x", "y */", '"s" if', "plain", ""])
+                               for _ in range(60)))
+    for _ in range(200):
+        if rng.random() < 0.7 or not screen.text:
+            screen.insert(rng.randint(0, len(screen.text)), rng.choice(["a", "\n", "/*", "*/", '"', "if ", "//", "x\ny"]))
+        else:
+            start = rng.randint(0, len(screen.text) - 1)
+            screen.delete(start, min(len(screen.text), start + rng.randint(1, 5)))
+        if rng.random() < 0.3:
+            top = rng.randint(0, len(screen.lines()) - 1)
+            worker.set_view(top, min(len(screen.lines()) - 1, top + 10))
+        if rng.random() < 0.2:
+            while not worker.results.empty():
+                screen.take(*worker.results.get())
+    settle(worker, screen.take)
+    assert screen.paint == reference(screen.text)
+
+
+def test_switching_back_keeps_the_document(worker):
+    first, second = object(), object()
+    assert not worker.switch(first)
+    worker.reset("int a;\n" * 50)
+    settle(worker, lambda *result: None)
+    generation = worker.generation
+    assert not worker.switch(second)
+    worker.reset("plain\n")
+    settle(worker, lambda *result: None)
+    assert worker.switch(first)
+    assert worker.generation == generation
+    tokenized = []
+    settle(worker, lambda key, generation, region: tokenized.append(key))
+    # Its line states are still there, nothing is tokenized again
+    assert tokenized == []
+
+
+def test_forgotten_document_wants_a_reset(worker):
+    document = object()
+    worker.switch(document)
+    worker.reset("int a;\n")
+    worker.forget(document)
+    assert not worker.switch(document)
@@ -0,0 +1,205 @@
+import os
+import random
+
+from gvim_core import UndoJournal
+
+
+class Buffer:
+    """A text and the journal recording its edits, the way the editor drives it"""
+
+    def __init__(self, path=None, text="hello\nworld\n", max_bytes=1 << 20):
+        self.text = text
+        self.journal = UndoJournal(max_bytes=max_bytes)
+        self.journal.start(path)
+
+    def offset(self, index):
+        line, column = map(int, index.split("."))
+        offset = 0
+        for _ in range(line - 1):
+            offset = self.text.index("\n", offset) + 1
+        return offset + column
+
+    def index(self, offset):
+        return f"{self.text.count(chr(10), 0, offset) + 1}.{offset - self.text.rfind(chr(10), 0, offset) - 1}"
+
+    def replace(self, index, removed, inserted):
+        start = self.offset(index)
+        assert self.text[start:start + len(removed)] == removed
+        self.text = self.text[:start] + inserted + self.text[start + len(removed):]
+
+    def edit(self, offset, length, inserted):
+        index, removed = self.index(offset), self.text[offset:offset + length]
+        self.replace(index, removed, inserted)
+        self.journal.record(index, removed, inserted)
+
+    def undo(self):
+        group = self.journal.take_undo()
+        for index, removed, inserted in reversed(group or []):
+            self.replace(index, inserted, removed)
+            self.journal.record(index, inserted, removed, history=False)
+        return group is not None
+
+    def redo(self):
+        group = self.journal.take_redo()
+        for index, removed, inserted in group or []:
+            self.replace(index, removed, inserted)
+            self.journal.record(index, removed, inserted, history=False)
+        return group is not None
+
+
+def test_typing_merges_into_one_undo_step():
+    buffer = Buffer()
+    for offset, char in enumerate("abc"):
+        buffer.edit(offset, 0, char)
+    assert buffer.text == "abchello\nworld\n"
+    assert buffer.undo()
+    assert buffer.text == "hello\nworld\n"
+    assert not buffer.undo()
+
+
+def test_group_is_one_undo_step():
+    buffer = Buffer()
+    buffer.journal.begin_group()
+    buffer.edit(0, 5, "HELLO")
+    buffer.journal.separate()
+    buffer.edit(6, 5, "WORLD")
+    buffer.journal.end_group()
+    assert buffer.undo()
+    assert buffer.text == "hello\nworld\n"
+    assert buffer.redo()
+    assert buffer.text == "HELLO\nWORLD\n"
+
+
+def test_new_edit_clears_redo():
+    buffer = Buffer()
+    buffer.edit(0, 0, "x")
+    buffer.undo()
+    buffer.edit(0, 0, "y")
+    assert not buffer.redo()
+    assert buffer.text == "yhello\nworld\n"
+
+
+def test_undo_redo_round_trip_through_the_swap_file():
+    rng = random.Random(3)
+    buffer = Buffer(max_bytes=600)
+    for _ in range(400):
+        roll = rng.random()
+        if roll < 0.5:
+            buffer.edit(rng.randint(0, len(buffer.text)), 0, rng.choice(["a", "b\n", "xyz"]))
+        elif roll < 0.7 and buffer.text:
+            offset = rng.randint(0, len(buffer.text) - 1)
+            buffer.edit(offset, min(3, len(buffer.text) - offset), rng.choice(["", "Q"]))
+        elif roll < 0.85:
+            buffer.undo()
+        else:
+            buffer.redo()
+        if rng.random() < 0.1:
+            buffer.journal.separate()
+    buffer.edit(0, 0, "S")
+    assert buffer.journal.spilled
+    latest = buffer.text
+    steps = [latest]
+    while buffer.undo():
+        steps.append(buffer.text)
+    assert buffer.text == "hello\nworld\n"
+    assert buffer.journal.size <= 600 or len(buffer.journal.undo) + len(buffer.journal.redo) <= 2
+    steps.pop()
+    while buffer.redo():
+        assert buffer.text == steps.pop()
+    assert buffer.text == latest
+
+
+def test_recover_replays_edits_made_since_the_save(tmp_path):
+    path = str(tmp_path / "file.txt")
+    with open(path, "w") as file:
+        file.write("hello\nworld\n")
+    buffer = Buffer(path)
+    buffer.edit(0, 0, "ZZ")
+    buffer.edit(2, 0, "\nq")
+    buffer.edit(3, 1, "")
+    assert buffer.journal.modified()
+    buffer.journal.flush()
+    recovered = Buffer(text="hello\nworld\n")
+    for index, removed, inserted in UndoJournal.recover(path):
+        recovered.replace(index, removed, inserted)
+    assert recovered.text == buffer.text
+
+
+def test_recover_ignores_a_record_cut_short(tmp_path):
+    path = str(tmp_path / "file.txt")
+    with open(path, "w") as file:
+        file.write("hello\nworld\n")
+    buffer = Buffer(path)
+    buffer.edit(0, 0, "a")
+    buffer.journal.swap.write(b'{"e": ["1.1", "", "tr')
+    buffer.journal.swap.flush()
+    assert UndoJournal.recover(path) == [("1.0", "", "a")]
+
+
+def test_nothing_to_recover_after_a_save(tmp_path):
+    path = str(tmp_path / "file.txt")
+    with open(path, "w") as file:
+        file.write("hello\nworld\n")
+    buffer = Buffer(path)
+    buffer.edit(0, 0, "a")
+    with open(path, "w") as file:
+        file.write(buffer.text)
+    buffer.journal.mark_saved(path)
+    assert not buffer.journal.modified()
+    assert UndoJournal.recover(path) is None
+    buffer.edit(1, 0, "b")
+    buffer.journal.flush()
+    assert len(UndoJournal.recover(path)) == 1
+    buffer.journal.close()
+    assert not os.path.exists(UndoJournal.swap_path_for(path))
+    assert UndoJournal.recover(path) is None
+
+
+def test_edits_reach_the_disk_on_flush_and_a_save_marker_at_once(tmp_path):
+    path = str(tmp_path / "file.txt")
+    with open(path, "w") as file:
+        file.write("hello\nworld\n")
+    buffer = Buffer(path)
+    assert os.path.getsize(UndoJournal.swap_path_for(path)) > 0
+    buffer.edit(0, 0, "a")
+    assert UndoJournal.recover(path) is None
+    buffer.journal.flush()
+    assert UndoJournal.recover(path) == [("1.0", "", "a")]
+
+
+def test_compacting_keeps_the_swap_file_bounded(tmp_path):
+    path = str(tmp_path / "file.txt")
+    with open(path, "w") as file:
+        file.write("hello\nworld\n")
+    rng = random.Random(5)
+    buffer = Buffer(path, max_bytes=600)
+    for step in range(3000):
+        if rng.random() < 0.2:
+            buffer.undo()
+        else:
+            buffer.edit(rng.randint(0, len(buffer.text)), 0, rng.choice(["ab", "c\n"]))
+        buffer.journal.separate()
+        if step == 2000:
+            with open(path, "w") as file:
+                file.write(buffer.text)
+            buffer.journal.mark_saved(path)
+            saved_text = buffer.text
+    assert buffer.journal.compacted
+    assert buffer.journal.swap_size <= 2 * buffer.journal.compacted + 600
+    buffer.journal.flush()
+    assert os.path.getsize(UndoJournal.swap_path_for(path)) == buffer.journal.swap_size
+
+    recovered = Buffer(text=saved_text)
+    for index, removed, inserted in UndoJournal.recover(path):
+        recovered.replace(index, removed, inserted)
+    assert recovered.text == buffer.text
+
+    latest = buffer.text
+    steps = [latest]
+    while buffer.undo():
+        steps.append(buffer.text)
+    assert buffer.text == "hello\nworld\n"
+    steps.pop()
+    while buffer.redo():
+        assert buffer.text == steps.pop()
+    assert buffer.text == latest
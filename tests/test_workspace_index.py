@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+from gvim_core import WorkspaceIndex
+
+
+def make_tree(root, depth, files_per_level):
+    directory = root
+    for level in range(depth):
+        directory = directory / f"level{level}"
+        directory.mkdir()
+        for i in range(files_per_level):
+            (directory / f"file{i}.txt").write_text("x\n")
+
+
+def test_root_is_the_nearest_repository(tmp_path):
+    (tmp_path / "repo" / ".git").mkdir(parents=True)
+    (tmp_path / "repo" / "src" / "pkg").mkdir(parents=True)
+    path = tmp_path / "repo" / "src" / "pkg" / "main.py"
+    assert WorkspaceIndex.find_root(str(path)) == str(tmp_path / "repo")
+
+
+def test_no_root_outside_a_repository(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / "notes").mkdir()
+    assert WorkspaceIndex.find_root(str(tmp_path / "notes" / "todo.txt")) is None
+    # A repository in the home directory is not a workspace either
+    (tmp_path / ".git").mkdir()
+    assert WorkspaceIndex.find_root(str(tmp_path / "notes" / "todo.txt")) is None
+
+
+def test_walk_is_capped_by_depth_and_file_count(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    root.mkdir()
+    make_tree(root, 6, 3)
+    monkeypatch.setattr(WorkspaceIndex, "MAX_DEPTH", 4)
+    index = WorkspaceIndex(str(root), directory=str(tmp_path / "index"), workers=1)
+    index.refresh({})
+    assert max(path.count(os.sep) for path in index.entries) == 3
+    assert not index.truncated
+    monkeypatch.setattr(WorkspaceIndex, "MAX_FILES", 5)
+    index.refresh({})
+    assert index.truncated
+    assert len(index.entries) == 5
+    # The shallowest files are the ones kept
+    assert sorted(path.count(os.sep) for path in index.entries) == [1, 1, 1, 2, 2]
+
+
+def test_saved_paths_outside_the_root_are_ignored(tmp_path):
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "a.txt").write_text("a\n")
+    outside = tmp_path / "b.txt"
+    outside.write_text("b\n")
+    index = WorkspaceIndex(str(root), directory=str(tmp_path / "index"), workers=1)
+    index.refresh({})
+    index.refresh({}, [str(outside), str(root / "a.txt")])
+    assert sorted(index.entries) == ["a.txt"]
+
+
+def test_symbols_come_from_the_built_in_rules(tmp_path):
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "shapes.py").write_text("class Circle:\n    def area(self):\n        pass\n")
+    (root / "main.c").write_text("#define SIZE 4\nstatic int helper(int x)\n{\n}\n")
+    index = WorkspaceIndex(str(root), directory=str(tmp_path / "index"), workers=1)
+    index.refresh(WorkspaceIndex.SYMBOL_RULES)
+    found = {(name, kind, os.path.basename(path), line) for name, kind, path, line in index.find_symbols("", 10)}
+    assert found == {("Circle", "class", "shapes.py", 1), ("area", "function", "shapes.py", 2),
+                     ("SIZE", "macro", "main.c", 1), ("helper", "function", "main.c", 2)}
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="the cache lives under LOCALAPPDATA there")
+def test_index_is_saved_in_the_user_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "a.txt").write_text("a\n")
+    index = WorkspaceIndex(str(root), workers=1)
+    index.refresh({})
+    assert os.path.dirname(index.path) == str(tmp_path / "cache" / "gvim" / "workspaces")
+    assert os.path.exists(index.path)